@@ -0,0 +1,153 @@
+"""
+Measure time-to-first-token (TTFT) of the custom LLM endpoint against a
+local fake OpenAI upstream, compared with calling the upstream directly
+and with waiting for a full, non-streamed completion.
+
+    python benchmarks/bench_custom_llm_ttft.py --turns 20 --first-token-ms 300 --tokens 40
+
+The fake upstream waits --first-token-ms, then emits --tokens chunks
+--token-ms apart. No database or credentials are needed: the requests
+carry no caller, so the endpoint runs without user context.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def completion_chunk(content: str, finish_reason=None) -> dict:
+    return {
+        "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": "fake",
+        "choices": [{"index": 0, "delta": {"content": content} if content else {}, "finish_reason": finish_reason}],
+    }
+
+
+def make_upstream(first_token: float, token_interval: float, tokens: int):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            headers = dict(line.split(": ", 1) for line in head.decode("latin-1").split("\r\n")[1:] if ": " in line)
+            length = int(headers.get("Content-Length", headers.get("content-length", 0)))
+            body = json.loads(await reader.readexactly(length)) if length else {}
+            await asyncio.sleep(first_token)
+
+            if body.get("stream"):
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+                for i in range(tokens):
+                    if i:
+                        await asyncio.sleep(token_interval)
+                    writer.write(f"data: {json.dumps(completion_chunk(f'tok{i} '))}\n\n".encode())
+                    await writer.drain()
+                writer.write(f"data: {json.dumps(completion_chunk('', 'stop'))}\n\ndata: [DONE]\n\n".encode())
+            else:
+                await asyncio.sleep(token_interval * (tokens - 1))
+                payload = json.dumps({
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": "fake",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": " ".join(f"tok{i}" for i in range(tokens))}}],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": 10 + tokens},
+                }).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                             + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def report(name: str, samples: list) -> None:
+    samples = sorted(samples)
+    print(f"{name:>28}: p50 {statistics.median(samples) * 1000:7.1f} ms  max {samples[-1] * 1000:7.1f} ms")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=20)
+    parser.add_argument("--tokens", type=int, default=40)
+    args = parser.parse_args()
+
+    upstream = await asyncio.start_server(
+        make_upstream(args.first_token_ms / 1000, args.token_ms / 1000, args.tokens), "127.0.0.1", 0)
+    upstream_url = f"http://127.0.0.1:{upstream.sockets[0].getsockname()[1]}/v1"
+
+    for name, value in {
+        "TWILIO_ACCOUNT_SID": "ACbench", "TWILIO_AUTH_TOKEN": "bench", "TWILIO_WHATSAPP_NUMBER": "+15550000000",
+        "VAPI_API_KEY": "bench", "OPENAI_API_KEY": "bench", "CUSTOM_LLM_SECRET": "bench",
+    }.items():
+        os.environ.setdefault(name, value)
+    os.environ["OPENAI_BASE_URL"] = upstream_url
+
+    import httpx
+    import uvicorn
+    from fastapi import FastAPI
+    from routes import custom_llm
+    from services.llm_gateway import client as upstream_client
+
+    app = FastAPI()
+    app.include_router(custom_llm.router, prefix="/api/v1")
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    messages = [{"role": "system", "content": "You are Prim."}, {"role": "user", "content": "Hi, can you help me?"}]
+    direct_ttft, endpoint_ttft, full = [], [], []
+
+    for _ in range(args.turns):
+        started = time.perf_counter()
+        stream = await upstream_client.chat.completions.create(model="fake", messages=messages, stream=True)
+        async for _chunk in stream:
+            direct_ttft.append(time.perf_counter() - started)
+            break
+        await stream.close()
+
+        started = time.perf_counter()
+        await upstream_client.chat.completions.create(model="fake", messages=messages)
+        full.append(time.perf_counter() - started)
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=30,
+                                 headers={"Authorization": f"Bearer {os.environ['CUSTOM_LLM_SECRET']}"}) as http:
+        for turn in range(args.turns):
+            body = {"model": "fake", "stream": True, "messages": messages, "call": {"id": "bench-call"}}
+            started = time.perf_counter()
+            first = None
+            async with http.stream("POST", "/api/v1/custom-llm/chat/completions", json=body) as response:
+                async for line in response.aiter_lines():
+                    if first is None and line.startswith("data: {"):
+                        first = time.perf_counter() - started
+            endpoint_ttft.append(first)
+
+    print(f"{args.turns} turns, upstream first token {args.first_token_ms:.0f} ms, "
+          f"{args.tokens} tokens every {args.token_ms:.0f} ms")
+    report("upstream direct, TTFT", direct_ttft)
+    report("custom-llm endpoint, TTFT", endpoint_ttft)
+    report("non-streamed completion", full)
+
+    server.should_exit = True
+    await server_task
+    upstream.close()
+    await upstream.wait_closed()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main())
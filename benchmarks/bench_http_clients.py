@@ -0,0 +1,146 @@
+"""
+Compare outbound Twilio/VAPI request latency with a new httpx client per
+request (the old behaviour) against the shared pooled clients.
+
+Runs against a local stub server, so it needs no credentials or network:
+
+    python benchmarks/bench_http_clients.py --requests 200 --concurrency 10 --tls
+
+--tls serves the stub over HTTPS with a throwaway self-signed certificate
+(requires the openssl CLI), which is where connection reuse matters most.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STUB_DELAY_SECONDS = 0.002
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Minimal keep-alive HTTP/1.1 server answering like Twilio and VAPI."""
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            path = lines[0].split(" ")[1]
+            headers = dict(line.split(": ", 1) for line in lines[1:] if ": " in line)
+            length = int(headers.get("Content-Length", headers.get("content-length", 0)))
+            if length:
+                await reader.readexactly(length)
+            await asyncio.sleep(STUB_DELAY_SECONDS)
+            body = json.dumps({"sid": "SM-stub"} if "Messages.json" in path else {"id": "call-stub"}).encode()
+            writer.write(
+                b"HTTP/1.1 201 Created\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+def make_certificate(directory: str) -> tuple:
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-addext", "subjectAltName=IP:127.0.0.1",
+         "-keyout", key, "-out", cert],
+        check=True, capture_output=True
+    )
+    return cert, key
+
+
+def summarize(name: str, latencies: list, elapsed: float) -> None:
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:>10}: {len(latencies) / elapsed:8.1f} req/s  "
+          f"p50 {statistics.median(latencies) * 1000:6.2f} ms  p95 {p95 * 1000:6.2f} ms")
+
+
+async def run(send, requests: int, concurrency: int) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await send(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies, time.perf_counter() - started
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--tls", action="store_true", help="serve the stub over HTTPS")
+    args = parser.parse_args()
+
+    ssl_context = None
+    scheme = "http"
+    tmp = tempfile.TemporaryDirectory()
+    if args.tls:
+        cert, key = make_certificate(tmp.name)
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(cert, key)
+        ssl_context.set_alpn_protocols(["http/1.1"])
+        os.environ["SSL_CERT_FILE"] = cert
+        scheme = "https"
+
+    server = await asyncio.start_server(handle_connection, "127.0.0.1", 0, ssl=ssl_context)
+    port = server.sockets[0].getsockname()[1]
+    base_url = f"{scheme}://127.0.0.1:{port}"
+
+    for name, value in {
+        "TWILIO_ACCOUNT_SID": "ACbench", "TWILIO_AUTH_TOKEN": "bench", "TWILIO_WHATSAPP_NUMBER": "+15550000000",
+        "VAPI_API_KEY": "bench", "OPENAI_API_KEY": "bench",
+    }.items():
+        os.environ.setdefault(name, value)
+    os.environ["TWILIO_API_BASE_URL"] = base_url
+    os.environ["VAPI_BASE_URL"] = base_url
+
+    import httpx
+    from services import http_clients
+    from services.whatsapp_service import post_whatsapp_message
+
+    async def send_unpooled(i: int) -> None:
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                f"{base_url}/2010-04-01/Accounts/ACbench/Messages.json",
+                auth=("ACbench", "bench"),
+                data={"From": "whatsapp:+15550000000", "To": f"whatsapp:+1555{i:07d}", "Body": "hello"}
+            )
+            response.raise_for_status()
+
+    async def send_pooled(i: int) -> None:
+        await post_whatsapp_message(f"whatsapp:+1555{i:07d}", "hello")
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}, {scheme}")
+    summarize("unpooled", *await run(send_unpooled, args.requests, args.concurrency))
+    await http_clients.start()
+    await send_pooled(0)  # open a connection before timing
+    summarize("pooled", *await run(send_pooled, args.requests, args.concurrency))
+    await http_clients.close()
+
+    server.close()
+    await server.wait_closed()
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main())
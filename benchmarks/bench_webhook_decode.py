@@ -0,0 +1,170 @@
+"""
+Compare decoding VAPI and Tally webhooks with json.loads plus dict
+walking (the old path) against the msgspec structs in models/, and
+encoding an assistant-request response with FastAPI's default encoder
+against msgspec.
+
+    python benchmarks/bench_webhook_decode.py --turns 120 --iterations 2000
+    python benchmarks/bench_webhook_decode.py --payload recorded/end-of-call.json
+
+Without --payload, payloads shaped like VAPI's end-of-call-report (with a
+--turns long transcript, artifact and analysis), assistant-request and a
+Tally form response are generated.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msgspec
+from fastapi.encoders import jsonable_encoder
+from models.tally import TallyWebhook
+from models.vapi import VapiWebhook, EndOfCallReportMessage
+
+vapi_decoder = msgspec.json.Decoder(VapiWebhook)
+tally_decoder = msgspec.json.Decoder(TallyWebhook)
+encoder = msgspec.json.Encoder()
+
+
+def call_object() -> dict:
+    return {
+        "id": "c2b4f1de-0d6a-4a0e-9d53-2b8b4a6f0a11", "orgId": "org-1", "type": "inboundPhoneCall",
+        "status": "ended", "phoneCallProvider": "twilio", "phoneCallTransport": "pstn",
+        "customer": {"number": "+15551234567"},
+        "createdAt": "2025-05-01T15:00:00.000Z", "updatedAt": "2025-05-01T15:06:00.000Z",
+    }
+
+
+def assistant_config() -> dict:
+    return {
+        "firstMessage": "Hey there! It's Prim!",
+        "model": {"provider": "openai", "model": "gpt-4.1", "messages": [{"role": "system", "content": "You are Prim. " * 200}]},
+        "voice": {"provider": "vapi", "voiceId": "Lily"},
+        "transcriber": {"provider": "deepgram", "model": "nova-2", "language": "en"},
+    }
+
+
+def end_of_call_report(turns: int) -> dict:
+    messages = [{"role": "system", "message": "You are Prim. " * 200, "time": 1746111600000, "secondsFromStart": 0}]
+    transcript = []
+    for i in range(turns):
+        role = "bot" if i % 2 == 0 else "user"
+        text = f"Turn {i}: I'd like to book a follow-up with my cardiologist next week if possible."
+        messages.append({
+            "role": role, "message": text, "time": 1746111600000 + i * 4000, "endTime": 1746111603000 + i * 4000,
+            "secondsFromStart": i * 4, "duration": 3000, "source": "", **({"metadata": {"wordLevelConfidence": [
+                {"word": word, "start": 0.1, "end": 0.2, "confidence": 0.98} for word in text.split()]}} if role == "user" else {}),
+        })
+        transcript.append(f"{'AI' if role == 'bot' else 'User'}: {text}")
+    openai_messages = [{"role": "assistant" if m["role"] == "bot" else m["role"], "content": m["message"]} for m in messages]
+    return {"message": {
+        "timestamp": 1746111960000, "type": "end-of-call-report", "endedReason": "customer-ended-call",
+        "call": call_object(), "assistant": assistant_config(),
+        "startedAt": "2025-05-01T15:00:00.000Z", "endedAt": "2025-05-01T15:06:00.000Z",
+        "cost": 0.42, "costBreakdown": {"stt": 0.05, "llm": 0.2, "tts": 0.1, "vapi": 0.07, "total": 0.42},
+        "transcript": "\n".join(transcript), "messages": messages,
+        "analysis": {"summary": "The user asked to book a cardiology follow-up. " * 10, "successEvaluation": "true"},
+        "artifact": {"messages": messages, "messagesOpenAIFormatted": openai_messages, "transcript": "\n".join(transcript),
+                     "recordingUrl": "https://storage.vapi.ai/recording.wav"},
+    }}
+
+
+def assistant_request() -> dict:
+    return {"message": {"timestamp": 1746111600000, "type": "assistant-request", "call": call_object(),
+                        "phoneNumber": {"id": "pn-1", "number": "+15550000000", "provider": "twilio"}}}
+
+
+def tally_response() -> dict:
+    return {
+        "eventId": "a4cb511e-d513-4fa5-baee-b815d718dfd1", "eventType": "FORM_RESPONSE", "createdAt": "2025-05-01T15:00:21.889Z",
+        "data": {"responseId": "2wgx4n", "submissionId": "2wgx4n", "respondentId": "dwQKYm", "formId": "mDYYWq",
+                 "formName": "Onboarding", "createdAt": "2025-05-01T15:00:21.000Z", "fields": [
+                     {"key": "question_1", "label": "Name or nickname", "type": "INPUT_TEXT", "value": "Ann"},
+                     {"key": "question_2", "label": "Email", "type": "INPUT_EMAIL", "value": "ann@example.com"},
+                     {"key": "question_3", "label": "Phone number", "type": "INPUT_PHONE_NUMBER", "value": "+15551234567"},
+                     {"key": "question_4", "label": "Conditions", "type": "CHECKBOXES", "value": ["a", "b"],
+                      "options": [{"id": str(i), "text": f"Option {i}"} for i in range(30)]},
+                 ]},
+    }
+
+
+def walk_vapi(data: dict) -> None:
+    """The lookups the old handlers made on the decoded dict."""
+    message = data.get("message", {})
+    message.get("type")
+    message.get("call", {}).get("customer", {}).get("number")
+    message.get("call", {}).get("id")
+    message.get("endedReason"), message.get("startedAt"), message.get("endedAt"), message.get("transcript")
+    for turn in message.get("artifact", {}).get("messages") or message.get("messages") or []:
+        turn.get("role"), turn.get("message"), turn.get("time")
+
+
+def walk_tally(data: dict) -> None:
+    data["data"]["formId"], data["createdAt"]
+    for field in data["data"]["fields"]:
+        field["type"], field["label"], field["value"]
+
+
+def walk_vapi_struct(webhook: VapiWebhook) -> None:
+    message = webhook.message
+    message.call.customer.number
+    if isinstance(message, EndOfCallReportMessage):
+        for turn in (message.artifact.messages if message.artifact else None) or message.messages:
+            turn.role, turn.message, turn.time
+
+
+def bench(fn, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations
+
+
+def report(name: str, size: int, baseline: float, fast: float) -> None:
+    print(f"{name:>28} {size / 1024:8.1f} KiB  json {baseline * 1e6:9.1f} us  msgspec {fast * 1e6:9.1f} us  "
+          f"{baseline / fast:5.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=120)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--payload", action="append", default=[],
+                        help="Recorded VAPI or Tally webhook body (JSON file); may be repeated")
+    args = parser.parse_args()
+
+    if args.payload:
+        payloads = []
+        for path in args.payload:
+            with open(path, "rb") as f:
+                payloads.append((os.path.basename(path), f.read()))
+    else:
+        payloads = [
+            ("end-of-call-report", json.dumps(end_of_call_report(args.turns)).encode()),
+            ("assistant-request", json.dumps(assistant_request()).encode()),
+            ("tally form response", json.dumps(tally_response()).encode()),
+        ]
+
+    print(f"decode, {args.iterations} iterations per payload")
+    for name, body in payloads:
+        if b'"eventType"' in body:
+            baseline = bench(lambda: walk_tally(json.loads(body)), args.iterations)
+            fast = bench(lambda: tally_decoder.decode(body), args.iterations)
+        else:
+            baseline = bench(lambda: walk_vapi(json.loads(body)), args.iterations)
+            fast = bench(lambda: walk_vapi_struct(vapi_decoder.decode(body)), args.iterations)
+        report(name, len(body), baseline, fast)
+
+    response = {"assistant": {**assistant_config(), "backgroundSound": "off", "startSpeakingPlan": {"waitSeconds": 2.0}}}
+    size = len(encoder.encode(response))
+    print(f"\nencode, {args.iterations} iterations")
+    baseline = bench(lambda: json.dumps(jsonable_encoder(response)).encode(), args.iterations)
+    fast = bench(lambda: encoder.encode(response), args.iterations)
+    report("assistant-request response", size, baseline, fast)
+
+
+if __name__ == "__main__":
+    main()
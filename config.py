@@ -8,14 +8,46 @@ class Settings(BaseSettings):
     twilio_account_sid: str
     twilio_auth_token: str
     twilio_whatsapp_number: str
+    twilio_api_base_url: str = "https://api.twilio.com"
+    twilio_timeout_seconds: float = 10.0
 
     # VAPI
     vapi_api_key: str
     vapi_phone_id: str = "4fcc0c65-34bd-48c9-9d49-29ca3e6d9bcc" # Prim test number
     vapi_webhook_url: str = "https://bdf1-70-53-71-114.ngrok-free.app/api/v1/vapi-webhook"
+    vapi_base_url: str = "https://api.vapi.ai"
+    vapi_timeout_seconds: float = 15.0
+    # Serve in-call completions from /api/v1/custom-llm instead of letting VAPI call OpenAI
+    custom_llm_enabled: bool = False
+    custom_llm_url: str = ""  # Public URL of the custom LLM endpoint; defaults to {base_url}/api/v1/custom-llm
+    custom_llm_secret: str = ""  # Bearer token VAPI sends to the custom LLM endpoint; requests are rejected while unset
+    custom_llm_history_messages: int = 20
+    custom_llm_max_calls: int = 1000
+    custom_llm_call_ttl_seconds: float = 3600.0
+
+    # Outbound HTTP connection pools (shared by the Twilio, VAPI and Postmark clients)
+    http2_enabled: bool = True
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry_seconds: float = 60.0
+    http_connect_timeout_seconds: float = 5.0
+    http_pool_timeout_seconds: float = 5.0
 
     # OpenAI
     openai_api_key: str
+    openai_base_url: str = ""  # OpenAI-compatible API base URL; defaults to OpenAI's
+    llm_model: str = "gpt-4.1"
+    llm_fallback_model: str = "gpt-4.1-mini"  # Used while llm_model's circuit breaker is open
+    llm_max_concurrency: int = 16
+    llm_timeout_seconds: float = 20.0  # Deadline for interactive completions, including retries
+    llm_background_timeout_seconds: float = 60.0
+    llm_first_token_timeout_seconds: float = 5.0  # Deadline for the first streamed token, including retries
+    llm_max_retries: int = 2
+    llm_retry_max_backoff_seconds: float = 4.0
+    llm_breaker_failure_threshold: int = 5
+    llm_breaker_reset_seconds: float = 30.0
+    llm_context_token_budget: int = 3000
+    llm_token_encoding: str = "o200k_base"
 
     # MongoDB
     database_url: str = ""  # For Digital Ocean DATABASE_URL
@@ -27,9 +59,124 @@ class Settings(BaseSettings):
     mongo_database: str = "prim"
     mongo_auth_source: str = "admin"  # Default auth source for MongoDB Atlas
     mongo_uri_str: str = ""  # Direct MongoDB URI (for MongoDB Atlas)
+    mongo_max_pool_size: int = 100  # Connections per server
+    mongo_min_pool_size: int = 10  # Kept open (and opened at startup) so requests don't pay connection setup
+    mongo_max_idle_time_seconds: float = 300.0
+    mongo_wait_queue_timeout_seconds: float = 5.0  # Max wait for a free pooled connection
+    mongo_connect_timeout_seconds: float = 5.0
+    mongo_server_selection_timeout_seconds: float = 5.0
+    mongo_socket_timeout_seconds: float = 30.0
+    mongo_compressors: str = ""  # Wire compression, e.g. "zstd,zlib" (zstd needs the zstandard package)
+    mongo_read_preference: str = "primary"  # e.g. "primaryPreferred", "secondaryPreferred"
+    mongo_ready_timeout_seconds: float = 2.0  # /ready fails if a ping takes longer
+    mongo_ready_max_pool_saturation: float = 0.9  # /ready fails while this share of the pool is checked out
     
+    # User cache
+    user_cache_max_size: int = 10000
+    user_cache_ttl_seconds: float = 300.0
+
+    # Conversation history buffer
+    history_buffer_messages_per_user: int = 50
+    history_buffer_max_messages: int = 100000
+    history_buffer_ttl_seconds: float = 600.0
+
+    # Embeddings
+    embedding_worker_enabled: bool = False  # Embeds every stored message (paid API calls); needed for memory retrieval
+    embedding_provider: str = "openai"  # "openai" or "fake" (offline, deterministic)
+    embedding_model: str = "text-embedding-3-small"
+    embedding_dimensions: int = 1536
+    embedding_batch_size: int = 256
+    embedding_flush_interval_seconds: float = 2.0
+    embedding_queue_max_size: int = 10000
+    embedding_requests_per_minute: int = 500
+    embedding_max_retries: int = 5
+
+    # In-process memory retrieval
+    memory_retrieval_top_k: int = 5
+    memory_retrieval_timeout_seconds: float = 1.5  # Replies go out without memories if retrieval takes longer
+    memory_index_max_users: int = 1000
+    memory_index_max_vectors_per_user: int = 20000
+    memory_index_ttl_seconds: float = 600.0  # Loaded users are re-checked against Mongo after this, for vectors stored by other processes
+    memory_snapshot_dir: str = ""  # Directory for memory-mapped vector snapshots; disabled when empty
+
+    # Qdrant (vectors are mirrored there when qdrant_host is set)
+    qdrant_host: str = ""
+    qdrant_port: int = 6333
+    qdrant_api_key: str = ""
+    qdrant_collection: str = "messages"
+
+    # Rolling conversation summaries
+    summary_model: str = "gpt-4.1-mini"
+    summary_message_threshold: int = 20
+    summary_token_threshold: int = 2000
+    summary_batch_size: int = 200
+    summary_max_tokens: int = 400
+    summary_min_recent_messages: int = 6
+
+    # Voice context snapshots for inbound calls
+    voice_context_model: str = "gpt-4.1-mini"
+    voice_context_debounce_seconds: float = 10.0
+    voice_context_history_messages: int = 30
+    voice_context_cache_size: int = 10000
+    voice_context_cache_ttl_seconds: float = 600.0
+
+    # WhatsApp processing pipeline
+    whatsapp_worker_concurrency: int = 8
+    whatsapp_queue_max_size: int = 500
+    whatsapp_enqueue_timeout_seconds: float = 0.5
+    whatsapp_coalesce_window_seconds: float = 1.5
+    whatsapp_coalesce_max_wait_seconds: float = 5.0
+    whatsapp_full_assistant_enabled: bool = False  # Reply to onboarded users with the full assistant instead of the beta reply
+    shutdown_drain_timeout_seconds: float = 20.0
+
+    # Outbound WhatsApp sends (Twilio throughput limits)
+    whatsapp_send_rate_per_second: float = 20.0  # Twilio account limit, shared by all sending processes
+    whatsapp_send_burst: int = 20
+    whatsapp_send_processes: int = 2  # Processes sending WhatsApp messages (web apps and workers); each gets an equal share of the rate and burst
+    whatsapp_recipient_rate_per_second: float = 1.0
+    whatsapp_recipient_burst: int = 3
+    whatsapp_send_concurrency: int = 10
+    whatsapp_send_max_retries: int = 5
+
+    # Cached beta and onboarding replies
+    response_cache_enabled: bool = True
+    response_cache_max_size: int = 5000
+    response_cache_ttl_seconds: float = 3600.0
+    response_cache_similarity_threshold: float = 0.0  # Cosine similarity for near-duplicate hits, e.g. 0.92; 0 disables
+
+    # Background jobs (jobs collection; run by `python -m worker` and, when enabled, in the web process)
+    job_worker_enabled: bool = True  # Run a job worker inside the web process too
+    job_worker_concurrency: int = 8
+    job_poll_interval_seconds: float = 1.0
+    job_visibility_timeout_seconds: float = 300.0  # A leased job is retried elsewhere if not finished by then
+    job_max_attempts: int = 5
+    job_retry_base_seconds: float = 5.0
+    job_retry_max_seconds: float = 600.0
+    job_retention_seconds: int = 604800  # Finished jobs are deleted after this; dead ones are kept
+
+    # Delayed jobs (timers collection, held in a timing wheel once near-term)
+    timer_scheduler_enabled: bool = True  # Run a timer scheduler inside the web process too
+    timer_tick_seconds: float = 1.0
+    timer_wheel_slots: int = 60  # Two levels of 60 one-second slots cover just under an hour
+    timer_lookahead_seconds: float = 300.0  # Timers due within this are claimed and held in memory
+    timer_load_interval_seconds: float = 60.0
+    timer_batch_size: int = 500
+    timer_dispatch_concurrency: int = 20
+    timer_claim_grace_seconds: float = 60.0
+    missed_call_retry_delay_seconds: float = 1200.0  # A missed YC onboarding call is retried once after this
+    follow_up_nudge_delay_seconds: float = 82800.0  # WhatsApp check-in on open tasks after this long without a message; must stay under WhatsApp's 24h window
+    follow_up_refresh_seconds: float = 3600.0  # Reschedule a user's check-in at most this often
+
+    # Webhook idempotency
+    idempotency_ttl_seconds: int = 86400
+    idempotency_cache_size: int = 50000
+
     # Postmark
     postmark_api_key: str = ""
+    postmark_api_base_url: str = "https://api.postmarkapp.com"
+    postmark_timeout_seconds: float = 10.0
+    email_batch_window_seconds: float = 0.2  # Emails sent within this window share one batch request; 0 disables
+    email_batch_max_size: int = 500
     email_from: str = "prim@mail.primhealth.ai"
 
     # Application
@@ -1,11 +1,27 @@
-from motor.motor_asyncio import AsyncIOMotorClient
+"""
+MongoDB client and collections.
+
+The client is created by connect(), which the app lifespan and the worker
+call at startup: it builds the connection pool from the mongo_* settings
+and warms it with pings, so the first requests don't pay for server
+selection, TCP/TLS and auth. Code running outside those (scripts) gets the
+client created on first use. The module-level collections are proxies
+that resolve against the current client, so `from db import
+users_collection` works before connect() has run.
+
+A CMAP listener tracks pool usage for /ready and /metrics.
+"""
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import monitoring
 from config import get_settings
-import ssl
+import asyncio
 import tempfile
+import threading
+import time
 import os
 import logging
 import base64
-import subprocess
+from typing import Any, Dict, Optional
 
 settings = get_settings()
 
@@ -13,92 +29,267 @@ settings = get_settings()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# MongoDB setup with SSL/TLS support
-try:
-    if settings.ca_cert:
-        logger.info("CA certificate found in settings")
-
-        # For Digital Ocean managed databases, we should use the system's CA certificates
-        cert_path = "/etc/ssl/certs/ca-certificates.crt"
-        if os.path.exists(cert_path):
-            logger.info(f"Using system CA certificates from {cert_path}")
-
-            # Configure MongoDB client with system CA certificates
-            client = AsyncIOMotorClient(
-                settings.mongo_uri,
-                tls=True,
-                tlsAllowInvalidCertificates=False,
-                tlsCAFile=cert_path
-            )
-            logger.info(
-                "Successfully connected to MongoDB with system CA certificates")
-        else:
-            logger.warning(
-                "System CA certificates not found, attempting to use provided certificate")
-            # Fallback to using the provided certificate
-            with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_ca:
-                try:
-                    # Try to decode if the certificate is base64 encoded
-                    try:
-                        cert_content = base64.b64decode(
-                            settings.ca_cert).decode('utf-8')
-                        logger.info(
-                            "Successfully decoded base64 CA certificate")
-                    except Exception as decode_error:
-                        logger.info(
-                            f"Base64 decode failed: {decode_error}, trying raw content")
-                        cert_content = settings.ca_cert
-                        logger.info("Using raw CA certificate content")
-
-                    # Write the certificate content
-                    temp_ca.write(cert_content)
-                    temp_ca.flush()
-                    temp_ca_path = temp_ca.name
-                    logger.info(
-                        f"Created temporary CA certificate file at {temp_ca_path}")
-
-                    # Configure MongoDB client
-                    client = AsyncIOMotorClient(
-                        settings.mongo_uri,
-                        tls=True,
-                        tlsAllowInvalidCertificates=False,
-                        tlsCAFile=temp_ca_path
-                    )
-                    logger.info(
-                        "Successfully connected to MongoDB with provided certificate")
-                finally:
-                    # Clean up the temporary file
-                    try:
-                        os.unlink(temp_ca_path)
-                        logger.info("Cleaned up temporary CA certificate file")
-                    except Exception as e:
-                        logger.warning(
-                            f"Failed to clean up temporary CA certificate file: {e}")
-    else:
+# For Digital Ocean managed databases, we should use the system's CA certificates
+SYSTEM_CA_PATH = "/etc/ssl/certs/ca-certificates.crt"
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Connection pool counters per server, from CMAP events. Events arrive on
+    pymongo's threads, hence the lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open: Dict[str, int] = {}
+        self.checked_out: Dict[str, int] = {}
+        self.waiting: Dict[str, int] = {}
+        self.checkout_failures = 0
+        self.pool_clears = 0
+
+    def _add(self, counts: Dict[str, int], address: Any, delta: int) -> None:
+        key = "%s:%s" % address
+        with self._lock:
+            counts[key] = max(0, counts.get(key, 0) + delta)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        key = "%s:%s" % event.address
+        with self._lock:
+            for counts in (self.open, self.checked_out, self.waiting):
+                counts.pop(key, None)
+
+    def connection_created(self, event):
+        self._add(self.open, event.address, 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(self.open, event.address, -1)
+
+    def connection_check_out_started(self, event):
+        self._add(self.waiting, event.address, 1)
+
+    def connection_check_out_failed(self, event):
+        self._add(self.waiting, event.address, -1)
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        self._add(self.waiting, event.address, -1)
+        self._add(self.checked_out, event.address, 1)
+
+    def connection_checked_in(self, event):
+        self._add(self.checked_out, event.address, -1)
+
+    def saturation(self) -> float:
+        """Checked-out share of the busiest server's pool."""
+        with self._lock:
+            busiest = max(self.checked_out.values(), default=0)
+        return busiest / settings.mongo_max_pool_size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "open": sum(self.open.values()),
+                "checked_out": sum(self.checked_out.values()),
+                "waiting": sum(self.waiting.values()),
+                "max_pool_size": settings.mongo_max_pool_size,
+                "checkout_failures": self.checkout_failures,
+                "pool_clears": self.pool_clears,
+            }
+
+
+pool_monitor = PoolMonitor()
+_client: Optional[AsyncIOMotorClient] = None
+_database: Optional[AsyncIOMotorDatabase] = None
+last_ping_ms: Optional[float] = None
+
+
+def _client_options() -> Dict[str, Any]:
+    options: Dict[str, Any] = {
+        "maxPoolSize": settings.mongo_max_pool_size,
+        "minPoolSize": settings.mongo_min_pool_size,
+        "maxIdleTimeMS": int(settings.mongo_max_idle_time_seconds * 1000),
+        "waitQueueTimeoutMS": int(settings.mongo_wait_queue_timeout_seconds * 1000),
+        "connectTimeoutMS": int(settings.mongo_connect_timeout_seconds * 1000),
+        "serverSelectionTimeoutMS": int(settings.mongo_server_selection_timeout_seconds * 1000),
+        "socketTimeoutMS": int(settings.mongo_socket_timeout_seconds * 1000),
+        "readPreference": settings.mongo_read_preference,
+        "event_listeners": [pool_monitor],
+    }
+    if settings.mongo_compressors:
+        options["compressors"] = settings.mongo_compressors
+    return options
+
+
+def _create_client() -> AsyncIOMotorClient:
+    options = _client_options()
+    if not settings.ca_cert:
         logger.info("No CA certificate found, connecting without SSL")
-        client = AsyncIOMotorClient(settings.mongo_uri)
-        logger.info("Connected to MongoDB without SSL")
+        return AsyncIOMotorClient(settings.mongo_uri, **options)
+
+    logger.info("CA certificate found in settings")
+    if os.path.exists(SYSTEM_CA_PATH):
+        logger.info(f"Using system CA certificates from {SYSTEM_CA_PATH}")
+        return AsyncIOMotorClient(
+            settings.mongo_uri, tls=True, tlsAllowInvalidCertificates=False, tlsCAFile=SYSTEM_CA_PATH, **options)
+
+    logger.warning("System CA certificates not found, attempting to use provided certificate")
+    try:
+        # Try to decode if the certificate is base64 encoded
+        cert_content = base64.b64decode(settings.ca_cert).decode('utf-8')
+        logger.info("Successfully decoded base64 CA certificate")
+    except Exception as decode_error:
+        logger.info(f"Base64 decode failed: {decode_error}, trying raw content")
+        cert_content = settings.ca_cert
+    # pymongo only takes a CA file; it is read when the client is created
+    with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_ca:
+        temp_ca.write(cert_content)
+    try:
+        return AsyncIOMotorClient(
+            settings.mongo_uri, tls=True, tlsAllowInvalidCertificates=False, tlsCAFile=temp_ca.name, **options)
+    finally:
+        try:
+            os.unlink(temp_ca.name)
+        except Exception as e:
+            logger.warning(f"Failed to clean up temporary CA certificate file: {e}")
+
+
+def get_client() -> AsyncIOMotorClient:
+    global _client, _database
+    if _client is None:
+        try:
+            _client = _create_client()
+        except Exception as e:
+            logger.error(f"Failed to create MongoDB client: {str(e)}")
+            raise
+        _database = _client[settings.mongo_database]
+        logger.info(f"Created MongoDB client for database: {settings.mongo_database}")
+    return _client
+
+
+def get_database() -> AsyncIOMotorDatabase:
+    get_client()
+    return _database
+
+
+async def ping() -> float:
+    """
+    Round-trip a ping to the server.
+    Returns:
+        Latency in milliseconds
+    """
+    global last_ping_ms
+    started = time.perf_counter()
+    await get_client().admin.command("ping")
+    last_ping_ms = (time.perf_counter() - started) * 1000
+    return last_ping_ms
+
+
+async def connect() -> None:
+    """
+    Create the client and warm its pool: concurrent pings open up to
+    mongo_min_pool_size connections, so startup fails fast if Mongo is
+    unreachable and the first requests find connections ready.
+    """
+    get_client()
+    await asyncio.gather(*(ping() for _ in range(max(1, settings.mongo_min_pool_size))))
+    logger.info(f"Connected to MongoDB in {last_ping_ms:.1f}ms, {pool_monitor.stats()['open']} connections open")
+
+
+def close() -> None:
+    global _client, _database
+    if _client is not None:
+        _client.close()
+        _client = None
+        _database = None
+        logger.info("Closed MongoDB client")
+
+
+class CollectionProxy:
+    """Stands in for a collection of the current client's database."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._database: Optional[AsyncIOMotorDatabase] = None
+        self._collection: Optional[AsyncIOMotorCollection] = None
+
+    def _resolve(self) -> AsyncIOMotorCollection:
+        database = get_database()
+        if self._database is not database:
+            self._database = database
+            self._collection = database[self._name]
+        return self._collection
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._resolve(), attr)
+
+    def __repr__(self) -> str:
+        return f"CollectionProxy({self._name!r})"
+
 
-    db = client[settings.mongo_database]
-    logger.info(f"Connected to database: {settings.mongo_database}")
+def get_db_stats() -> dict:
+    return {"connected": _client is not None, "last_ping_ms": last_ping_ms, "pool": pool_monitor.stats()}
 
-    # Collections
-    users_collection = db.users
-    messages_collection = db.messages
-    logger.info("Successfully initialized database collections")
 
-except Exception as e:
-    logger.error(f"Failed to connect to MongoDB: {str(e)}")
-    logger.error(f"Error type: {type(e)}")
-    raise
+# Collections
+users_collection = CollectionProxy("users")
+messages_collection = CollectionProxy("messages")
+processed_events_collection = CollectionProxy("processed_events")
+worker_state_collection = CollectionProxy("worker_state")
+# Keyed by user _id; one document per user
+voice_contexts_collection = CollectionProxy("voice_contexts")
+jobs_collection = CollectionProxy("jobs")
+timers_collection = CollectionProxy("timers")
 
 
 async def ensure_indexes():
+    # Imported here: user_service imports this module
+    from services.user_service import backfill_normalized_phones
     try:
         # Create indexes for MongoDB collections
         await users_collection.create_index("phone", unique=True)
-        await messages_collection.create_index("user_id")
+        # Resolve normalized phone collisions first, or the unique index can't
+        # be built; the web app and workers all get here, in any order
+        await backfill_normalized_phones()
+        # Normalized phone fields back get_user_by_phone; sparse so users
+        # without a number don't collide on a missing value.
+        await users_collection.create_index("normalized_phone", unique=True, sparse=True)
+        await users_collection.create_index("normalized_call_phone", sparse=True)
+        # Serves "latest N messages for a user" as a single index range scan
+        # (_id breaks ties between messages stored in the same millisecond);
+        # also covers plain user_id lookups
+        await messages_collection.create_index([("user_id", 1), ("timestamp", -1), ("_id", -1)])
         await messages_collection.create_index("timestamp")
+        # Finds a user's messages not yet folded into their rolling summary
+        await messages_collection.create_index([("user_id", 1), ("summarized", 1), ("timestamp", 1)])
+        await messages_collection.create_index(
+            [("call_id", 1), ("turn_index", 1)],
+            unique=True,
+            partialFilterExpression={"call_id": {"$type": "string"}})
+        # Webhook dedup keys expire on their own once retries can no longer arrive
+        await processed_events_collection.create_index(
+            "created_at", expireAfterSeconds=settings.idempotency_ttl_seconds)
+        # Job leasing scans runnable jobs by run_at; dedupe keys make enqueueing
+        # from a re-delivered webhook a no-op
+        await jobs_collection.create_index([("status", 1), ("run_at", 1)])
+        await jobs_collection.create_index("dedupe_key", unique=True, sparse=True)
+        await jobs_collection.create_index("finished_at", expireAfterSeconds=settings.job_retention_seconds)
+        # Finds a user's recent jobs, e.g. whether a missed call was already retried
+        await jobs_collection.create_index([("payload.user_id", 1), ("type", 1)], sparse=True)
+        await timers_collection.create_index("due_at")
+        await timers_collection.create_index("dedupe_key", unique=True, sparse=True)
         logger.info("Successfully created MongoDB indexes")
     except Exception as e:
         logger.error(f"Failed to create MongoDB indexes: {e}")
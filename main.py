@@ -1,7 +1,29 @@
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from routes import whatsapp, vapi, tally, postmark
-from db import ensure_indexes
+from fastapi.responses import JSONResponse
+from routes import whatsapp, vapi, tally, postmark, custom_llm
+import db
+from services.user_service import get_user_cache_stats
+from services.idempotency_service import get_idempotency_stats
+from services.message_service import get_conversation_buffer_stats
+from services import summary_service
+from services.embedding_service import embedding_worker
+from services import retrieval_service
+from services import http_clients
+from services.email_service import outbox, get_email_stats
+from services.whatsapp_service import outbound, get_outbound_stats
+from services.llm_gateway import get_llm_stats
+from services.response_cache import get_response_cache_stats
+from services.custom_llm_service import get_custom_llm_stats
+from services import voice_context_service
+from services.job_queue import job_worker, get_job_stats
+from services.timer_service import timer_scheduler, get_timer_stats
+from services import follow_up_service
+# Registers the job handlers
+import services.jobs  # noqa: F401
+from config import get_settings
 
 # Configure logging
 logging.basicConfig(
@@ -14,22 +36,110 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-app = FastAPI(title="Prim API")
+settings = get_settings()
+
+# Set once startup finishes and cleared when shutdown starts, so /ready
+# takes the instance out of rotation before it stops serving
+accepting_traffic = False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global accepting_traffic
+    # Open and warm the Mongo connection pool before anything queries it
+    await db.connect()
+    # Ensure database indexes are created (backfilling normalized phones first)
+    await db.ensure_indexes()
+    await http_clients.start()
+    await whatsapp.pipeline.start()
+    summary_service.start()
+    voice_context_service.start()
+    if settings.embedding_worker_enabled:
+        embedding_worker.start()
+    retrieval_service.start()
+    follow_up_service.start()
+    if settings.job_worker_enabled:
+        job_worker.start()
+    if settings.timer_scheduler_enabled:
+        timer_scheduler.start()
+    accepting_traffic = True
+    logger.info("Application started and database indexes created")
+
+    yield
+
+    accepting_traffic = False
+    # Let pending and queued WhatsApp replies finish before the process exits
+    await whatsapp.coalescer.drain(timeout=settings.shutdown_drain_timeout_seconds)
+    await whatsapp.pipeline.stop(timeout=settings.shutdown_drain_timeout_seconds)
+    await follow_up_service.stop()
+    await timer_scheduler.stop()
+    await job_worker.stop(timeout=settings.shutdown_drain_timeout_seconds)
+    await outbound.stop(timeout=settings.shutdown_drain_timeout_seconds)
+    await summary_service.stop()
+    await voice_context_service.stop()
+    await embedding_worker.stop()
+    # Snapshot warm users' vectors so the next start can memory-map them
+    retrieval_service.stop()
+    await outbox.close()
+    await http_clients.close()
+    db.close()
+    logger.info("Application shut down")
+
+
+app = FastAPI(title="Prim API", lifespan=lifespan)
 
 # Include routers
 app.include_router(whatsapp.router, prefix="/api/v1", tags=["whatsapp"])
 app.include_router(vapi.router, prefix="/api/v1", tags=["vapi"])
 app.include_router(tally.router, prefix="/api/v1", tags=["tally"])
 app.include_router(postmark.router, prefix="/api/v1", tags=["postmark"])
-
-
-@app.on_event("startup")
-async def startup_event():
-    # Ensure database indexes are created
-    await ensure_indexes()
-    logger.info("Application started and database indexes created")
+app.include_router(custom_llm.router, prefix="/api/v1", tags=["custom-llm"])
 
 
 @app.get("/")
 async def root():
     return {"status": "ok", "message": "Prim Backend is running"}
+
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness for the load balancer: 503 until startup has finished, while
+    shutting down, when Mongo doesn't answer a ping within
+    mongo_ready_timeout_seconds, or when the connection pool is nearly
+    exhausted.
+    """
+    status = {"ready": False, "mongo_latency_ms": None, "pool_saturation": db.pool_monitor.saturation()}
+    if not accepting_traffic:
+        return JSONResponse({**status, "reason": "not accepting traffic"}, status_code=503)
+    try:
+        status["mongo_latency_ms"] = round(await asyncio.wait_for(db.ping(), settings.mongo_ready_timeout_seconds), 2)
+    except Exception as e:
+        return JSONResponse({**status, "reason": f"mongo ping failed: {type(e).__name__}"}, status_code=503)
+    if status["pool_saturation"] >= settings.mongo_ready_max_pool_saturation:
+        return JSONResponse({**status, "reason": "mongo connection pool saturated"}, status_code=503)
+    return {**status, "ready": True}
+
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "mongo": db.get_db_stats(),
+        "user_cache": get_user_cache_stats(),
+        "conversation_buffer": get_conversation_buffer_stats(),
+        "whatsapp_pipeline": whatsapp.pipeline.stats(),
+        "whatsapp_coalescer": whatsapp.coalescer.stats(),
+        "whatsapp_outbound": get_outbound_stats(),
+        "idempotency": get_idempotency_stats(),
+        "embeddings": embedding_worker.stats(),
+        "vector_index": retrieval_service.vector_index.stats(),
+        "email": get_email_stats(),
+        "llm": get_llm_stats(),
+        "response_cache": get_response_cache_stats(),
+        "custom_llm": get_custom_llm_stats(),
+        "voice_context": voice_context_service.get_voice_context_stats(),
+        "vapi_events": vapi.get_vapi_event_stats(),
+        "jobs": await get_job_stats(),
+        "timers": get_timer_stats(),
+        "follow_ups": follow_up_service.get_follow_up_stats(),
+    }
@@ -0,0 +1,28 @@
+from datetime import datetime
+from typing import Any, Dict, Literal, Optional
+from pydantic import BaseModel, Field
+from bson import ObjectId
+from .user import PyObjectId
+
+
+class Job(BaseModel):
+    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    type: str
+    payload: Dict[str, Any] = Field(default_factory=dict)
+    status: Literal["queued", "running", "done", "dead"] = "queued"
+    attempts: int = 0
+    max_attempts: int
+    # When the job can next run; while running, when its lease expires
+    run_at: datetime = Field(default_factory=datetime.utcnow)
+    # Identifies the current lease, so a worker whose lease lapsed can't finish the job
+    lease_id: Optional[str] = None
+    last_error: Optional[str] = None
+    # Jobs with the same key are only enqueued once
+    dedupe_key: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    finished_at: Optional[datetime] = None
+    dead_at: Optional[datetime] = None
+
+    class Config:
+        json_encoders = {ObjectId: str}
+        populate_by_name = True
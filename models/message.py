@@ -13,6 +13,11 @@ class Message(BaseModel):
     source: Literal["whatsapp", "voice"]
     sender: Literal["user", "assistant"]
     timestamp: datetime = Field(default_factory=datetime.utcnow)
+    # Set on voice transcript turns so re-delivered call reports are no-ops
+    call_id: Optional[str] = None
+    turn_index: Optional[int] = None
+    # Set once the message has been folded into the user's rolling summary
+    summarized: bool = False
 
     class Config:
         json_encoders = {ObjectId: str}
@@ -0,0 +1,21 @@
+from typing import Any, List, Optional
+import msgspec
+
+
+class TallyField(msgspec.Struct):
+    type: str
+    label: Optional[str] = None
+    # Text inputs are strings; choice fields send lists
+    value: Any = None
+
+
+class TallyFormResponse(msgspec.Struct):
+    formId: str
+    fields: List[TallyField]
+
+
+class TallyWebhook(msgspec.Struct):
+    """The parts of a Tally FORM_RESPONSE webhook the onboarding flow reads."""
+    createdAt: str
+    data: TallyFormResponse
+    eventId: Optional[str] = None
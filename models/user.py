@@ -30,6 +30,10 @@ class User(BaseModel):
     onboarded: bool = False
     is_yc: bool = False
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    # Set by backfill_normalized_phones on users whose phone normalizes to another user's
+    duplicate_of: Optional[PyObjectId] = None
+    # Rolling conversation summary; the messages it covers are marked `summarized`
+    conversation_summary: Optional[str] = None
 
     class Config:
         json_encoders = {ObjectId: str}
@@ -0,0 +1,65 @@
+"""
+Typed views of the VAPI webhook events we handle.
+
+Each struct declares only the fields its handler reads; msgspec skips
+everything else in the payload (analysis, artifact recordings, the full
+assistant config) without building dicts for it. `message.type` selects
+the struct, so unhandled event types fail to decode.
+"""
+from typing import List, Optional, Union
+import msgspec
+
+
+class VapiCustomer(msgspec.Struct):
+    number: Optional[str] = None
+
+
+class VapiCall(msgspec.Struct):
+    id: Optional[str] = None
+    customer: Optional[VapiCustomer] = None
+
+
+class VapiCallMessage(msgspec.Struct):
+    """One turn of a call transcript."""
+    role: Optional[str] = None
+    message: Optional[str] = None
+    # Epoch milliseconds, or ISO 8601
+    time: Union[float, str, None] = None
+
+
+class VapiArtifact(msgspec.Struct):
+    messages: List[VapiCallMessage] = []
+
+
+class AssistantRequestMessage(msgspec.Struct, tag="assistant-request"):
+    call: Optional[VapiCall] = None
+
+
+class EndOfCallReportMessage(msgspec.Struct, tag="end-of-call-report"):
+    call: Optional[VapiCall] = None
+    endedReason: Optional[str] = None
+    startedAt: Optional[str] = None
+    endedAt: Optional[str] = None
+    transcript: Optional[str] = None
+    messages: List[VapiCallMessage] = []
+    artifact: Optional[VapiArtifact] = None
+
+
+VapiMessage = Union[AssistantRequestMessage, EndOfCallReportMessage]
+
+
+class VapiWebhook(msgspec.Struct):
+    message: VapiMessage
+
+
+class VapiMessageType(msgspec.Struct):
+    type: Optional[str] = None
+
+
+class VapiWebhookType(msgspec.Struct):
+    """Just the event type, for bodies that failed to decode as VapiWebhook."""
+    message: Optional[VapiMessageType] = None
+
+
+def message_type(message: VapiMessage) -> str:
+    return type(message).__struct_config__.tag
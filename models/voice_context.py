@@ -0,0 +1,23 @@
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel, Field
+from bson import ObjectId
+from .user import PyObjectId
+
+
+class VoiceContext(BaseModel):
+    """
+    What the voice assistant needs to greet a user who calls in, prepared
+    ahead of time so assistant-request can answer with one lookup.
+    """
+    user_id: PyObjectId = Field(alias="_id")
+    greeting: str
+    summary: Optional[str] = None
+    open_tasks: List[str] = Field(default_factory=list)
+    # Timestamp of the newest message the snapshot was built from
+    through: Optional[datetime] = None
+    built_at: datetime = Field(default_factory=datetime.utcnow)
+
+    class Config:
+        json_encoders = {ObjectId: str}
+        populate_by_name = True
@@ -0,0 +1,120 @@
+import hmac
+import json
+import logging
+from typing import Optional
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from models.user import User
+from services.custom_llm_service import CallState, call_states, build_call_context, assemble_messages
+from services.llm_gateway import gateway
+from services.user_service import get_user_by_id, get_user_by_phone
+from config import get_settings
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Request fields passed through to the upstream completion. The model and
+# tools are ours to choose, not the caller's.
+PASSTHROUGH_PARAMS = ("temperature", "max_tokens", "top_p")
+
+
+def authorize(request: Request) -> None:
+    """
+    Reject requests without the shared secret (Authorization: Bearer, or
+    VAPI's X-Vapi-Secret): the endpoint puts a user's summary and history
+    into the completion.
+    """
+    if not settings.custom_llm_secret:
+        logger.error("Rejecting custom LLM request: custom_llm_secret is not set")
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    token = request.headers.get("x-vapi-secret") or ""
+    authorization = request.headers.get("authorization") or ""
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if not hmac.compare_digest(token.encode(), settings.custom_llm_secret.encode()):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+async def resolve_user(user_id: Optional[str], body: dict) -> Optional[User]:
+    if user_id:
+        try:
+            return await get_user_by_id(ObjectId(user_id))
+        except InvalidId:
+            logger.warning("Ignoring invalid user ID in custom LLM URL: %s", user_id)
+    phone = ((body.get("call") or {}).get("customer") or {}).get("number")
+    if phone:
+        return await get_user_by_phone(phone)
+    return None
+
+
+async def chat_messages(body: dict, user_id: Optional[str]) -> list:
+    """
+    The messages to send upstream: the call's cached context followed by
+    the turns in VAPI's request. The context is built on the first turn.
+    """
+    messages = body.get("messages") or []
+    call_id = (body.get("call") or {}).get("id")
+    state = call_states.get(call_id) if call_id else None
+    if state is None:
+        system_prompt = next((m.get("content") for m in messages if m.get("role") == "system"), None)
+        user = await resolve_user(user_id, body)
+        state = CallState(user.id if user else None, await build_call_context(user, system_prompt))
+        if call_id:
+            call_states.put(call_id, state)
+    state.turns += 1
+    return assemble_messages(state.context, messages)
+
+
+async def sse_events(chunks):
+    try:
+        async for chunk in chunks:
+            yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+    except Exception as e:
+        # Headers are already sent; end the stream so VAPI can move on
+        logger.error("Custom LLM stream failed: %s", str(e))
+    yield "data: [DONE]\n\n"
+
+
+async def custom_llm_completion(request: Request, user_id: Optional[str] = None):
+    authorize(request)
+    try:
+        body = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Invalid request body")
+    messages = await chat_messages(body, user_id)
+    params = {key: body[key] for key in PASSTHROUGH_PARAMS if body.get(key) is not None}
+
+    if not body.get("stream", False):
+        response = await gateway.complete(messages, **params)
+        return response.model_dump(exclude_unset=True)
+
+    chunks = gateway.stream(messages, **params)
+    return StreamingResponse(
+        sse_events(chunks),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/custom-llm/chat/completions")
+async def custom_llm_chat_completions(request: Request):
+    """
+    OpenAI-compatible chat completions endpoint VAPI uses as the in-call
+    model. The caller is looked up by the call's customer number.
+    """
+    return await custom_llm_completion(request)
+
+
+@router.post("/custom-llm/{user_id}/chat/completions")
+async def custom_llm_user_chat_completions(user_id: str, request: Request):
+    """
+    Same as /custom-llm/chat/completions for calls where we already know
+    the user (outbound calls and assistant-request), who is identified by
+    the path rather than the phone number.
+    """
+    return await custom_llm_completion(request, user_id)
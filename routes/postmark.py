@@ -1,8 +1,7 @@
 import logging
 from fastapi import APIRouter, HTTPException, Request
 from services.user_service import get_user_by_email
-from services.vapi_service import make_call
-from services.prompts import PRIM_ONBOARDING_CALL
+from services.jobs import enqueue_onboarding_call, NOTIFY_EMAIL
 from config import get_settings
 import json
 
@@ -41,22 +40,11 @@ async def postmark_webhook(request: Request):
         # For YC users, initiate onboarding call
         if user.is_yc:
             logging.info("YC user %s responded to email, initiating call", user.id)
-            try:
-                # Create first message that includes their name
-                first_message = f"Hi {user.name.split()[0] if user.name else 'there'}! 👋 I'm Prim, and I'm excited to learn more about your healthcare needs and get you onboarded. I understand you're from YC - that's fantastic! Let's chat about how I can help you. Let's start with chatting about any existing health conditions you have."
-
-                # Make the call
-                call_id = await make_call(
-                    to_phone=user.call_phone,
-                    system_prompt=PRIM_ONBOARDING_CALL,
-                    first_message=first_message
-                )
-                logging.info("Initiated onboarding call with ID: %s", call_id)
-                return {"status": "ok", "message": "Call initiated"}
-                
-            except Exception as e:
-                logging.error("Failed to initiate call for YC user %s: %s", user.id, str(e))
-                raise HTTPException(status_code=500, detail="Failed to initiate call")
+            job_id = await enqueue_onboarding_call(
+                user.id, notify=NOTIFY_EMAIL,
+                dedupe_key=f"postmark:{data['MessageID']}:onboarding_call" if data.get("MessageID") else None)
+            logging.info("Queued onboarding call job %s for user %s", job_id, user.id)
+            return {"status": "ok", "message": "Call queued"}
         else:
             # TODO: Process non-YC user's response to beta signup
             logging.info("Non-YC user %s responded to beta signup email", user.id)
@@ -1,4 +1,18 @@
 import re
+from typing import Any, Optional
+import msgspec
+from fastapi import Response
+
+_json_encoder = msgspec.json.Encoder()
+
+
+def encode_json(content: Any) -> bytes:
+    return _json_encoder.encode(content)
+
+
+def json_response(content: bytes) -> Response:
+    """Send already-encoded JSON, skipping FastAPI's jsonable_encoder pass."""
+    return Response(content=content, media_type="application/json")
 
 def is_valid_email(email: str) -> bool:
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -11,4 +25,17 @@ def is_valid_phone(phone: str) -> bool:
     if digits.startswith('1'):
         digits = digits[1:]  # Remove the 1 prefix
     # Check if it's a valid length (10 digits for US numbers)
-    return len(digits) == 10
\ No newline at end of file
+    return len(digits) == 10
+
+
+def extract_email(text: str) -> Optional[str]:
+    match = re.search(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', text)
+    return match.group(0) if match else None
+
+
+def extract_phone_number(text: str) -> Optional[str]:
+    # Candidate runs of digits with common separators, e.g. "+1 (650) 555-1234"
+    for match in re.finditer(r'\+?\d[\d\s().-]{8,}\d', text):
+        if is_valid_phone(match.group(0)):
+            return match.group(0)
+    return None
@@ -1,19 +1,23 @@
 from fastapi import APIRouter, HTTPException, Request
-from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
-from services.email_service import send_missed_call_email
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Tuple
 from services.user_service import get_user_by_phone
-from services.message_service import store_message
-from services.prompts import PRIM_HEALTHCARE_ASSISTANT_VOICE
-from services.vapi_service import make_call
+from models.user import User
+from models.vapi import (
+    VapiWebhook, VapiWebhookType, VapiCallMessage, AssistantRequestMessage, EndOfCallReportMessage, message_type
+)
+from services.message_service import store_call_transcript
+from services.vapi_service import assistant_model
+from services.custom_llm_service import call_states
+from services.voice_context_service import get_voice_context, voice_system_prompt, default_greeting, schedule_rebuild
 import logging
-import json
-from openai import AsyncOpenAI
+import time
+import msgspec
+from datetime import datetime, timedelta, timezone
 from config import get_settings
-import asyncio
-import openai
-import httpx
-from services.whatsapp_service import send_whatsapp_message
+from services.idempotency_service import claim_event, release_event, vapi_event_key
+from services.summary_service import append_conversation_summary
+from routes.utils import encode_json, json_response
+from services.jobs import handle_missed_call
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,206 +28,342 @@ settings = get_settings()
 router = APIRouter()
 
 
-class Customer(BaseModel):
-    number: str
-    sipUri: Optional[str] = None
+# VAPI transcript roles we keep, mapped to Message.sender
+TRANSCRIPT_ROLES = {"bot": "assistant", "assistant": "assistant", "user": "user"}
 
 
-class CallObject(BaseModel):
-    id: str
-    type: Optional[str] = None
-    status: Optional[str] = None
-    customer: Customer
-    # Add other call object fields as needed
+def parse_vapi_timestamp(value: Any) -> Optional[datetime]:
+    """
+    Parse a VAPI timestamp (epoch milliseconds or ISO 8601) into a naive UTC datetime.
+    """
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.utcfromtimestamp(value / 1000)
+        if isinstance(value, str) and value:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            if parsed.tzinfo:
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            return parsed
+    except (ValueError, OverflowError, OSError):
+        pass
+    return None
 
 
-class Message(BaseModel):
-    type: str
-    call: CallObject
-    timestamp: Optional[int] = None
-    # Optional fields based on message type
-    status: Optional[str] = None
-    transcript: Optional[str] = None
-    summary: Optional[str] = None
-    endedReason: Optional[str] = None
-    recordingUrl: Optional[str] = None
-    messages: Optional[List[Dict[str, str]]] = None
+def transcript_turns_from_messages(messages: List[VapiCallMessage]) -> List[Dict[str, Any]]:
+    """
+    Convert VAPI's structured call messages into transcript turns, keeping
+    the time each turn was spoken.
+    """
+    turns = []
+    fallback_time = datetime.utcnow()
+    for message in messages:
+        sender = TRANSCRIPT_ROLES.get(message.role)
+        text = (message.message or "").strip()
+        if not sender or not text:
+            continue
+        timestamp = parse_vapi_timestamp(message.time) or fallback_time
+        turns.append({"text": text, "sender": sender, "timestamp": timestamp})
+    return turns
 
 
-class VapiWebhook(BaseModel):
-    message: Message
+def transcript_turns_from_text(transcript: str, started_at: Optional[datetime]) -> List[Dict[str, Any]]:
+    """
+    Fallback for reports without structured messages: split the "AI:" /
+    "User:" transcript text into turns. Turns get increasing timestamps from
+    the call start so their order survives sorting.
+    """
+    turns = []
+    base_time = started_at or datetime.utcnow()
+    for line in transcript.split('\n'):
+        if line.startswith('AI:'):
+            sender, text = "assistant", line[3:].strip()
+        elif line.startswith('User:'):
+            sender, text = "user", line[5:].strip()
+        else:
+            continue
+        if text:
+            timestamp = base_time + timedelta(milliseconds=len(turns))
+            turns.append({"text": text, "sender": sender, "timestamp": timestamp})
+    return turns
 
 
-@router.post("/vapi-webhook")
-async def vapi_webhook(request: Request):
-    # Get raw request body
-    body = await request.body()
-    webhook_data = json.loads(body)
-    
-    # Log the webhook data
-    logger.info("Received VAPI webhook data: %s", webhook_data)
+async def handle_end_of_call_report(message: EndOfCallReportMessage, user: User) -> None:
+    """
+    Follow up on a missed call and store the call transcript.
+    """
+    ended_reason = message.endedReason
+    started_at = message.startedAt
+    ended_at = message.endedAt
 
-    # Get message type first
-    message_type = webhook_data.get("message", {}).get("type")
+    call_id = message.call.id if message.call else None
+    if user.is_yc and (ended_reason and ("error" in ended_reason or "busy" in ended_reason or "customer-did-not-answer" in ended_reason)) or (not started_at and not ended_at):
+        # Call back later or send the missed call email, from a job worker
+        await handle_missed_call(user, call_id)
 
-    # Safely get the calling number
-    try:
-        calling_number = webhook_data.get("message", {}).get(
-            "call", {}).get("customer", {}).get("number")
-        if calling_number:
-            logger.info(
-                "Received %s event for number: %s", message_type, calling_number)
-        else:
-            logger.warning("No calling number in webhook payload")
-            return {
-                "assistant": {
-                    "firstMessage": "Hi there! I'm Prim, your personal healthcare advocate! I'm having trouble determining your phone number. To help you better, I'll need to know who's calling. Could you please try calling again?",
-                    "model": {
-                        "provider": "openai",
-                        "model": "gpt-4.1",
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": "You are Prim, a friendly AI healthcare assistant. You can't determine the caller's number, politely explain the issue and ask them to try calling again."
-                            }
-                        ]
-                    },
-                    "voice": {
-                        "provider": "vapi",
-                        "voiceId": "Lily"
-                    },
-                    "backgroundSound": "off",
-                    **({"server": {"url": settings.vapi_webhook_url}} if settings.vapi_webhook_url else {}),
-                }
-            }
-    except (KeyError, AttributeError) as e:
-        logger.error("Error accessing webhook data: %s", str(e))
+    # Store final transcript, preferring the structured turns with their original timestamps
+    if call_id:
+        call_states.drop(call_id)
+    transcript = message.transcript
+    turns = transcript_turns_from_messages(
+        (message.artifact.messages if message.artifact else None) or message.messages)
+    if not turns and transcript:
+        turns = transcript_turns_from_text(transcript, parse_vapi_timestamp(started_at))
+    if turns:
+        inserted = await store_call_transcript(user.id, call_id, turns)
+        logger.info("Stored %s transcript messages for call %s", inserted, call_id)
 
-    user = await get_user_by_phone(calling_number)
-    if not user:
-        logger.error("No user found for calling number: %s", calling_number)
-        return {
-            "assistant": {
-                "firstMessage": "Hi there! I'm Prim, your personal healthcare advocate! I'm so excited to help you on your healthcare journey! I notice you haven't signed up yet - no worries! Just message me on WhatsApp by going to prim health dot ai, that's p r i m h e a l t h dot a i and I'll help you get everything set up!",
-                "model": {
-                    "provider": "openai",
-                    "model": "gpt-4.1",
-                    "messages": [
+    # # Analyze if the call was about scheduling
+    # try:
+    #     client = AsyncOpenAI(api_key=settings.openai_api_key)
+    #     response = await client.chat.completions.create(
+    #         model="gpt-4.1",
+    #         messages=[
+    #             {"role": "system", "content": "You are an AI that analyzes healthcare conversations. Determine if the conversation was about scheduling an appointment. Respond with 'yes' or 'no' only."},
+    #             {"role": "user", "content": transcript}
+    #         ]
+    #     )
+
+    #     is_scheduling = response.choices[0].message.content.strip(
+    #     ).lower() == 'yes'
+
+    #     if is_scheduling:
+    #         logger.info(
+    #             "Call was about scheduling, initiating doctor call")
+    #         # Make call to doctor with context in background
+    #         await make_call(
+    #             to_phone="+19055195834",
+    #             system_prompt=f"This is a scheduling request from a patient, Isaac Chang. Here is the context from their conversation: {transcript}. Do not mention any real calendar dates. Do not mention how you are going to messaging the patient back on WhatsApp.",
+    #             first_message="Hello, this is Prim. I need to schedule an appointment for a patient. Are you the right person to speak to?",
+    #             model="gpt-4.1"
+    #         )
+    # except (openai.APIError, httpx.HTTPError) as e:
+    #     logger.error(
+    #         "Error analyzing transcript or making doctor call: %s", str(e))
+
+
+# Responses that don't depend on the caller are encoded once
+OK_RESPONSE = encode_json({"status": "ok"})
+
+NO_NUMBER_RESPONSE = encode_json({
+        "assistant": {
+            "firstMessage": "Hi there! I'm Prim, your personal healthcare advocate! I'm having trouble determining your phone number. To help you better, I'll need to know who's calling. Could you please try calling again?",
+            "model": {
+                "provider": "openai",
+                "model": "gpt-4.1",
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": "You are Prim, a friendly AI healthcare assistant. You can't determine the caller's number, politely explain the issue and ask them to try calling again."
+                    }
+                ]
+            },
+            "voice": {
+                "provider": "vapi",
+                "voiceId": "Lily"
+            },
+            "backgroundSound": "off",
+            **({"server": {"url": settings.vapi_webhook_url}} if settings.vapi_webhook_url else {}),
+        }
+    })
+
+UNREGISTERED_USER_RESPONSE = encode_json({
+        "assistant": {
+            "firstMessage": "Hi there! I'm Prim, your personal healthcare advocate! I'm so excited to help you on your healthcare journey! I notice you haven't signed up yet - no worries! Just message me on WhatsApp by going to prim health dot ai, that's p r i m h e a l t h dot a i and I'll help you get everything set up!",
+            "model": {
+                "provider": "openai",
+                "model": "gpt-4.1",
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": "You are Prim, a friendly AI healthcare assistant. If the user hasn't signed up, simply direct them to visit prim health dot ai to sign up. Focus on the signup process and don't help the user with anything else. The signup process is just to go to prim health dot ai and message you on WhatsApp. There is a button on the website that says 'Message me on WhatsApp'."
+                    }
+                ]
+            },
+            "voice": {
+                "provider": "vapi",
+                "voiceId": "Lily",
+                "fallbackPlan": {
+                    "voices": [
                         {
-                            "role": "system",
-                            "content": "You are Prim, a friendly AI healthcare assistant. If the user hasn't signed up, simply direct them to visit prim health dot ai to sign up. Focus on the signup process and don't help the user with anything else. The signup process is just to go to prim health dot ai and message you on WhatsApp. There is a button on the website that says 'Message me on WhatsApp'."
+                            "provider": "openai",
+                            "voiceId": "shimmer"
                         }
                     ]
-                },
-                "voice": {
-                    "provider": "vapi",
-                    "voiceId": "Lily",
-                    "fallbackPlan": {
-                        "voices": [
-                            {
-                                "provider": "openai",
-                                "voiceId": "shimmer"
-                            }
-                        ]
-                    }
-                },
-                "backgroundSound": "off",
-                **({"server": {"url": settings.vapi_webhook_url}} if settings.vapi_webhook_url else {}),
-            }
+                }
+            },
+            "backgroundSound": "off",
+            **({"server": {"url": settings.vapi_webhook_url}} if settings.vapi_webhook_url else {}),
         }
+    })
+
+
+async def on_end_of_call_report(message: EndOfCallReportMessage, user: User) -> bytes:
+    # VAPI re-delivers reports it didn't get a timely 200 for; process each call once
+    call_id = message.call.id if message.call else None
+    event_key = vapi_event_key(call_id, "end-of-call-report") if call_id else None
+    if event_key and not await claim_event(event_key):
+        return OK_RESPONSE
+
+    try:
+        await handle_end_of_call_report(message, user)
+    except Exception:
+        if event_key:
+            await release_event(event_key)
+        raise
+
+    return OK_RESPONSE
+
+
+async def on_assistant_request(message: AssistantRequestMessage, user: User) -> bytes:
+    # Create a new assistant dynamically from the user's precomputed voice context
+    system_prompt = "You are Prim, a friendly AI assistant currently in closed beta testing! Keep your tone warm, bubbly and enthusiastic. Explain that while you're super excited to help, you're not quite ready yet since you're still in testing. Thank them for their interest and let them know you'll reach out once you're fully launched! Keep responses brief but friendly."
+    voice_context = await get_voice_context(user.id)
+    if voice_context:
+        first_message = voice_context.greeting
+        system_prompt = voice_system_prompt(system_prompt, voice_context)
+    else:
+        # Not built yet; answer with the generic greeting and build it for next time
+        first_message = default_greeting(user)
+        system_prompt = append_conversation_summary(system_prompt, user)
+        schedule_rebuild(user.id)
+
+    return encode_json({
+        "assistant": {
+            "firstMessage": first_message,
+            "model": assistant_model(system_prompt, user_id=user.id),
+            "voice": {
+                "provider": "vapi",
+                "voiceId": "Lily"
+            },
+            "backgroundSound": "off",
+            "startSpeakingPlan": {
+                "waitSeconds": 2.0,
+            },
+            **({"server": {"url": settings.vapi_webhook_url}} if settings.vapi_webhook_url else {}),
+        }
+    })
+
 
-    # Handle different message types
-    if message_type == "end-of-call-report":
-        # Get ended reason
-        ended_reason = webhook_data.get("message", {}).get("endedReason")
-        # Get started at and ended at
-        started_at = webhook_data.get("message", {}).get("startedAt")
-        ended_at = webhook_data.get("message", {}).get("endedAt")
-        
-        if user.is_yc and (ended_reason and ("error" in ended_reason or "busy" in ended_reason or "customer-did-not-answer" in ended_reason)) or (not started_at and not ended_at):
-            # Send missed call email to user
-            await send_missed_call_email(user.email, user.name)
-
-        # Store final transcript and summary
-        transcript = webhook_data.get("message", {}).get("transcript")
-        if transcript:
-            # Split transcript into separate messages
-            messages = transcript.split('\n')
-            for message in messages:
-                if message.strip():  # Skip empty lines
-                    if message.startswith('AI:'):
-                        # Store AI message
-                        # Remove 'AI:' prefix
-                        ai_text = message[3:].strip()
-                        await store_message(user.id, ai_text, "voice", "assistant")
-                    elif message.startswith('User:'):
-                        # Store user message
-                        # Remove 'User:' prefix
-                        user_text = message[5:].strip()
-                        await store_message(user.id, user_text, "voice", "user")
-
-            # # Analyze if the call was about scheduling
-            # try:
-            #     client = AsyncOpenAI(api_key=settings.openai_api_key)
-            #     response = await client.chat.completions.create(
-            #         model="gpt-4.1",
-            #         messages=[
-            #             {"role": "system", "content": "You are an AI that analyzes healthcare conversations. Determine if the conversation was about scheduling an appointment. Respond with 'yes' or 'no' only."},
-            #             {"role": "user", "content": transcript}
-            #         ]
-            #     )
-
-            #     is_scheduling = response.choices[0].message.content.strip(
-            #     ).lower() == 'yes'
-
-            #     if is_scheduling:
-            #         logger.info(
-            #             "Call was about scheduling, initiating doctor call")
-            #         # Make call to doctor with context in background
-            #         await make_call(
-            #             to_phone="+19055195834",
-            #             system_prompt=f"This is a scheduling request from a patient, Isaac Chang. Here is the context from their conversation: {transcript}. Do not mention any real calendar dates. Do not mention how you are going to messaging the patient back on WhatsApp.",
-            #             first_message="Hello, this is Prim. I need to schedule an appointment for a patient. Are you the right person to speak to?",
-            #             model="gpt-4.1"
-            #         )
-            # except (openai.APIError, httpx.HTTPError) as e:
-            #     logger.error(
-            #         "Error analyzing transcript or making doctor call: %s", str(e))
-
-        return {"status": "ok"}
-
-    elif message_type == "assistant-request":
-        # Create a new assistant dynamically
-        first_message = "Hey there! It's Prim! How's everything going? Anything I can help you with?"
-        if user and user.name:
-            first_name = user.name.split()[0]  # Get first name if any
-            first_message = f"Hey there {first_name}! It's Prim! How's everything going? Anything I can help you with?"
+class VapiEventHandler:
+    def __init__(self, handler: Callable[..., Awaitable[bytes]], needs_user: bool):
+        self.handler = handler
+        # Handlers that need the caller get their User; the lookup is skipped for the rest
+        self.needs_user = needs_user
 
+
+# message.type -> handler, which gets the matching struct from models/vapi.py.
+# Anything else (status-update, speech-update, conversation-update,
+# transcript, ...) is acknowledged without parsing
+EVENT_HANDLERS: Dict[str, VapiEventHandler] = {
+    "assistant-request": VapiEventHandler(on_assistant_request, needs_user=True),
+    "end-of-call-report": VapiEventHandler(on_end_of_call_report, needs_user=True),
+}
+
+# A handled event's body contains its quoted type. Bodies without any of
+# these can't be for a handler; false positives just get parsed
+EVENT_TYPE_MARKERS = tuple(f'"{event_type}"'.encode() for event_type in EVENT_HANDLERS)
+
+# Buckets for events without a handler, so arbitrary types don't grow the stats
+IGNORED_EVENT = "ignored"
+UNHANDLED_EVENT = "unhandled"
+INVALID_EVENT = "invalid"
+FAILED_EVENT = "failed"
+
+
+class InvalidVapiEvent(Exception):
+    """A handled event type whose payload doesn't match its struct."""
+
+
+class EventTimings:
+    """Count and time spent per VAPI event type."""
+
+    def __init__(self):
+        self._timings: Dict[str, List[float]] = {}
+
+    def record(self, event_type: str, seconds: float) -> None:
+        timing = self._timings.setdefault(event_type, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
         return {
-            "assistant": {
-                "firstMessage": first_message,
-                "model": {
-                    "provider": "openai",
-                    "model": "gpt-4.1",
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": "You are Prim, a friendly AI assistant currently in closed beta testing! Keep your tone warm, bubbly and enthusiastic. Explain that while you're super excited to help, you're not quite ready yet since you're still in testing. Thank them for their interest and let them know you'll reach out once you're fully launched! Keep responses brief but friendly."
-                        }
-                    ]
-                },
-                "voice": {
-                    "provider": "vapi",
-                    "voiceId": "Lily"
-                },
-                "backgroundSound": "off",
-                "startSpeakingPlan": {
-                    "waitSeconds": 2.0,
-                },
-                **({"server": {"url": settings.vapi_webhook_url}} if settings.vapi_webhook_url else {}),
+            event_type: {
+                "count": count,
+                "avg_ms": round(total / count * 1000, 3),
+                "max_ms": round(longest * 1000, 3),
             }
+            for event_type, (count, total, longest) in self._timings.items()
         }
 
-    # Log unhandled message types as warnings but return success
-    logger.warning("Received unhandled message type: %s", message_type)
-    return {"status": "ok"}
+
+event_timings = EventTimings()
+webhook_decoder = msgspec.json.Decoder(VapiWebhook)
+type_decoder = msgspec.json.Decoder(VapiWebhookType)
+
+
+def decoded_type(body: bytes) -> Optional[str]:
+    try:
+        webhook = type_decoder.decode(body)
+    except msgspec.DecodeError:
+        return None
+    return webhook.message.type if webhook.message else None
+
+
+def get_vapi_event_stats() -> Dict[str, Dict[str, float]]:
+    return event_timings.stats()
+
+
+async def dispatch_event(body: bytes) -> Tuple[str, bytes]:
+    """
+    Route a VAPI webhook body to its handler.
+    Returns:
+        The event type it was counted under and the encoded response
+    """
+    if not any(marker in body for marker in EVENT_TYPE_MARKERS):
+        # Never the body: ignored events carry live transcripts and arrive several times a second
+        logger.debug("Ignoring VAPI webhook (%s bytes)", len(body))
+        return IGNORED_EVENT, OK_RESPONSE
+
+    try:
+        message = webhook_decoder.decode(body).message
+    except msgspec.ValidationError as e:
+        event_type = decoded_type(body)
+        if event_type not in EVENT_HANDLERS:
+            # A handled type's name appeared elsewhere in the body
+            return UNHANDLED_EVENT, OK_RESPONSE
+        # Acknowledging it would lose the transcript or leave the call without an assistant
+        logger.error("Invalid %s VAPI webhook: %s", event_type, str(e))
+        raise InvalidVapiEvent(f"Invalid {event_type} payload: {e}")
+
+    event_type = message_type(message)
+    logger.debug("Received %s VAPI webhook (%s bytes)", event_type, len(body))
+    event_handler = EVENT_HANDLERS[event_type]
+    user = None
+    if event_handler.needs_user:
+        customer = message.call.customer if message.call else None
+        calling_number = customer.number if customer else None
+        if not calling_number:
+            logger.warning("No calling number in %s webhook payload", event_type)
+            return event_type, NO_NUMBER_RESPONSE
+        logger.info("Received %s event for number: %s", event_type, calling_number)
+        user = await get_user_by_phone(calling_number)
+        if not user:
+            logger.error("No user found for calling number: %s", calling_number)
+            return event_type, UNREGISTERED_USER_RESPONSE
+
+    return event_type, await event_handler.handler(message, user)
+
+
+@router.post("/vapi-webhook")
+async def vapi_webhook(request: Request):
+    started = time.perf_counter()
+    event_type = FAILED_EVENT
+    try:
+        event_type, response = await dispatch_event(await request.body())
+        return json_response(response)
+    except InvalidVapiEvent as e:
+        event_type = INVALID_EVENT
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        event_timings.record(event_type, time.perf_counter() - started)
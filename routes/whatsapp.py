@@ -1,77 +1,227 @@
 import logging
-from fastapi import APIRouter, Form, HTTPException, Request
-from services.prompts import PRIM_ONBOARDING_CALL
-from services.user_service import get_user_by_phone, create_user, update_user
+from fastapi import APIRouter, HTTPException, Request
+from services.user_service import get_or_create_user, get_user_by_id, update_user_and_get
 from services.whatsapp_service import send_whatsapp_message
-from services.message_service import store_message, get_user_message_history, generate_response, generate_beta_response
+from services.prompts import PRIM_ONBOARDING_RESPONSE, PRIM_ONBOARDING_INSTRUCTIONS
+from services.message_service import store_message, get_user_message_history, generate_response, generate_beta_response, summary_context
 from config import get_settings
 from models.whatsapp import TwilioWhatsAppWebhook
-import re
-from openai import AsyncOpenAI
-import phonenumbers
-from email_validator import validate_email, EmailNotValidError
-from services.vapi_service import make_call
-import httpx
-from routes.utils import is_valid_email, is_valid_phone
+from typing import Optional
+from services.jobs import enqueue_onboarding_call, NOTIFY_WHATSAPP
+from routes.utils import extract_email, extract_phone_number
+from models.user import User
+from models.message import Message
+from services.context_builder import build_chat_messages
+from services.llm_gateway import complete_text
+from services.response_cache import response_cache, shared_history
+from services.retrieval_service import recall_memories
+from services.worker_pool import WorkerPool
+from services.coalescer import MessageCoalescer
+from bson import ObjectId
+from services.idempotency_service import claim_event, release_event, twilio_message_key
 
 router = APIRouter()
 settings = get_settings()
-client = AsyncOpenAI(api_key=settings.openai_api_key)
+
+# Replies are generated off the request path on this pool; started and
+# drained by the app lifespan in main.py
+pipeline = WorkerPool(
+    "whatsapp",
+    concurrency=settings.whatsapp_worker_concurrency,
+    max_queue_size=settings.whatsapp_queue_max_size,
+    enqueue_timeout=settings.whatsapp_enqueue_timeout_seconds,
+)
 
 WELCOME_MESSAGE = "Hi {name}! 👋 I'm Prim, and I'm super excited to meet you! ✨ I'm currently in a closed beta testing phase with a select group of users, so I can't help out just yet - but I'd absolutely love to stay connected with you until I'm ready to make your healthcare journey amazing! 🌟 Would you mind sharing your email address and best phone number so I can reach out once we open up to more users? 💫"
 PRIM_NUMBER = "+16505407827"
 
-ONBOARDING_PROMPT = """You are Prim, a bubbly and enthusiastic healthcare assistant! 🌟 You're currently in closed beta testing with a select group of users, but you're super excited to be connecting with a new potential user and can't wait to collect their email and phone number so you can reach out once you're ready to help them on their healthcare journey!
 
-The user's name is {name}.
-Recent conversation history:
-{message_history}
+async def generate_onboarding_response(user_id: ObjectId, user_name: str, user_message: str, missing_info: list[str], message_history: list[Message], user: Optional[User] = None) -> str:
+    """
+    Generate a natural response for onboarding using OpenAI.
+    """
+    async def generate(shared: bool) -> str:
+        instructions = PRIM_ONBOARDING_INSTRUCTIONS.format(name=user_name, missing_info=" and ".join(missing_info))
+        if shared:
+            # Served to other users too, so nothing from this user's history or summary
+            messages = build_chat_messages(
+                PRIM_ONBOARDING_RESPONSE, shared_history(user_id, user_message), instructions=instructions)
+        else:
+            messages = build_chat_messages(
+                PRIM_ONBOARDING_RESPONSE, message_history, instructions=instructions, **summary_context(user))
+        return await complete_text(
+            messages,
+            max_tokens=100,  # Reduced from 150 to encourage brevity
+            temperature=0.7
+        )
+
+    # Replies only vary with what we still need and what the user just said
+    return await response_cache.get_or_generate(
+        "onboarding", ",".join(missing_info), user_message,
+        user_name if user and user.name else None, generate)
+
+
+async def process_whatsapp_burst(user_id: ObjectId, items: list[tuple[TwilioWhatsAppWebhook, bool]]) -> None:
+    """
+    Reply once to a burst of messages a user sent in quick succession.
+    Each message is already stored individually; for the reply they are
+    treated as a single message whose body is the bodies joined in order.
+    """
+    webhooks = [webhook for webhook, _ in items]
+    created = any(created for _, created in items)
 
-Missing information: {missing_info}
+    # Earlier bursts may have updated the user (e.g. their email)
+    user = await get_user_by_id(user_id)
+    if not user:
+        logging.error("User %s not found while processing WhatsApp messages", user_id)
+        return
 
-Generate a very brief, upbeat response (max 1-2 sentences) that:
-1. Warmly acknowledges their last message with genuine enthusiasm.
-2. Cheerfully asks for the missing information, explaining with excitement:
-   - Email: to stay connected and notify them when beta testing opens up! ✨
-   - Phone: so you can reach out once you're ready to welcome more users! 📱
-3. Makes them feel special and valued while being clear you're in closed beta
-4. Don't do anything healthcare assistant related, just ask for the missing information.
+    webhook = webhooks[-1]
+    if len(webhooks) > 1:
+        logging.info("Coalesced %s messages from %s into one reply", len(webhooks), webhook.From)
+        webhook = webhook.model_copy(update={"Body": "\n".join(w.Body for w in webhooks)})
 
-Keep it super friendly and natural, like chatting with a caring friend, but be transparent about being in testing! 💫"""
+    await process_whatsapp_message(webhook, user, created)
 
 
-async def generate_onboarding_response(user_name: str, user_message: str, missing_info: list[str], message_history: list[dict]) -> str:
+async def process_whatsapp_message(webhook: TwilioWhatsAppWebhook, user: User, created: bool) -> None:
     """
-    Generate a natural response for onboarding using OpenAI.
+    Generate and send the reply to an inbound WhatsApp message.
+    Runs on the WhatsApp worker pool after the webhook has been acknowledged;
+    the inbound message itself is already stored by then.
     """
-    # Format message history for the prompt
-    formatted_history = []
-    for msg in message_history:
-        formatted_history.append(f"{msg.sender}: {msg.text}")
-
-    prompt = ONBOARDING_PROMPT.format(
-        name=user_name,
-        message_history="\n".join(formatted_history),
-        missing_info=" and ".join(missing_info)
-    )
-
-    response = await client.chat.completions.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are Prim, a friendly healthcare assistant. Keep responses very brief and natural."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=100,  # Reduced from 150 to encourage brevity
-        temperature=0.7
-    )
-
-    return response.choices[0].message.content.strip()
+    if created:
+        try:
+            welcome_message = WELCOME_MESSAGE.format(
+                name=webhook.ProfileName.split(
+                )[0] if webhook.ProfileName else "there"
+            )
+            # Store the welcome message first
+            await store_message(
+                user_id=user.id,
+                text=welcome_message,
+                source="whatsapp",
+                sender="assistant"
+            )
+            # Then send it
+            await send_whatsapp_message(webhook.From, welcome_message)
+            logging.info(
+                "Successfully sent welcome message to %s", webhook.From)
+        except Exception as e:
+            logging.error("Failed to send welcome message: %s", str(e))
+        return
+
+    try:
+        # Check if we need to collect email and call phone
+        if not user.email or not user.call_phone:
+            # Try to extract email and phone from the message
+            message_text = webhook.Body.lower()
+            email = extract_email(message_text)
+            call_phone = extract_phone_number(message_text)
+
+            # Update user if we found either email or phone
+            if email or call_phone:
+                update_data = {}
+                data_updated = False
+                if email:
+                    update_data['email'] = email
+                    data_updated = True
+                if call_phone:
+                    update_data['call_phone'] = call_phone
+                    data_updated = True
+                if data_updated:
+                    user = await update_user_and_get(user.id, update_data) or user
+
+            # If still missing either email or phone, ask for them
+            if not user.email or not user.call_phone:
+                missing = []
+                if not user.email:
+                    missing.append("email")
+                if not user.call_phone:
+                    missing.append("phone number")
+
+                # Get user's first name or use "there" if not available
+                user_name = user.name.split()[0] if user.name else "there"
+
+                # Get message history for context
+                message_history = await get_user_message_history(user.id)
+
+                # Generate a natural response based on the user's message and history
+                response_text = await generate_onboarding_response(
+                    user_id=user.id,
+                    user_name=user_name,
+                    user_message=webhook.Body,
+                    missing_info=missing,
+                    message_history=message_history,
+                    user=user
+                )
+
+                await store_message(user_id=user.id, text=response_text, source="whatsapp", sender="assistant")
+                await send_whatsapp_message(webhook.From, response_text)
+                return
+
+        # If we have both email and phone, proceed with normal response generation
+        message_history = await get_user_message_history(user.id)
+
+        # If user message includes the text "from YC"
+        logging.info("Received message: %s", webhook.Body)
+        logging.info("Message in lowercase: %s", webhook.Body.lower())
+        if "from yc" in webhook.Body.lower():
+            try:
+                # Update user to indicate they're from YC
+                user = await update_user_and_get(user.id, {"is_yc": True}) or user
+            except Exception as e:
+                logging.error("Failed to update user to indicate they're from YC: %s", str(e))
+
+            # A job worker places the call; if it can't, the user hears back on WhatsApp
+            job_id = await enqueue_onboarding_call(
+                user.id, notify=NOTIFY_WHATSAPP, include_summary=True,
+                dedupe_key=f"twilio:{webhook.MessageSid}:onboarding_call")
+            logging.info("Queued YC onboarding call job %s", job_id)
+            response_text = "I'll be giving you a call shortly to learn more about your healthcare needs and how I can help! 📞"
+
+            # Send WhatsApp message once
+            await store_message(user_id=user.id, text=response_text, source="whatsapp", sender="assistant")
+            await send_whatsapp_message(webhook.From, response_text)
+            return
+        elif user.onboarded and settings.whatsapp_full_assistant_enabled:
+            # Past the beta: the full assistant, reminded of relevant older messages
+            memories = await recall_memories(user.id, webhook.Body)
+            response_text = await generate_response(message_history, user=user, memories=memories)
+        else:
+            response_text = await generate_beta_response(message_history, user.id, user=user)
+
+        # Store and send the response
+        await store_message(
+            user_id=user.id,
+            text=response_text,
+            source="whatsapp",
+            sender="assistant"
+        )
+        await send_whatsapp_message(webhook.From, response_text)
+        logging.info("Successfully sent response to %s", webhook.From)
+
+    except (ValueError, ConnectionError) as e:
+        logging.error("Failed to process message: %s", str(e))
+
+
+# Messages a user sends in quick succession get a single reply, and a user's
+# bursts are handled one at a time so replies go out in order
+coalescer = MessageCoalescer(
+    pipeline,
+    process_whatsapp_burst,
+    window_seconds=settings.whatsapp_coalesce_window_seconds,
+    max_wait_seconds=settings.whatsapp_coalesce_max_wait_seconds,
+)
 
 
 @router.post("/whatsapp-webhook")
 async def whatsapp_webhook(request: Request):
     """
     Handle incoming WhatsApp messages from Twilio.
+    The message is validated and stored, then the reply is generated on the
+    WhatsApp worker pool so Twilio gets its 200 right away. Messages arriving
+    within the coalescing window are answered together.
     """
     try:
         # Parse form data from Twilio webhook
@@ -94,41 +244,28 @@ async def whatsapp_webhook(request: Request):
             logging.info("Ignoring message from our own number")
             return {"status": "ok"}
 
-        # Log incoming message
-        logging.info("Received WhatsApp message from %s: %s",
-                     webhook.From, webhook.Body)
-
-        # Get or create user if user does not exist
-        user = await get_user_by_phone(webhook.From)
-        if not user:
-            logging.info("No user found, creating user for %s", webhook.From)
-            # Extract name from ProfileName, defaulting to None if not present
-            name = webhook.ProfileName if webhook.ProfileName else None
-            logging.info("Creating user with name: %s", name)
-            user = await create_user(webhook.From, name=name)
-
-            try:
-                welcome_message = WELCOME_MESSAGE.format(
-                    name=webhook.ProfileName.split(
-                    )[0] if webhook.ProfileName else "there"
-                )
-                # Store the welcome message first
-                await store_message(
-                    user_id=user.id,
-                    text=welcome_message,
-                    source="whatsapp",
-                    sender="assistant"
-                )
-                # Then send it
-                await send_whatsapp_message(webhook.From, welcome_message)
-                logging.info(
-                    "Successfully sent welcome message to %s", webhook.From)
-            except Exception as e:
-                logging.error("Failed to send welcome message: %s", str(e))
+        # Push back before writing anything so Twilio's retry starts clean
+        if pipeline.is_saturated():
+            logging.warning("WhatsApp pipeline saturated, rejecting message %s", webhook.MessageSid)
+            raise HTTPException(status_code=503, detail="Busy, please retry")
 
+        # Twilio retries webhooks; only the first delivery of a message is processed
+        event_key = twilio_message_key(webhook.MessageSid)
+        if not await claim_event(event_key):
             return {"status": "ok"}
 
         try:
+            # Log incoming message
+            logging.info("Received WhatsApp message from %s: %s",
+                         webhook.From, webhook.Body)
+
+            # Get or create user if user does not exist
+            # Extract name from ProfileName, defaulting to None if not present
+            name = webhook.ProfileName if webhook.ProfileName else None
+            user, created = await get_or_create_user(webhook.From, name=name)
+            if created:
+                logging.info("Created user for %s with name: %s", webhook.From, name)
+
             # Store the incoming message
             await store_message(
                 user_id=user.id,
@@ -138,107 +275,16 @@ async def whatsapp_webhook(request: Request):
             )
             logging.info("Successfully stored message from %s", webhook.From)
 
-            # Check if we need to collect email and call phone
-            if not user.email or not user.call_phone:
-                # Try to extract email and phone from the message
-                message_text = webhook.Body.lower()
-                email = extract_email(message_text)
-                call_phone = extract_phone_number(message_text)
-
-                # Update user if we found either email or phone
-                if email or call_phone:
-                    update_data = {}
-                    data_updated = False
-                    if email:
-                        update_data['email'] = email
-                        data_updated = True
-                    if call_phone:
-                        update_data['call_phone'] = call_phone
-                        data_updated = True
-                    if data_updated:
-                        await update_user(user.id, update_data)
-                        # Refresh user data
-                        user = await get_user_by_phone(webhook.From)
-
-                # If still missing either email or phone, ask for them
-                if not user.email or not user.call_phone:
-                    missing = []
-                    if not user.email:
-                        missing.append("email")
-                    if not user.call_phone:
-                        missing.append("phone number")
-
-                    # Get user's first name or use "there" if not available
-                    user_name = user.name.split()[0] if user.name else "there"
-
-                    # Get message history for context
-                    message_history = await get_user_message_history(user.id)
-
-                    # Generate a natural response based on the user's message and history
-                    response_text = await generate_onboarding_response(
-                        user_name=user_name,
-                        user_message=webhook.Body,
-                        missing_info=missing,
-                        message_history=message_history
-                    )
-
-                    await store_message(user_id=user.id, text=response_text, source="whatsapp", sender="assistant")
-                    await send_whatsapp_message(webhook.From, response_text)
-                    return {"status": "ok"}
-
-            # If we have both email and phone, proceed with normal response generation
-            message_history = await get_user_message_history(user.id)
-
-            # If user message includes the text "from YC"
-            logging.info("Received message: %s", webhook.Body)
-            logging.info("Message in lowercase: %s", webhook.Body.lower())
-            if "from yc" in webhook.Body.lower():
-                # Create first message that includes their name
-                first_message = f"Hi {user.name.split()[0] if user.name else 'there'}! 👋 I'm Prim, and I'm excited to learn more about your healthcare needs and get you onboarded. I understand you're from YC - that's fantastic! Let's chat about how I can help you. Let's start with chatting about any existing health conditions you have."
-
-                try:
-                    # Update user to indicate they're from YC
-                    await update_user(user.id, {"is_yc": True})
-                except Exception as e:
-                    logging.error("Failed to update user to indicate they're from YC: %s", str(e))
-
-                # Make the call asynchronously without blocking
-                try:
-                    call_id = await make_call(
-                        to_phone=user.call_phone,
-                        system_prompt=PRIM_ONBOARDING_CALL,
-                        first_message=first_message
-                    )
-                    logging.info(
-                        "Initiated YC onboarding call with ID: %s", call_id)
-                    response_text = "I'll be giving you a call shortly to learn more about your healthcare needs and how I can help! 📞"
-                except (httpx.HTTPError, httpx.RequestError) as e:
-                    logging.error(
-                        "Failed to initiate YC onboarding call: %s", str(e))
-                    response_text = "Sorry, I wasn't able to call you just now. Could you please send 'I'm from YC' again and I'll try calling you right away?"
-
-                # Send WhatsApp message once
-                await store_message(user_id=user.id, text=response_text, source="whatsapp", sender="assistant")
-                await send_whatsapp_message(webhook.From, response_text)
-                return {"status": "ok"}
-            else:
-                response_text = await generate_beta_response(message_history)
-
-            # Store and send the response
-            await store_message(
-                user_id=user.id,
-                text=response_text,
-                source="whatsapp",
-                sender="assistant"
-            )
-            await send_whatsapp_message(webhook.From, response_text)
-            logging.info("Successfully sent response to %s", webhook.From)
-
-        except (ValueError, ConnectionError) as e:
-            logging.error("Failed to process message: %s", str(e))
+            coalescer.add(user.id, (webhook, created))
+        except Exception:
+            # Let Twilio's retry take another pass at the message
+            await release_event(event_key)
+            raise
 
         return {"status": "ok"}
 
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error("Error processing webhook: %s", str(e))
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+from services.worker_pool import WorkerPool, QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+class _Burst:
+    def __init__(self):
+        self.items: List[Any] = []
+        self.first_at: Optional[float] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.busy = False
+
+
+class MessageCoalescer:
+    """
+    Per-key debounce and serialization in front of a WorkerPool.
+    Items added for the same key within `window_seconds` of each other are
+    handed to `handler(key, items)` as one batch, at most `max_wait_seconds`
+    after the first of them arrived. Only one batch per key is in flight at
+    a time; items arriving meanwhile form the next batch, so batches for a
+    key are handled in arrival order.
+    """
+
+    def __init__(
+        self,
+        pool: WorkerPool,
+        handler: Callable[[Hashable, List[Any]], Awaitable[None]],
+        window_seconds: float,
+        max_wait_seconds: float,
+    ):
+        self.pool = pool
+        self.handler = handler
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max(max_wait_seconds, window_seconds)
+        self._bursts: Dict[Hashable, _Burst] = {}
+        # Dispatches in flight, referenced so they aren't garbage-collected
+        self._tasks: Set[asyncio.Task] = set()
+        self._closing = False
+        self.batches = 0
+        self.items = 0
+
+    def add(self, key: Hashable, item: Any) -> None:
+        burst = self._bursts.setdefault(key, _Burst())
+        burst.items.append(item)
+        if burst.first_at is None:
+            burst.first_at = time.monotonic()
+        self._schedule(key, burst)
+
+    def _schedule(self, key: Hashable, burst: _Burst) -> None:
+        # A batch for this key is running; its completion schedules the next one
+        if burst.busy or not burst.items:
+            return
+        if burst.timer:
+            burst.timer.cancel()
+
+        if self._closing:
+            delay = 0.0
+        else:
+            deadline = burst.first_at + self.max_wait_seconds
+            delay = max(0.0, min(self.window_seconds, deadline - time.monotonic()))
+        burst.timer = asyncio.get_running_loop().call_later(delay, self._start_dispatch, key)
+
+    def _start_dispatch(self, key: Hashable) -> None:
+        task = asyncio.get_running_loop().create_task(self._dispatch(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._dispatch_done)
+
+    def _dispatch_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Failed to dispatch a batch", exc_info=task.exception())
+
+    async def _dispatch(self, key: Hashable) -> None:
+        burst = self._bursts.get(key)
+        if burst is None or burst.busy or not burst.items:
+            return
+
+        items, burst.items = burst.items, []
+        burst.first_at = None
+        burst.timer = None
+        burst.busy = True
+        try:
+            await self.pool.submit(self._run, key, items)
+        except QueueFullError as e:
+            burst.busy = False
+            if self._closing:
+                logger.error("Dropping %s queued items for %s during shutdown: %s", len(items), key, str(e))
+                self._cleanup(key, burst)
+                return
+            # Put the batch back in front and try again after another window
+            logger.warning("Worker pool full, delaying %s items for %s", len(items), key)
+            burst.items = items + burst.items
+            burst.first_at = time.monotonic()
+            self._schedule(key, burst)
+
+    async def _run(self, key: Hashable, items: List[Any]) -> None:
+        self.batches += 1
+        self.items += len(items)
+        burst = self._bursts[key]
+        try:
+            await self.handler(key, items)
+        finally:
+            burst.busy = False
+            if burst.items:
+                self._schedule(key, burst)
+            else:
+                self._cleanup(key, burst)
+
+    def _cleanup(self, key: Hashable, burst: _Burst) -> None:
+        if not burst.items and not burst.busy and self._bursts.get(key) is burst:
+            del self._bursts[key]
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Dispatch every pending batch immediately and wait up to `timeout`
+        seconds for all of them to be handed to the pool.
+        """
+        self._closing = True
+        for key, burst in list(self._bursts.items()):
+            self._schedule(key, burst)
+
+        deadline = time.monotonic() + timeout
+        while (any(burst.items for burst in self._bursts.values()) or self._tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def stats(self) -> dict:
+        return {
+            "pending_keys": len(self._bursts),
+            "pending_items": sum(len(burst.items) for burst in self._bursts.values()),
+            "batches": self.batches,
+            "items": self.items,
+            "items_per_batch": self.items / self.batches if self.batches else 0.0,
+        }
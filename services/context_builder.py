@@ -0,0 +1,126 @@
+"""
+Builds the chat messages sent to the LLM from a user's message history.
+"""
+from functools import lru_cache
+from typing import List, Optional
+import logging
+from models.message import Message
+from config import get_settings
+
+try:
+    import tiktoken
+except ImportError:  # Token counts fall back to an estimate
+    tiktoken = None
+
+settings = get_settings()
+
+# Tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+SENDER_ROLES = {"user": "user", "assistant": "assistant"}
+SUMMARY_PREFIX = "Summary of your earlier conversation with this user:\n"
+MEMORIES_PREFIX = "Earlier messages that may be relevant:\n"
+
+
+def format_memories(memories: List[dict]) -> str:
+    lines = []
+    for memory in memories:
+        when = (memory.get("timestamp") or "")[:10]
+        lines.append(f"- [{when} {memory.get('sender')} via {memory.get('source')}] {memory.get('text')}")
+    return MEMORIES_PREFIX + "\n".join(lines)
+
+
+@lru_cache(maxsize=None)
+def _get_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(settings.llm_token_encoding)
+    except Exception as e:
+        # tiktoken downloads encodings on first use; don't fail requests offline
+        logging.warning("Token encoding %s unavailable, estimating token counts: %s",
+                        settings.llm_token_encoding, str(e))
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens in `text` locally, or estimate them (~4 characters per
+    token) when no tokenizer is available.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[dict]) -> int:
+    return sum(count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def build_chat_messages(
+    system_prompt: str,
+    message_history: List[Message],
+    instructions: Optional[str] = None,
+    token_budget: Optional[int] = None,
+    summary: Optional[str] = None,
+    memories: Optional[List[dict]] = None,
+) -> List[dict]:
+    """
+    Build role-tagged chat messages for a completion.
+
+    The static system prompt always comes first so consecutive requests share
+    a prefix the provider can cache. History follows as user/assistant turns,
+    keeping the most recent ones that fit in the token budget (the latest
+    turn is always kept). Per-request `instructions` go last as a system
+    message so they don't break the cached prefix.
+
+    When the user has a rolling summary, it follows the system prompt and
+    messages it already covers are dropped, except for the last
+    `summary_min_recent_messages` which keep the reply grounded in the
+    immediate conversation. Retrieved `memories` go after the history,
+    skipping any that are already part of it.
+
+    Args:
+        system_prompt: Static system prompt
+        message_history: Messages ordered by timestamp (oldest first)
+        instructions: Request-specific instructions appended after the history (optional)
+        token_budget: Maximum prompt tokens (default: settings.llm_context_token_budget)
+        summary: Rolling summary of the conversation (optional)
+        memories: Relevant past messages from retrieval_service (optional)
+    Returns:
+        List of chat messages
+    """
+    if token_budget is None:
+        token_budget = settings.llm_context_token_budget
+
+    head = [{"role": "system", "content": system_prompt}]
+    if summary:
+        head.append({"role": "system", "content": SUMMARY_PREFIX + summary})
+    tail = [{"role": "system", "content": instructions}] if instructions else []
+    remaining = token_budget - count_message_tokens(head) - count_message_tokens(tail)
+
+    turns = []
+    for message in sorted(message_history, key=lambda x: x.timestamp, reverse=True):
+        role = SENDER_ROLES.get(message.sender)
+        if not role or not message.text:
+            continue
+        if summary and message.summarized and len(turns) >= settings.summary_min_recent_messages:
+            # Covered by the summary; older unsummarized turns (e.g. a late call transcript) are still kept
+            continue
+        turn = {"role": role, "content": message.text}
+        cost = count_message_tokens([turn])
+        if turns and cost > remaining:
+            break
+        turns.append(turn)
+        remaining -= cost
+    turns.reverse()
+
+    if memories:
+        included = {turn["content"] for turn in turns}
+        memories = [memory for memory in memories if memory.get("text") and memory["text"] not in included]
+        if memories:
+            memory_message = {"role": "system", "content": format_memories(memories)}
+            if count_message_tokens([memory_message]) <= remaining:
+                tail.insert(0, memory_message)
+
+    return head + turns + tail
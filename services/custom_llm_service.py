@@ -0,0 +1,132 @@
+"""
+Context and per-call state for the custom LLM endpoint VAPI calls on
+every voice turn (routes/custom_llm.py).
+
+A call's context (the system prompt, the user's rolling summary and their
+recent messages) is built on the call's first turn and kept in memory,
+so later turns only add VAPI's latest transcript before streaming.
+"""
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from bson import ObjectId
+from config import get_settings
+from models.user import User
+from services.context_builder import SUMMARY_PREFIX, count_message_tokens, count_tokens
+from services.message_service import get_user_message_history
+from services.prompts import PRIM_HEALTHCARE_ASSISTANT_VOICE
+
+settings = get_settings()
+
+RECENT_MESSAGES_PREFIX = "Your most recent messages with this user (WhatsApp and earlier calls):\n"
+TURN_ROLES = {"user", "assistant"}
+
+
+class CallState:
+    def __init__(self, user_id: Optional[ObjectId], context: List[dict]):
+        self.user_id = user_id
+        self.context = context
+        self.turns = 0
+        self.expires_at = 0.0
+
+
+class CallStateStore:
+    """Bounded TTL + LRU map of call ID to CallState."""
+
+    def __init__(self, max_calls: int, ttl_seconds: float):
+        self.max_calls = max_calls
+        self.ttl_seconds = ttl_seconds
+        self._calls: "OrderedDict[str, CallState]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, call_id: str) -> Optional[CallState]:
+        state = self._calls.get(call_id)
+        if state is None or state.expires_at < time.monotonic():
+            self._calls.pop(call_id, None)
+            self.misses += 1
+            return None
+        state.expires_at = time.monotonic() + self.ttl_seconds
+        self._calls.move_to_end(call_id)
+        self.hits += 1
+        return state
+
+    def put(self, call_id: str, state: CallState) -> None:
+        state.expires_at = time.monotonic() + self.ttl_seconds
+        self._calls[call_id] = state
+        self._calls.move_to_end(call_id)
+        while len(self._calls) > self.max_calls:
+            self._calls.popitem(last=False)
+
+    def drop(self, call_id: str) -> None:
+        self._calls.pop(call_id, None)
+
+    def stats(self) -> dict:
+        return {"active_calls": len(self._calls), "hits": self.hits, "misses": self.misses}
+
+
+call_states = CallStateStore(settings.custom_llm_max_calls, settings.custom_llm_call_ttl_seconds)
+
+
+async def build_call_context(user: Optional[User], system_prompt: Optional[str]) -> List[dict]:
+    """
+    Build the system messages for a call: the assistant's prompt, the user's
+    rolling summary and as many of their recent messages as fit in half of
+    settings.llm_context_token_budget (the other half is left for the call).
+    Args:
+        user: The caller, if known
+        system_prompt: The system prompt from the assistant config (default: PRIM_HEALTHCARE_ASSISTANT_VOICE)
+    Returns:
+        System messages to put ahead of the call's turns
+    """
+    system_prompt = system_prompt or PRIM_HEALTHCARE_ASSISTANT_VOICE
+    context = [{"role": "system", "content": system_prompt}]
+    if not user:
+        return context
+
+    # Outbound calls may already carry the summary in their prompt
+    if user.conversation_summary and user.conversation_summary not in system_prompt:
+        context.append({"role": "system", "content": SUMMARY_PREFIX + user.conversation_summary})
+
+    history = await get_user_message_history(user.id, limit=settings.custom_llm_history_messages)
+    budget = settings.llm_context_token_budget // 2 - count_message_tokens(context) - count_tokens(RECENT_MESSAGES_PREFIX)
+    lines: List[str] = []
+    for message in reversed(history[-settings.custom_llm_history_messages:]):
+        if not message.text:
+            continue
+        line = f"- {message.sender} ({message.source}): {message.text}"
+        budget -= count_tokens(line) + 1
+        if budget < 0:
+            break
+        lines.insert(0, line)
+    if lines:
+        context.append({"role": "system", "content": RECENT_MESSAGES_PREFIX + "\n".join(lines)})
+    return context
+
+
+def call_turns(messages: List[dict], token_budget: int) -> List[dict]:
+    """
+    The conversation turns from VAPI's request, most recent kept first
+    within `token_budget` (the latest turn is always kept).
+    """
+    turns = []
+    for message in reversed(messages):
+        if message.get("role") not in TURN_ROLES or not message.get("content"):
+            continue
+        turn = {"role": message["role"], "content": message["content"]}
+        cost = count_message_tokens([turn])
+        if turns and cost > token_budget:
+            break
+        turns.append(turn)
+        token_budget -= cost
+    turns.reverse()
+    return turns
+
+
+def assemble_messages(context: List[dict], messages: List[dict]) -> List[dict]:
+    budget = settings.llm_context_token_budget - count_message_tokens(context)
+    return context + call_turns(messages, budget)
+
+
+def get_custom_llm_stats() -> dict:
+    return call_states.stats()
@@ -1,12 +1,159 @@
-from postmarker.core import PostmarkClient
+import asyncio
 from config import get_settings
 import logging
 from fastapi import HTTPException
-from typing import Optional
+from typing import List, Optional, Set
+from services.http_clients import get_postmark_client
 
 settings = get_settings()
 
-postmark = PostmarkClient(server_token=settings.postmark_api_key)
+# Postmark accepts at most this many messages per /email/batch request
+POSTMARK_MAX_BATCH_SIZE = 500
+
+
+class EmailSendError(Exception):
+    """Raised when Postmark rejects a message."""
+
+    def __init__(self, message: str, error_code: int = 0):
+        super().__init__(message)
+        self.error_code = error_code
+
+
+class EmailOutbox:
+    """
+    Collects emails sent within a short window and delivers them with a
+    single request to Postmark's batch endpoint. Each send() waits for its
+    own message's result, so callers see the same success or failure they
+    would from an individual send.
+    """
+
+    def __init__(self, window_seconds: float, max_batch_size: int):
+        self.window_seconds = window_seconds
+        self.max_batch_size = max(1, min(max_batch_size, POSTMARK_MAX_BATCH_SIZE))
+        self._pending: List[tuple] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+        self.sent = 0
+        self.failed = 0
+        self.requests = 0
+
+    async def send(self, message: dict) -> dict:
+        """
+        Queue a Postmark message (From, To, Subject, TextBody, ...) and wait
+        until it has been delivered.
+        Returns:
+            Postmark's response for the message
+        Raises:
+            EmailSendError: If Postmark rejected the message
+        """
+        if self.window_seconds <= 0:
+            return (await self._deliver([message]))[0]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = loop.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window_seconds)
+        self._timer = None
+        self._flush_now()
+
+    def _flush_now(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            task = asyncio.get_running_loop().create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[tuple]) -> None:
+        try:
+            results = await self._deliver([message for message, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _deliver(self, messages: List[dict]) -> list:
+        """Send messages to Postmark, returning a result or EmailSendError per message."""
+        client = get_postmark_client()
+        self.requests += 1
+        if len(messages) == 1:
+            response = await client.post("/email", json=messages[0])
+            if response.status_code >= 500:
+                response.raise_for_status()
+            results = [response.json()]
+        else:
+            response = await client.post("/email/batch", json=messages)
+            if response.status_code >= 500:
+                response.raise_for_status()
+            if response.status_code == 200:
+                results = response.json()
+            else:
+                results = [response.json()] * len(messages)
+
+        outcomes = []
+        for result in results:
+            if result.get("ErrorCode", 0) != 0:
+                self.failed += 1
+                outcomes.append(EmailSendError(result.get("Message", "Postmark error"), result["ErrorCode"]))
+            else:
+                self.sent += 1
+                outcomes.append(result)
+        if len(messages) == 1 and isinstance(outcomes[0], Exception):
+            raise outcomes[0]
+        return outcomes
+
+    async def close(self) -> None:
+        """Deliver anything still queued and wait for in-flight batches."""
+        self._flush_now()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "sent": self.sent,
+            "failed": self.failed,
+            "requests": self.requests,
+        }
+
+
+outbox = EmailOutbox(settings.email_batch_window_seconds, settings.email_batch_max_size)
+
+
+async def send_email(to_email: str, subject: str, text_body: str) -> dict:
+    """
+    Send a plain-text email from settings.email_from through the outbox.
+    Returns:
+        Postmark's response for the message
+    """
+    return await outbox.send({
+        "From": settings.email_from,
+        "To": to_email,
+        "Subject": subject,
+        "TextBody": text_body,
+    })
+
+
+def get_email_stats() -> dict:
+    return outbox.stats()
+
 
 MISSED_CALL_EMAIL_TEMPLATE = """Hi {name},
 
@@ -51,24 +198,22 @@ async def send_missed_call_email(
         bool: True if email was sent successfully, False otherwise
         
     Raises:
-        HTTPException: If there's an error sending the email
+        EmailSendError: If Postmark rejected the email
+        HTTPException: If there's any other error sending the email
     """
     try:
         # Format the email body with the recipient's name or a generic greeting
         greeting_name = name.split()[0] if name else "there"
         body = MISSED_CALL_EMAIL_TEMPLATE.format(name=greeting_name)
 
-        # Send email using Postmark
-        postmark.emails.send(
-            From=settings.email_from,
-            To=to_email,
-            Subject=subject,
-            TextBody=body
-        )
+        await send_email(to_email, subject, body)
             
         logging.info(f"Successfully sent missed call email to {to_email}")
         return True
 
+    except EmailSendError as e:
+        logging.error(f"Postmark rejected missed call email to {to_email}: {str(e)}")
+        raise
     except Exception as e:
         logging.error(f"Failed to send missed call email to {to_email}: {str(e)}")
         raise HTTPException(
@@ -93,24 +238,22 @@ async def send_beta_signup_email(
         bool: True if email was sent successfully, False otherwise
         
     Raises:
-        HTTPException: If there's an error sending the email
+        EmailSendError: If Postmark rejected the email
+        HTTPException: If there's any other error sending the email
     """
     try:
         # Format the email body with the recipient's name or a generic greeting
         greeting_name = name.split()[0] if name else "there"
         body = BETA_SIGNUP_EMAIL_TEMPLATE.format(name=greeting_name)
 
-        # Send email using Postmark
-        postmark.emails.send(
-            From=settings.email_from,
-            To=to_email,
-            Subject=subject,
-            TextBody=body
-        )
+        await send_email(to_email, subject, body)
             
         logging.info(f"Successfully sent beta signup email to {to_email}")
         return True
 
+    except EmailSendError as e:
+        logging.error(f"Postmark rejected beta signup email to {to_email}: {str(e)}")
+        raise
     except Exception as e:
         logging.error(f"Failed to send beta signup email to {to_email}: {str(e)}")
         raise HTTPException(
@@ -0,0 +1,350 @@
+"""
+Computes Message.embedding in the background and mirrors vectors to Qdrant.
+
+New messages are picked up through the message_service listener and
+embedded in batches; `python -m services.embedding_service --backfill`
+walks historical messages, checkpointing its progress so it can resume.
+"""
+import asyncio
+import argparse
+import hashlib
+import logging
+import random
+import time
+import uuid
+from datetime import datetime
+from typing import List, Optional, Set
+import numpy as np
+import openai
+from bson import ObjectId
+from pymongo import UpdateOne
+from db import messages_collection, worker_state_collection
+from config import get_settings
+from models.message import Message
+from services.message_service import add_message_listener, remove_message_listener
+from services.llm_gateway import client
+
+try:
+    from qdrant_client import AsyncQdrantClient, models as qdrant_models
+except ImportError:  # Qdrant mirroring is skipped without the client library
+    AsyncQdrantClient = None
+    qdrant_models = None
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+BACKFILL_STATE_ID = "embedding_backfill"
+EMBEDDING_PROJECTION = {"_id": 1, "user_id": 1, "text": 1, "source": 1, "sender": 1, "timestamp": 1}
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+
+class OpenAIEmbedder:
+    def __init__(self, model: str, dimensions: int):
+        self.model = model
+        self.dimensions = dimensions
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        response = await client.embeddings.create(
+            model=self.model,
+            input=texts,
+            dimensions=self.dimensions
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class FakeEmbedder:
+    """
+    Deterministic offline embedder for tests and local development: hashes
+    words into a fixed-size bag-of-words vector, so texts sharing words are
+    similar under cosine distance.
+    """
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                bucket = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+                vectors[row, bucket % self.dimensions] += 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1.0, norms)
+        return vectors.tolist()
+
+
+def get_embedder():
+    if settings.embedding_provider == "fake":
+        return FakeEmbedder(settings.embedding_dimensions)
+    return OpenAIEmbedder(settings.embedding_model, settings.embedding_dimensions)
+
+
+def qdrant_point_id(message_id: ObjectId) -> str:
+    """Qdrant only accepts integer or UUID ids; pad the 12-byte ObjectId into a UUID."""
+    return str(uuid.UUID(bytes=message_id.binary + b"\0" * 4))
+
+
+class QdrantStore:
+    def __init__(self):
+        self.client = AsyncQdrantClient(
+            host=settings.qdrant_host,
+            port=settings.qdrant_port,
+            api_key=settings.qdrant_api_key or None
+        )
+        self.collection = settings.qdrant_collection
+        self._ready = False
+
+    async def ensure_collection(self) -> None:
+        if self._ready:
+            return
+        if not await self.client.collection_exists(self.collection):
+            await self.client.create_collection(
+                collection_name=self.collection,
+                vectors_config=qdrant_models.VectorParams(
+                    size=settings.embedding_dimensions,
+                    distance=qdrant_models.Distance.COSINE
+                )
+            )
+            await self.client.create_payload_index(
+                collection_name=self.collection,
+                field_name="user_id",
+                field_schema=qdrant_models.PayloadSchemaType.KEYWORD
+            )
+        self._ready = True
+
+    async def upsert(self, docs: List[dict], vectors: List[List[float]]) -> None:
+        await self.ensure_collection()
+        await self.client.upsert(
+            collection_name=self.collection,
+            points=[
+                qdrant_models.PointStruct(
+                    id=qdrant_point_id(doc["_id"]),
+                    vector=vector,
+                    payload={
+                        "message_id": str(doc["_id"]),
+                        "user_id": str(doc["user_id"]),
+                        "source": doc.get("source"),
+                        "sender": doc.get("sender"),
+                        "timestamp": doc["timestamp"].isoformat() if doc.get("timestamp") else None,
+                    }
+                )
+                for doc, vector in zip(docs, vectors)
+            ]
+        )
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+def get_qdrant_store() -> Optional[QdrantStore]:
+    if not settings.qdrant_host:
+        return None
+    if AsyncQdrantClient is None:
+        logger.warning("QDRANT_HOST is set but qdrant-client is not installed; skipping Qdrant")
+        return None
+    return QdrantStore()
+
+
+class RequestRateLimiter:
+    """Spaces requests evenly to stay under a requests-per-minute limit."""
+
+    def __init__(self, requests_per_minute: int):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            delay = self._next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_at = max(self._next_at, time.monotonic()) + self.interval
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class EmbeddingWorker:
+    """
+    Embeds messages in batches and writes the vectors back to Mongo (with a
+    single bulk_write per batch) and to Qdrant when configured.
+    """
+
+    def __init__(self, embedder=None, qdrant: Optional[QdrantStore] = None):
+        self.embedder = embedder or get_embedder()
+        self.qdrant = qdrant
+        self.batch_size = settings.embedding_batch_size
+        self.rate_limiter = RequestRateLimiter(settings.embedding_requests_per_minute)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=settings.embedding_queue_max_size)
+        self._task: Optional[asyncio.Task] = None
+        self._vector_listeners = []
+        self.embedded = 0
+        self.failed_batches = 0
+        self.dropped = 0
+
+    def add_vector_listener(self, listener) -> None:
+        """Register `listener(docs, vectors)`, called after each batch is stored."""
+        self._vector_listeners.append(listener)
+
+    def on_messages_stored(self, user_id: ObjectId, messages: List[Message]) -> None:
+        for message in messages:
+            if not message.text:
+                continue
+            try:
+                self._queue.put_nowait(message.id)
+            except asyncio.QueueFull:
+                # The backfill picks these up later
+                self.dropped += 1
+
+    async def embed_with_retry(self, texts: List[str]) -> List[List[float]]:
+        for attempt in range(settings.embedding_max_retries + 1):
+            await self.rate_limiter.wait()
+            try:
+                return await self.embedder.embed(texts)
+            except RETRYABLE_ERRORS as e:
+                if attempt == settings.embedding_max_retries:
+                    raise
+                delay = retry_after_seconds(e) or min(60.0, 2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning("Embedding request failed (%s), retrying in %.1fs", type(e).__name__, delay)
+                await asyncio.sleep(delay)
+
+    async def embed_documents(self, docs: List[dict]) -> int:
+        """
+        Embed message documents and store the vectors.
+        Returns:
+            Number of messages embedded
+        """
+        docs = [doc for doc in docs if doc.get("text")]
+        if not docs:
+            return 0
+
+        vectors = await self.embed_with_retry([doc["text"] for doc in docs])
+        await messages_collection.bulk_write(
+            [UpdateOne({"_id": doc["_id"]}, {"$set": {"embedding": vector}}) for doc, vector in zip(docs, vectors)],
+            ordered=False
+        )
+        if self.qdrant:
+            try:
+                await self.qdrant.upsert(docs, vectors)
+            except Exception as e:
+                # Mongo holds the vectors; a later backfill can re-sync Qdrant
+                logger.error("Failed to upsert %s vectors into Qdrant: %s", len(docs), str(e))
+        for listener in self._vector_listeners:
+            try:
+                listener(docs, vectors)
+            except Exception:
+                logger.exception("Vector listener %s failed", listener)
+
+        self.embedded += len(docs)
+        return len(docs)
+
+    async def _next_batch(self) -> List[ObjectId]:
+        ids = [await self._queue.get()]
+        deadline = time.monotonic() + settings.embedding_flush_interval_seconds
+        while len(ids) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                ids.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return ids
+
+    async def run(self) -> None:
+        while True:
+            ids = await self._next_batch()
+            try:
+                cursor = messages_collection.find({"_id": {"$in": ids}, "embedding": None}, EMBEDDING_PROJECTION)
+                await self.embed_documents([doc async for doc in cursor])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed_batches += 1
+                logger.exception("Failed to embed batch of %s messages", len(ids))
+
+    async def backfill(self, limit: Optional[int] = None) -> int:
+        """
+        Embed historical messages without an embedding, in _id order.
+        Progress is checkpointed in the worker_state collection, so an
+        interrupted backfill resumes where it stopped.
+        Args:
+            limit: Stop after this many messages (optional)
+        Returns:
+            Number of messages embedded
+        """
+        state = await worker_state_collection.find_one({"_id": BACKFILL_STATE_ID}) or {}
+        last_id = state.get("last_id")
+        total = 0
+
+        while limit is None or total < limit:
+            query = {"embedding": None}
+            if last_id:
+                query["_id"] = {"$gt": last_id}
+            batch_size = self.batch_size if limit is None else min(self.batch_size, limit - total)
+            docs = [doc async for doc in messages_collection.find(query, EMBEDDING_PROJECTION).sort("_id", 1).limit(batch_size)]
+            if not docs:
+                break
+
+            total += await self.embed_documents(docs)
+            last_id = docs[-1]["_id"]
+            await worker_state_collection.update_one(
+                {"_id": BACKFILL_STATE_ID},
+                {"$set": {"last_id": last_id, "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+            logger.info("Backfilled embeddings for %s messages (through %s)", total, last_id)
+
+        return total
+
+    def start(self) -> None:
+        add_message_listener(self.on_messages_stored)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        remove_message_listener(self.on_messages_stored)
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.qdrant:
+            await self.qdrant.close()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "embedded": self.embedded,
+            "failed_batches": self.failed_batches,
+            "dropped": self.dropped,
+        }
+
+
+embedding_worker = EmbeddingWorker(qdrant=get_qdrant_store())
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description="Embed stored messages")
+    parser.add_argument("--backfill", action="store_true", help="embed historical messages without embeddings")
+    parser.add_argument("--limit", type=int, default=None, help="maximum number of messages to embed")
+    parser.add_argument("--reset", action="store_true", help="restart the backfill from the first message")
+    args = parser.parse_args()
+
+    if args.reset:
+        await worker_state_collection.delete_one({"_id": BACKFILL_STATE_ID})
+    if args.backfill:
+        total = await embedding_worker.backfill(limit=args.limit)
+        logger.info("Backfill finished, embedded %s messages", total)
+    if embedding_worker.qdrant:
+        await embedding_worker.qdrant.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
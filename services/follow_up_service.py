@@ -0,0 +1,120 @@
+"""
+WhatsApp check-ins on open tasks.
+
+Every user message moves the user's check-in timer to
+follow_up_nudge_delay_seconds later, so it only fires once the
+conversation has gone quiet. When it does, Prim asks about the open tasks
+in the user's voice context snapshot; users without open tasks aren't
+messaged. The check-in is free-form text, which WhatsApp only delivers
+within 24 hours of the user's last message, so the delay has to stay
+below that and late check-ins are dropped.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, Set
+from bson import ObjectId
+from config import get_settings
+from models.job import Job
+from models.message import Message
+from models.user import User
+from services.idempotency_service import RecentKeys
+from services.job_queue import register, enqueue
+from services.jobs import WHATSAPP_MESSAGE, whatsapp_address
+from services.message_service import add_message_listener, remove_message_listener, get_user_message_history
+from services.timer_service import schedule_timer
+from services.user_service import get_user_by_id
+from services.voice_context_service import get_voice_context
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+FOLLOW_UP_NUDGE = "follow_up_nudge"
+# WhatsApp's customer service window: free-form messages are only delivered this soon after the user wrote
+SESSION_WINDOW = timedelta(hours=24)
+
+# Users whose timer was moved recently; saves a timers write per message
+_refreshed = RecentKeys(settings.user_cache_max_size, settings.follow_up_refresh_seconds)
+_tasks: Set[asyncio.Task] = set()
+nudges_sent = 0
+nudges_skipped = 0
+
+
+def follow_up_key(user_id: ObjectId) -> str:
+    return f"follow_up:{user_id}"
+
+
+def nudge_text(user: User, open_tasks: List[str]) -> str:
+    name = user.name.split()[0] if user.name else "there"
+    if len(open_tasks) == 1:
+        return f"Hey {name}! Just checking in on something we talked about: {open_tasks[0].rstrip('.')}. How's it going? Anything I can help with?"
+    tasks = "\n".join(f"- {task}" for task in open_tasks)
+    return f"Hey {name}! Just checking in on a few things we talked about:\n{tasks}\nHow's it going? Anything I can help with?"
+
+
+async def reschedule_follow_up(user_id: ObjectId, delay: float) -> None:
+    await schedule_timer(
+        FOLLOW_UP_NUDGE, {"user_id": user_id}, delay=delay, dedupe_key=follow_up_key(user_id), replace=True)
+
+
+async def _refresh(user_id: ObjectId) -> None:
+    try:
+        await reschedule_follow_up(user_id, settings.follow_up_nudge_delay_seconds)
+    except Exception as e:
+        _refreshed.discard(follow_up_key(user_id))
+        logger.error("Failed to schedule follow-up for user %s: %s", user_id, str(e))
+
+
+def on_messages_stored(user_id: ObjectId, messages: List[Message]) -> None:
+    """Message listener: push the user's check-in back when they write."""
+    key = follow_up_key(user_id)
+    if key in _refreshed or not any(message.sender == "user" for message in messages):
+        return
+    _refreshed.add(key)
+    task = asyncio.get_running_loop().create_task(_refresh(user_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+@register(FOLLOW_UP_NUDGE)
+async def run_follow_up_nudge(job: Job) -> None:
+    global nudges_sent, nudges_skipped
+    user = await get_user_by_id(ObjectId(job.payload["user_id"]))
+    if not user:
+        return
+
+    # Refreshes are throttled, so the user may have written after the timer was set
+    history = await get_user_message_history(user.id, limit=20)
+    last_message_at = max((message.timestamp for message in history if message.sender == "user"), default=None)
+    quiet_until = last_message_at + timedelta(seconds=settings.follow_up_nudge_delay_seconds) if last_message_at else None
+    if quiet_until and quiet_until > datetime.utcnow():
+        await reschedule_follow_up(user.id, (quiet_until - datetime.utcnow()).total_seconds())
+        return
+    if not last_message_at or last_message_at + SESSION_WINDOW <= datetime.utcnow():
+        # Twilio would reject it outside the window
+        nudges_skipped += 1
+        return
+
+    context = await get_voice_context(user.id)
+    if not context or not context.open_tasks:
+        nudges_skipped += 1
+        return
+    # Stored in the user's history by the job once it has been sent
+    await enqueue(
+        WHATSAPP_MESSAGE,
+        {"to": whatsapp_address(user.phone), "body": nudge_text(user, context.open_tasks), "user_id": user.id},
+        dedupe_key=f"{job.id}:message")
+    nudges_sent += 1
+
+
+def get_follow_up_stats() -> dict:
+    return {"nudges_sent": nudges_sent, "nudges_skipped": nudges_skipped, "pending_refreshes": len(_tasks)}
+
+
+def start() -> None:
+    add_message_listener(on_messages_stored)
+
+
+async def stop() -> None:
+    remove_message_listener(on_messages_stored)
+    await asyncio.gather(*_tasks, return_exceptions=True)
@@ -0,0 +1,107 @@
+"""
+Long-lived HTTP clients for outbound APIs.
+
+Each client keeps a pool of warm keep-alive (and, where the server supports
+it, HTTP/2) connections, so a request doesn't pay DNS, TCP and TLS setup.
+The app lifespan opens them at startup and closes them at shutdown; code
+running outside the app (scripts, workers) gets them created on first use.
+"""
+import logging
+from typing import Dict
+import httpx
+from config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.http_max_connections,
+        max_keepalive_connections=settings.http_max_keepalive_connections,
+        keepalive_expiry=settings.http_keepalive_expiry_seconds,
+    )
+
+
+def _timeout(read_seconds: float) -> httpx.Timeout:
+    return httpx.Timeout(
+        read_seconds,
+        connect=settings.http_connect_timeout_seconds,
+        pool=settings.http_pool_timeout_seconds,
+    )
+
+
+def _build_twilio_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=settings.twilio_api_base_url,
+        auth=(settings.twilio_account_sid, settings.twilio_auth_token),
+        http2=settings.http2_enabled,
+        limits=_limits(),
+        timeout=_timeout(settings.twilio_timeout_seconds),
+    )
+
+
+def _build_vapi_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=settings.vapi_base_url,
+        headers={"Authorization": f"Bearer {settings.vapi_api_key}"},
+        http2=settings.http2_enabled,
+        limits=_limits(),
+        timeout=_timeout(settings.vapi_timeout_seconds),
+    )
+
+
+def _build_postmark_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=settings.postmark_api_base_url,
+        headers={
+            "Accept": "application/json",
+            "X-Postmark-Server-Token": settings.postmark_api_key,
+        },
+        http2=settings.http2_enabled,
+        limits=_limits(),
+        timeout=_timeout(settings.postmark_timeout_seconds),
+    )
+
+
+_builders = {
+    "twilio": _build_twilio_client,
+    "vapi": _build_vapi_client,
+    "postmark": _build_postmark_client,
+}
+
+
+def _get_client(name: str) -> httpx.AsyncClient:
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = _clients[name] = _builders[name]()
+    return client
+
+
+def get_twilio_client() -> httpx.AsyncClient:
+    return _get_client("twilio")
+
+
+def get_vapi_client() -> httpx.AsyncClient:
+    return _get_client("vapi")
+
+
+def get_postmark_client() -> httpx.AsyncClient:
+    return _get_client("postmark")
+
+
+async def start() -> None:
+    for name in _builders:
+        _get_client(name)
+    logger.info("Opened HTTP clients: %s", ", ".join(_builders))
+
+
+async def close() -> None:
+    for name, client in list(_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning("Failed to close %s HTTP client: %s", name, str(e))
+    _clients.clear()
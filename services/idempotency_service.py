@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import time
+from pymongo.errors import DuplicateKeyError
+from db import processed_events_collection
+from config import get_settings
+
+settings = get_settings()
+
+
+class RecentKeys:
+    """
+    Bounded set of recently claimed event keys with per-key expiry.
+    Answers most retries without a Mongo round trip; the processed_events
+    collection stays the source of truth across instances and restarts.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._keys: "OrderedDict[str, float]" = OrderedDict()
+
+    def __contains__(self, key: str) -> bool:
+        expires_at = self._keys.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._keys[key]
+            return False
+        return True
+
+    def add(self, key: str) -> None:
+        self._keys[key] = time.monotonic() + self.ttl_seconds
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        self._keys.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+recent_keys = RecentKeys(settings.idempotency_cache_size, settings.idempotency_ttl_seconds)
+duplicates = 0
+
+
+def twilio_message_key(message_sid: str) -> str:
+    return f"twilio:{message_sid}"
+
+
+def vapi_event_key(call_id: str, event_type: str) -> str:
+    return f"vapi:{call_id}:{event_type}"
+
+
+async def claim_event(key: str) -> bool:
+    """
+    Record that a webhook event is being processed.
+    Args:
+        key: Stable identifier of the event (see twilio_message_key / vapi_event_key)
+    Returns:
+        True if this is the first delivery, False if the event was already claimed
+    """
+    global duplicates
+
+    if key in recent_keys:
+        duplicates += 1
+        logging.info("Skipping duplicate webhook event %s", key)
+        return False
+
+    try:
+        await processed_events_collection.insert_one({"_id": key, "created_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        recent_keys.add(key)
+        duplicates += 1
+        logging.info("Skipping duplicate webhook event %s", key)
+        return False
+
+    recent_keys.add(key)
+    return True
+
+
+async def release_event(key: str) -> None:
+    """
+    Forget a claimed event so a retry of it is processed again.
+    Used when handling fails before the event's side effects took place.
+    """
+    recent_keys.discard(key)
+    try:
+        await processed_events_collection.delete_one({"_id": key})
+    except Exception as e:
+        logging.error("Failed to release webhook event %s: %s", key, str(e))
+
+
+def get_idempotency_stats() -> dict:
+    return {
+        "cached_keys": len(recent_keys),
+        "duplicates": duplicates,
+    }
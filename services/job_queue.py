@@ -0,0 +1,320 @@
+"""
+Durable background jobs, stored in the jobs collection.
+
+Side effects that must survive a restart (calls, emails, notifications)
+are enqueued as jobs and run by job workers: `python -m worker`, and the
+web process itself when job_worker_enabled is set. Workers lease a job
+with a single find_one_and_update that marks it running and pushes its
+run_at out by the visibility timeout; if a worker dies mid-job the lease
+lapses and another worker runs it again, so handlers must tolerate
+running more than once. Failed jobs are retried with exponential backoff
+and marked dead after max_attempts.
+"""
+import asyncio
+import logging
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from db import jobs_collection
+from config import get_settings
+from models.job import Job
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_DEAD = "dead"
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying can't help; the job is marked dead."""
+
+
+class JobHandler:
+    def __init__(self, run: Callable[[Job], Awaitable[Any]], on_dead: Optional[Callable[[Job], Awaitable[Any]]]):
+        self.run = run
+        # Called once when the job runs out of attempts
+        self.on_dead = on_dead
+
+
+_handlers: Dict[str, JobHandler] = {}
+_workers: List["JobWorker"] = []
+enqueued = 0
+duplicates = 0
+
+
+def register(job_type: str, on_dead: Optional[Callable[[Job], Awaitable[Any]]] = None):
+    """Decorator registering `handler(job)` to run jobs of `job_type`."""
+    def decorator(run: Callable[[Job], Awaitable[Any]]):
+        _handlers[job_type] = JobHandler(run, on_dead)
+        return run
+    return decorator
+
+
+async def enqueue(
+    job_type: str,
+    payload: Optional[Dict[str, Any]] = None,
+    delay: float = 0.0,
+    dedupe_key: Optional[str] = None,
+    max_attempts: Optional[int] = None,
+) -> Optional[ObjectId]:
+    """
+    Store a job for a worker to run.
+    Args:
+        job_type: Name the handler was registered under
+        payload: Arguments for the handler (stored in Mongo, so BSON types only)
+        delay: Seconds to wait before the job can run
+        dedupe_key: Skip enqueueing if a job with this key already exists
+        max_attempts: Attempts before the job is marked dead (default: settings.job_max_attempts)
+    Returns:
+        The job's ID, or None if it was a duplicate
+    """
+    global enqueued, duplicates
+    job = Job(
+        type=job_type,
+        payload=payload or {},
+        max_attempts=max_attempts or settings.job_max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+        dedupe_key=dedupe_key,
+    )
+    try:
+        await jobs_collection.insert_one(job.model_dump(by_alias=True, exclude_none=True))
+    except DuplicateKeyError:
+        duplicates += 1
+        logger.info("Job %s already enqueued, skipping", dedupe_key)
+        return None
+    enqueued += 1
+    if delay <= 0:
+        for worker in _workers:
+            worker.wake()
+    return job.id
+
+
+def retry_delay_seconds(attempts: int) -> float:
+    """Exponential backoff with jitter after the `attempts`-th failure."""
+    delay = min(settings.job_retry_max_seconds, settings.job_retry_base_seconds * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.5)
+
+
+class JobWorker:
+    """
+    Runs up to `concurrency` leased jobs at a time. A single poller leases
+    a job whenever a slot is free, so an idle worker costs one query per
+    poll interval rather than one per slot.
+    """
+
+    def __init__(self, concurrency: int, poll_interval: float, visibility_timeout: float):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self._poller: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self.in_flight = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.dead = 0
+        self.lease_errors = 0
+
+    @property
+    def running(self) -> bool:
+        return self._poller is not None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._poller is not None:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._poller = asyncio.get_running_loop().create_task(self._poll())
+        _workers.append(self)
+
+    async def lease(self) -> Optional[Job]:
+        """Claim the next runnable job, including jobs whose lease has lapsed."""
+        if not _handlers:
+            return None
+        now = datetime.utcnow()
+        doc = await jobs_collection.find_one_and_update(
+            {
+                "status": {"$in": [JOB_QUEUED, JOB_RUNNING]},
+                "run_at": {"$lte": now},
+                # Only job types this process can run
+                "type": {"$in": list(_handlers)},
+            },
+            {
+                "$set": {
+                    "status": JOB_RUNNING,
+                    "run_at": now + timedelta(seconds=self.visibility_timeout),
+                    "lease_id": uuid.uuid4().hex,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        return Job(**doc) if doc else None
+
+    async def _complete(self, job: Job) -> None:
+        await jobs_collection.update_one(
+            {"_id": job.id, "lease_id": job.lease_id},
+            {"$set": {"status": JOB_DONE, "finished_at": datetime.utcnow()}, "$unset": {"lease_id": ""}}
+        )
+        self.succeeded += 1
+
+    async def _fail(self, job: Job, error: str, permanent: bool = False) -> None:
+        if permanent or job.attempts >= job.max_attempts:
+            result = await jobs_collection.update_one(
+                {"_id": job.id, "lease_id": job.lease_id},
+                {"$set": {"status": JOB_DEAD, "dead_at": datetime.utcnow(), "last_error": error},
+                 "$unset": {"lease_id": ""}}
+            )
+            if not result.modified_count:
+                return
+            self.dead += 1
+            logger.error("Job %s (%s) is dead after %s attempts: %s", job.id, job.type, job.attempts, error)
+            handler = _handlers.get(job.type)
+            if handler and handler.on_dead:
+                try:
+                    await handler.on_dead(job)
+                except Exception:
+                    logger.exception("on_dead for job %s (%s) failed", job.id, job.type)
+            return
+
+        delay = retry_delay_seconds(job.attempts)
+        await jobs_collection.update_one(
+            {"_id": job.id, "lease_id": job.lease_id},
+            {"$set": {"status": JOB_QUEUED, "run_at": datetime.utcnow() + timedelta(seconds=delay),
+                      "last_error": error},
+             "$unset": {"lease_id": ""}}
+        )
+        self.retried += 1
+        logger.warning("Job %s (%s) failed, retrying in %.1fs: %s", job.id, job.type, delay, error)
+
+    async def execute(self, job: Job) -> None:
+        if job.attempts > job.max_attempts:
+            # Leases kept lapsing, e.g. the job crashes or outlives its visibility timeout
+            await self._fail(job, "Lease expired on the last attempt", permanent=True)
+            return
+        handler = _handlers[job.type]
+        self.in_flight += 1
+        try:
+            # Give up before the lease lapses and another worker starts the job too
+            await asyncio.wait_for(handler.run(job), self.visibility_timeout)
+        except PermanentJobError as e:
+            await self._fail(job, str(e), permanent=True)
+        except asyncio.TimeoutError:
+            await self._fail(job, f"Timed out after {self.visibility_timeout}s")
+        except Exception as e:
+            await self._fail(job, f"{type(e).__name__}: {e}")
+        else:
+            await self._complete(job)
+        finally:
+            self.in_flight -= 1
+
+    async def _run_job(self, job: Job) -> None:
+        try:
+            await self.execute(job)
+        except Exception:
+            # Recording the outcome failed; the lease lapses and the job runs again
+            logger.exception("Failed to record the outcome of job %s", job.id)
+        finally:
+            self._slots.release()
+
+    async def _poll(self) -> None:
+        while not self._stopping:
+            await self._slots.acquire()
+            if self._stopping:
+                self._slots.release()
+                break
+            try:
+                job = await self.lease()
+            except Exception as e:
+                self.lease_errors += 1
+                logger.error("Failed to lease a job: %s", str(e))
+                job = None
+            if job is not None:
+                task = asyncio.get_running_loop().create_task(self._run_job(job))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+            self._slots.release()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop leasing jobs and give running ones up to `timeout` seconds to
+        finish. Jobs cancelled after that run again once their lease lapses.
+        """
+        if self._poller is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        # The poller may be waiting for a slot or for a lease in flight
+        self._poller.cancel()
+        await asyncio.gather(self._poller, return_exceptions=True)
+        self._poller = None
+        pending = set()
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logger.warning("Job worker stopped with %s jobs still running", len(pending))
+        if self in _workers:
+            _workers.remove(self)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "in_flight": self.in_flight,
+            "succeeded": self.succeeded,
+            "retried": self.retried,
+            "dead": self.dead,
+            "lease_errors": self.lease_errors,
+        }
+
+
+job_worker = JobWorker(
+    settings.job_worker_concurrency,
+    settings.job_poll_interval_seconds,
+    settings.job_visibility_timeout_seconds,
+)
+
+
+# /metrics is scraped often; the collection counts are refreshed at most this often
+JOB_COUNTS_TTL_SECONDS = 5.0
+_job_counts: Optional[dict] = None
+_job_counts_at = 0.0
+
+
+async def get_job_stats() -> dict:
+    global _job_counts, _job_counts_at
+    if _job_counts is None or time.monotonic() - _job_counts_at > JOB_COUNTS_TTL_SECONDS:
+        _job_counts = {
+            "queued": await jobs_collection.count_documents({"status": JOB_QUEUED}),
+            "dead_jobs": await jobs_collection.count_documents({"status": JOB_DEAD}),
+        }
+        _job_counts_at = time.monotonic()
+    return {
+        **job_worker.stats(),
+        "enqueued": enqueued,
+        "duplicates": duplicates,
+        **_job_counts,
+    }
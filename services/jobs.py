@@ -0,0 +1,181 @@
+"""
+Background job types and their handlers. Importing this module registers
+them with the job queue; routes enqueue jobs with the helpers below.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+import httpx
+from bson import ObjectId
+from db import jobs_collection
+from config import get_settings
+from models.job import Job
+from models.user import User
+from services.email_service import EmailSendError, send_missed_call_email, send_beta_signup_email
+from services.job_queue import register, enqueue, PermanentJobError
+from services.timer_service import schedule_timer
+from services.message_service import store_message
+from services.prompts import PRIM_ONBOARDING_CALL
+from services.summary_service import append_conversation_summary
+from services.user_service import get_user_by_id
+from services.vapi_service import make_call
+from services.whatsapp_service import send_whatsapp_message, PRIORITY_NOTIFICATION
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+ONBOARDING_CALL = "onboarding_call"
+MISSED_CALL_EMAIL = "missed_call_email"
+BETA_SIGNUP_EMAIL = "beta_signup_email"
+WHATSAPP_MESSAGE = "whatsapp_message"
+
+# How a user hears about an onboarding call that couldn't be placed
+NOTIFY_EMAIL = "email"
+NOTIFY_WHATSAPP = "whatsapp"
+
+# A missed call this soon after a retry was placed was the retry
+RETRY_WINDOW = timedelta(hours=1)
+
+# Postmark errors for recipients it will never deliver to: an invalid
+# address (300) or an inactive one, after a hard bounce or spam complaint (406)
+PERMANENT_EMAIL_ERROR_CODES = {300, 406}
+
+# Failures where the call request certainly never reached VAPI, so retrying can't place a second call
+UNSENT_CALL_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+CALL_FAILED_WHATSAPP_MESSAGE = "Sorry, I wasn't able to call you just now. Could you please send 'I'm from YC' again and I'll try calling you right away?"
+
+
+def onboarding_first_message(user: User) -> str:
+    return f"Hi {user.name.split()[0] if user.name else 'there'}! 👋 I'm Prim, and I'm excited to learn more about your healthcare needs and get you onboarded. I understand you're from YC - that's fantastic! Let's chat about how I can help you. Let's start with chatting about any existing health conditions you have."
+
+
+def whatsapp_address(phone: str) -> str:
+    return phone if phone.startswith("whatsapp:") else f"whatsapp:{phone}"
+
+
+async def job_user(job: Job) -> User:
+    user = await get_user_by_id(ObjectId(job.payload["user_id"]))
+    if not user:
+        raise PermanentJobError(f"User {job.payload['user_id']} not found")
+    return user
+
+
+async def enqueue_onboarding_call(
+    user_id: ObjectId,
+    notify: str = NOTIFY_EMAIL,
+    include_summary: bool = False,
+    dedupe_key: Optional[str] = None,
+) -> Optional[ObjectId]:
+    """
+    Queue the YC onboarding call.
+    Args:
+        user_id: The user to call
+        notify: NOTIFY_EMAIL or NOTIFY_WHATSAPP, how to tell the user if the call can't be placed
+        include_summary: Add the user's conversation summary to the call's prompt
+        dedupe_key: Optional key making the enqueue idempotent
+    """
+    return await enqueue(
+        ONBOARDING_CALL,
+        {"user_id": user_id, "notify": notify, "include_summary": include_summary},
+        dedupe_key=dedupe_key,
+    )
+
+
+async def handle_missed_call(user: User, call_id: Optional[str]) -> None:
+    """
+    Follow up on a call the user didn't pick up: YC users get one onboarding
+    call back after settings.missed_call_retry_delay_seconds, everyone else
+    (and YC users who missed the retry too) gets the missed-call email.
+    """
+    if user.is_yc and user.call_phone:
+        retried = await jobs_collection.find_one({
+            "type": ONBOARDING_CALL,
+            "payload.user_id": user.id,
+            "payload.retry": True,
+            "created_at": {"$gte": datetime.utcnow() - RETRY_WINDOW},
+        }, {"_id": 1})
+        if not retried:
+            timer_id = await schedule_timer(
+                ONBOARDING_CALL,
+                {"user_id": user.id, "notify": NOTIFY_EMAIL, "retry": True},
+                delay=settings.missed_call_retry_delay_seconds,
+                dedupe_key=f"vapi:{call_id}:call_retry" if call_id else None,
+            )
+            logger.info("Scheduled onboarding call retry %s for user %s", timer_id, user.id)
+            return
+
+    if user.email:
+        await enqueue(
+            MISSED_CALL_EMAIL, {"email": user.email, "name": user.name},
+            dedupe_key=f"vapi:{call_id}:missed_call_email" if call_id else None)
+
+
+async def on_onboarding_call_dead(job: Job) -> None:
+    user = await get_user_by_id(ObjectId(job.payload["user_id"]))
+    if not user:
+        return
+    if job.payload.get("notify") == NOTIFY_WHATSAPP:
+        await enqueue(WHATSAPP_MESSAGE, {
+            "to": whatsapp_address(user.phone), "body": CALL_FAILED_WHATSAPP_MESSAGE, "user_id": user.id})
+    elif user.email:
+        await enqueue(MISSED_CALL_EMAIL, {"email": user.email, "name": user.name})
+
+
+@register(ONBOARDING_CALL, on_dead=on_onboarding_call_dead)
+async def run_onboarding_call(job: Job) -> None:
+    user = await job_user(job)
+    if not user.call_phone:
+        raise PermanentJobError(f"User {user.id} has no phone number to call")
+    system_prompt = PRIM_ONBOARDING_CALL
+    if job.payload.get("include_summary"):
+        system_prompt = append_conversation_summary(system_prompt, user)
+    # Creating a call isn't idempotent: only retry when VAPI can't have placed it
+    try:
+        call_id = await make_call(
+            to_phone=user.call_phone,
+            system_prompt=system_prompt,
+            first_message=onboarding_first_message(user),
+            user_id=user.id
+        )
+    except UNSENT_CALL_ERRORS:
+        raise
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 429:
+            raise
+        raise PermanentJobError(f"VAPI rejected the call with status {e.response.status_code}")
+    except httpx.HTTPError as e:
+        raise PermanentJobError(f"VAPI call request failed after it was sent, not retrying: {type(e).__name__}: {e}")
+    logger.info("Initiated onboarding call with ID: %s", call_id)
+
+
+async def send_job_email(send, job: Job) -> None:
+    try:
+        await send(job.payload["email"], job.payload.get("name"))
+    except EmailSendError as e:
+        if e.error_code in PERMANENT_EMAIL_ERROR_CODES:
+            raise PermanentJobError(f"Postmark won't deliver to {job.payload['email']}: {e} (ErrorCode {e.error_code})")
+        raise
+
+
+@register(MISSED_CALL_EMAIL)
+async def run_missed_call_email(job: Job) -> None:
+    await send_job_email(send_missed_call_email, job)
+
+
+@register(BETA_SIGNUP_EMAIL)
+async def run_beta_signup_email(job: Job) -> None:
+    await send_job_email(send_beta_signup_email, job)
+
+
+@register(WHATSAPP_MESSAGE)
+async def run_whatsapp_message(job: Job) -> None:
+    """Send a WhatsApp message; with a user_id in the payload, store it in their history once sent."""
+    await send_whatsapp_message(job.payload["to"], job.payload["body"], priority=PRIORITY_NOTIFICATION)
+    if job.payload.get("user_id"):
+        try:
+            await store_message(
+                user_id=ObjectId(job.payload["user_id"]), text=job.payload["body"], source="whatsapp", sender="assistant")
+        except Exception as e:
+            # Not worth re-sending the message over
+            logger.error("Failed to store sent WhatsApp message for user %s: %s", job.payload["user_id"], str(e))
@@ -0,0 +1,402 @@
+"""
+Single entry point for OpenAI calls.
+
+Every chat completion goes through `gateway.complete()`, which:
+- caps the number of requests in flight, letting interactive callers
+  (a user waiting on a reply) jump ahead of background work
+- gives each call a deadline covering queueing, retries and the request itself
+- retries transient failures with jittered exponential backoff
+- trips a per-model circuit breaker after repeated failures and fails
+  over to `settings.llm_fallback_model` while it is open
+- records per-model latency, time to first token and token usage for /metrics
+
+`gateway.stream()` does the same for streamed completions.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional
+import openai
+from openai import AsyncOpenAI
+from config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+LATENCY_SAMPLES = 1000
+
+# Shared by every OpenAI caller; retries are handled by the gateway (or, for
+# embeddings, by the embedding worker), not by the SDK
+client = AsyncOpenAI(api_key=settings.openai_api_key, base_url=settings.openai_base_url or None, max_retries=0)
+
+
+class LLMTimeoutError(Exception):
+    """Raised when a completion can't finish within its deadline."""
+
+
+class LLMUnavailableError(Exception):
+    """Raised when the circuit breakers for a model and its fallback are open."""
+
+
+class PrioritySemaphore:
+    """Semaphore that wakes the waiter with the lowest priority value first."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters: List[tuple] = []  # (priority, seq, future)
+        self._seq = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> None:
+        if self._value > 0 and not self.waiting:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Granted a slot just as we were cancelled; hand it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures. Once open, it
+    lets a single trial request through every `reset_seconds`; a success
+    closes it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_seconds:
+            self.opened_at = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold and self.opened_at is None:
+            self.opened_at = time.monotonic()
+            logger.warning("Circuit breaker opened after %s consecutive failures", self.failures)
+
+
+class ModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.fallbacks = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.first_token_latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+
+    @staticmethod
+    def _percentile_ms(samples: Deque[float], q: float) -> Optional[float]:
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return round(ordered[math.ceil(len(ordered) * q) - 1] * 1000, 1)
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "fallbacks": self.fallbacks,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "p50_ms": self._percentile_ms(self.latencies, 0.5),
+            "p95_ms": self._percentile_ms(self.latencies, 0.95),
+            "ttft_p50_ms": self._percentile_ms(self.first_token_latencies, 0.5),
+            "ttft_p95_ms": self._percentile_ms(self.first_token_latencies, 0.95),
+        }
+
+
+class LLMGateway:
+    def __init__(self, max_concurrency: int, max_retries: int, failure_threshold: int, reset_seconds: float):
+        self.max_retries = max_retries
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._slots = PrioritySemaphore(max(1, max_concurrency))
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._stats: Dict[str, ModelStats] = {}
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+        return self._breakers[model]
+
+    def _model_stats(self, model: str) -> ModelStats:
+        if model not in self._stats:
+            self._stats[model] = ModelStats()
+        return self._stats[model]
+
+    def _choose_model(self, model: str, fallback_model: Optional[str]) -> str:
+        if self._breaker(model).allow():
+            return model
+        if fallback_model and fallback_model != model and self._breaker(fallback_model).allow():
+            self._model_stats(model).fallbacks += 1
+            return fallback_model
+        raise LLMUnavailableError(f"Circuit breaker open for {model}")
+
+    async def complete(
+        self,
+        messages: List[dict],
+        model: Optional[str] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        timeout: Optional[float] = None,
+        fallback_model: Optional[str] = None,
+        **params
+    ):
+        """
+        Create a chat completion.
+        Args:
+            messages: Chat messages
+            model: Model to use (default: settings.llm_model)
+            priority: PRIORITY_INTERACTIVE (default) or PRIORITY_BACKGROUND
+            timeout: Deadline in seconds for the whole call, including queueing and retries
+                (default: settings.llm_timeout_seconds, or llm_background_timeout_seconds for background calls)
+            fallback_model: Model to use while `model`'s circuit breaker is open
+                (default: settings.llm_fallback_model)
+            **params: Passed through to chat.completions.create (max_tokens, temperature, ...)
+        Returns:
+            The ChatCompletion
+        Raises:
+            LLMTimeoutError: If the deadline passes
+            LLMUnavailableError: If the model and its fallback are both failing
+        """
+        model = model or settings.llm_model
+        if fallback_model is None:
+            fallback_model = settings.llm_fallback_model
+        if timeout is None:
+            timeout = settings.llm_timeout_seconds if priority == PRIORITY_INTERACTIVE \
+                else settings.llm_background_timeout_seconds
+        deadline = time.monotonic() + timeout
+        last_error: Optional[Exception] = None
+
+        for attempt in range(self.max_retries + 1):
+            chosen = self._choose_model(model, fallback_model)
+            stats = self._model_stats(chosen)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._slots.acquire(priority), remaining)
+            except asyncio.TimeoutError:
+                break
+
+            started = time.monotonic()
+            stats.calls += 1
+            try:
+                response = await asyncio.wait_for(
+                    client.chat.completions.create(model=chosen, messages=messages, **params),
+                    max(0.0, deadline - started)
+                )
+            except RETRYABLE_ERRORS as e:
+                last_error = e
+                self._breaker(chosen).record_failure()
+                if isinstance(e, (asyncio.TimeoutError, openai.APITimeoutError)):
+                    stats.timeouts += 1
+                else:
+                    stats.errors += 1
+            except Exception:
+                stats.errors += 1
+                raise
+            else:
+                stats.latencies.append(time.monotonic() - started)
+                if response.usage:
+                    stats.prompt_tokens += response.usage.prompt_tokens
+                    stats.completion_tokens += response.usage.completion_tokens
+                self._breaker(chosen).record_success()
+                return response
+            finally:
+                self._slots.release()
+
+            if attempt == self.max_retries:
+                break
+            delay = random.uniform(0, min(settings.llm_retry_max_backoff_seconds, 0.5 * 2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                break
+            stats.retries += 1
+            logger.warning("%s call failed (%s), retrying in %.2fs", chosen, type(last_error).__name__, delay)
+            await asyncio.sleep(delay)
+
+        if last_error is None or isinstance(last_error, (asyncio.TimeoutError, openai.APITimeoutError)):
+            if last_error is None:
+                # The deadline passed while waiting for a slot
+                self._model_stats(model).timeouts += 1
+            raise LLMTimeoutError(f"{model} call did not finish within {timeout:.1f}s") from last_error
+        raise last_error
+
+    async def stream(
+        self,
+        messages: List[dict],
+        model: Optional[str] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        first_token_timeout: Optional[float] = None,
+        fallback_model: Optional[str] = None,
+        **params
+    ) -> AsyncIterator:
+        """
+        Stream a chat completion, yielding ChatCompletionChunks as they arrive.
+        Retries and failover only happen before the first chunk; once tokens
+        have been yielded, an upstream error ends the stream with that error.
+        Args:
+            messages: Chat messages
+            model: Model to use (default: settings.llm_model)
+            priority: PRIORITY_INTERACTIVE (default) or PRIORITY_BACKGROUND
+            first_token_timeout: Deadline in seconds for the first chunk, including
+                queueing and retries (default: settings.llm_first_token_timeout_seconds)
+            fallback_model: Model to use while `model`'s circuit breaker is open
+                (default: settings.llm_fallback_model)
+            **params: Passed through to chat.completions.create
+        Raises:
+            LLMTimeoutError: If no chunk arrives before the deadline
+            LLMUnavailableError: If the model and its fallback are both failing
+        """
+        model = model or settings.llm_model
+        if fallback_model is None:
+            fallback_model = settings.llm_fallback_model
+        timeout = first_token_timeout or settings.llm_first_token_timeout_seconds
+        deadline = time.monotonic() + timeout
+        last_error: Optional[Exception] = None
+
+        for attempt in range(self.max_retries + 1):
+            chosen = self._choose_model(model, fallback_model)
+            stats = self._model_stats(chosen)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._slots.acquire(priority), remaining)
+            except asyncio.TimeoutError:
+                break
+
+            started = time.monotonic()
+            stats.calls += 1
+            response = None
+            try:
+                response = await asyncio.wait_for(
+                    client.chat.completions.create(model=chosen, messages=messages, stream=True, **params),
+                    max(0.0, deadline - started)
+                )
+                chunks = response.__aiter__()
+                first = await asyncio.wait_for(chunks.__anext__(), max(0.0, deadline - time.monotonic()))
+            except StopAsyncIteration:
+                self._slots.release()
+                return
+            except RETRYABLE_ERRORS as e:
+                self._slots.release()
+                if response is not None:
+                    await response.close()
+                last_error = e
+                self._breaker(chosen).record_failure()
+                if isinstance(e, (asyncio.TimeoutError, openai.APITimeoutError)):
+                    stats.timeouts += 1
+                else:
+                    stats.errors += 1
+            except BaseException:
+                self._slots.release()
+                if response is not None:
+                    await response.close()
+                stats.errors += 1
+                raise
+            else:
+                stats.first_token_latencies.append(time.monotonic() - started)
+                self._breaker(chosen).record_success()
+                try:
+                    yield first
+                    async for chunk in chunks:
+                        yield chunk
+                    stats.latencies.append(time.monotonic() - started)
+                finally:
+                    self._slots.release()
+                    await response.close()
+                return
+
+            if attempt == self.max_retries:
+                break
+            delay = random.uniform(0, min(settings.llm_retry_max_backoff_seconds, 0.5 * 2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                break
+            stats.retries += 1
+            logger.warning("%s stream failed (%s), retrying in %.2fs", chosen, type(last_error).__name__, delay)
+            await asyncio.sleep(delay)
+
+        if last_error is None or isinstance(last_error, (asyncio.TimeoutError, openai.APITimeoutError)):
+            if last_error is None:
+                self._model_stats(model).timeouts += 1
+            raise LLMTimeoutError(f"{model} stream produced no tokens within {timeout:.1f}s") from last_error
+        raise last_error
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self._slots.waiting,
+            "models": {model: stats.to_dict() for model, stats in self._stats.items()},
+            "open_circuits": [model for model, breaker in self._breakers.items() if breaker.is_open],
+        }
+
+
+gateway = LLMGateway(
+    max_concurrency=settings.llm_max_concurrency,
+    max_retries=settings.llm_max_retries,
+    failure_threshold=settings.llm_breaker_failure_threshold,
+    reset_seconds=settings.llm_breaker_reset_seconds,
+)
+
+
+async def complete_text(messages: List[dict], **kwargs) -> str:
+    """Run gateway.complete() and return the stripped text of the first choice."""
+    response = await gateway.complete(messages, **kwargs)
+    return response.choices[0].message.content.strip()
+
+
+def get_llm_stats() -> dict:
+    return gateway.stats()
@@ -1,15 +1,150 @@
-from typing import List, Optional
+from typing import Callable, List, Optional
+from collections import OrderedDict, deque
+import time
 from bson import ObjectId
-from openai import AsyncOpenAI
+from pymongo.errors import BulkWriteError
 import logging
 from models.message import Message
+from models.user import User
 from db import messages_collection
 from config import get_settings
-from services.prompts import PRIM_HEALTHCARE_ASSISTANT_WHATSAPP
+from services.prompts import PRIM_HEALTHCARE_ASSISTANT_WHATSAPP, PRIM_BETA_RESPONSE
+from services.context_builder import build_chat_messages
+from services.llm_gateway import complete_text
+from services.response_cache import response_cache, last_user_message, shared_history
 from datetime import datetime
 
 settings = get_settings()
-client = AsyncOpenAI(api_key=settings.openai_api_key)
+
+
+class ConversationBuffer:
+    """
+    Per-user ring buffers of the most recent messages, kept in this process.
+    store_message appends to a user's buffer once it has been loaded from
+    Mongo, so history reads for active conversations skip the database.
+    Users are evicted least-recently-used first once the total number of
+    buffered messages exceeds `max_messages`, and a buffer is reloaded after
+    `ttl_seconds` to pick up messages written by other processes (other web
+    instances, and `python -m worker`, which stores outbound replies): those
+    only show up in a warm buffer once it expires.
+    """
+
+    def __init__(self, messages_per_user: int, max_messages: int, ttl_seconds: float):
+        self.messages_per_user = messages_per_user
+        self.max_messages = max_messages
+        self.ttl_seconds = ttl_seconds
+        self._buffers: "OrderedDict[ObjectId, tuple[float, deque]]" = OrderedDict()
+        self._total = 0
+        # Bumped by writes the buffers can't take in (invalidate(), appends for
+        # cold users), so a load that read Mongo before such a write is discarded
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: ObjectId, limit: int) -> Optional[List[Message]]:
+        entry = self._buffers.get(user_id)
+        if entry is None or limit > self.messages_per_user:
+            self.misses += 1
+            return None
+        loaded_at, buffer = entry
+        if time.monotonic() - loaded_at > self.ttl_seconds:
+            self._drop(user_id)
+            self.misses += 1
+            return None
+        self._buffers.move_to_end(user_id)
+        self.hits += 1
+        return list(buffer)[-limit:] if limit > 0 else []
+
+    def load(self, user_id: ObjectId, messages: List[Message], generation: Optional[int] = None) -> None:
+        """
+        Buffer `messages` as the user's latest. Pass the `generation` read
+        before querying them: if anything was invalidated since, the
+        messages may predate a write and aren't buffered.
+        """
+        if self.messages_per_user <= 0 or (generation is not None and generation != self.generation):
+            return
+        self._drop(user_id)
+        buffer = deque(messages[-self.messages_per_user:], maxlen=self.messages_per_user)
+        self._buffers[user_id] = (time.monotonic(), buffer)
+        self._total += len(buffer)
+        self._evict()
+
+    def append(self, message: Message) -> None:
+        # Only warm buffers are extended; a cold one would miss older messages.
+        # A read may be loading it from Mongo right now without this message
+        entry = self._buffers.get(message.user_id)
+        if entry is None:
+            self.generation += 1
+            return
+        buffer = entry[1]
+        if len(buffer) < buffer.maxlen:
+            self._total += 1
+        buffer.append(message)
+        self._buffers.move_to_end(message.user_id)
+        self._evict()
+
+    def invalidate(self, user_id: ObjectId) -> None:
+        """Drop the user's buffer after a write it can't be extended with."""
+        self.generation += 1
+        self._drop(user_id)
+
+    def _drop(self, user_id: ObjectId) -> None:
+        entry = self._buffers.pop(user_id, None)
+        if entry is not None:
+            self._total -= len(entry[1])
+
+    def _evict(self) -> None:
+        while self._total > self.max_messages and self._buffers:
+            _, (_, buffer) = self._buffers.popitem(last=False)
+            self._total -= len(buffer)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._buffers),
+            "messages": self._total,
+            "max_messages": self.max_messages,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+conversation_buffer = ConversationBuffer(
+    settings.history_buffer_messages_per_user,
+    settings.history_buffer_max_messages,
+    settings.history_buffer_ttl_seconds,
+)
+
+
+def get_conversation_buffer_stats() -> dict:
+    return conversation_buffer.stats()
+
+
+# Callbacks run after messages are stored, e.g. to refresh derived per-user
+# state. They are called synchronously and must only schedule work.
+MessageListener = Callable[[ObjectId, List[Message]], None]
+_message_listeners: List[MessageListener] = []
+
+
+def add_message_listener(listener: MessageListener) -> None:
+    if listener not in _message_listeners:
+        _message_listeners.append(listener)
+
+
+def remove_message_listener(listener: MessageListener) -> None:
+    if listener in _message_listeners:
+        _message_listeners.remove(listener)
+
+
+def notify_message_listeners(user_id: ObjectId, messages: List[Message]) -> None:
+    if not messages:
+        return
+    for listener in _message_listeners:
+        try:
+            listener(user_id, messages)
+        except Exception:
+            logging.exception("Message listener %s failed", listener)
 
 
 async def store_message(user_id: ObjectId, text: str, source: str, sender: str) -> Message:
@@ -29,21 +164,94 @@ async def store_message(user_id: ObjectId, text: str, source: str, sender: str)
     )
     result = await messages_collection.insert_one(message.model_dump(by_alias=True))
     message.id = result.inserted_id
+    conversation_buffer.append(message)
+    notify_message_listeners(user_id, [message])
     return message
 
 
+async def store_call_transcript(user_id: ObjectId, call_id: Optional[str], turns: List[dict]) -> int:
+    """Store the turns of a voice call transcript in a single bulk insert.
+
+    Each turn is keyed on (call_id, turn_index), so storing the same call
+    again only inserts turns that are missing.
+
+    Args:
+        user_id: The ID of the user
+        call_id: The VAPI call ID
+        turns: Ordered dicts with "text", "sender" and "timestamp" keys
+    Returns:
+        Number of messages inserted
+    """
+    messages = [
+        Message(
+            user_id=user_id,
+            text=turn["text"],
+            source="voice",
+            sender=turn["sender"],
+            timestamp=turn["timestamp"],
+            call_id=call_id,
+            turn_index=index
+        )
+        for index, turn in enumerate(turns)
+    ]
+    if not messages:
+        return 0
+
+    try:
+        await messages_collection.insert_many(
+            [message.model_dump(by_alias=True) for message in messages], ordered=False)
+        inserted = messages
+    except BulkWriteError as e:
+        # Duplicate keys mean the turn was stored by an earlier delivery
+        write_errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in write_errors):
+            raise
+        duplicates = {error["index"] for error in write_errors}
+        inserted = [message for index, message in enumerate(messages) if index not in duplicates]
+        logging.info("Skipped %s already stored turns for call %s", len(duplicates), call_id)
+    finally:
+        # Turns are older than messages already buffered; reload on next read.
+        # After the insert, so a read racing it can't buffer the history without them
+        conversation_buffer.invalidate(user_id)
+
+    notify_message_listeners(user_id, inserted)
+    return len(inserted)
+
+
+# Fields needed to rebuild a Message for LLM context; leaves out embeddings
+HISTORY_PROJECTION = {
+    "_id": 1,
+    "user_id": 1,
+    "text": 1,
+    "source": 1,
+    "sender": 1,
+    "timestamp": 1,
+    "summarized": 1,
+}
+
+
 async def get_user_message_history(user_id: ObjectId, limit: int = 50) -> List[Message]:
     """
-    Get a user's complete message history, ordered by timestamp.
+    Get a user's most recent messages, ordered by timestamp.
+    Served from the in-process conversation buffer when it is warm; otherwise
+    reads the newest messages through the (user_id, timestamp) index and
+    reverses them, so the cost doesn't grow with the length of the history.
     Args:
         user_id: The user's ID
         limit: Maximum number of messages to return (default: 50)
     Returns:
-        List of messages ordered by timestamp (oldest first)
+        List of the latest messages ordered by timestamp (oldest first)
     """
+    buffered = conversation_buffer.get(user_id, limit)
+    if buffered is not None:
+        return buffered
+    generation = conversation_buffer.generation
+
+    # Read enough to fill the buffer so the next reads are served from memory
     cursor = messages_collection.find(
-        {"user_id": user_id}
-    ).sort("timestamp", 1).limit(limit)  # Changed to 1 for ascending order
+        {"user_id": user_id},
+        HISTORY_PROJECTION
+    ).sort([("timestamp", -1), ("_id", -1)]).limit(max(limit, conversation_buffer.messages_per_user))
 
     messages = []
     async for doc in cursor:
@@ -52,77 +260,60 @@ async def get_user_message_history(user_id: ObjectId, limit: int = 50) -> List[M
             doc["sender"] = "assistant" if doc.get(
                 "source") == "whatsapp" else "user"
         messages.append(Message(**doc))
-    return messages  # No need to reverse anymore
+    messages.reverse()
+
+    conversation_buffer.load(user_id, messages, generation)
+    return messages[-limit:] if limit > 0 else []
+
+
+def summary_context(user: Optional[User]) -> dict:
+    """
+    Keyword arguments passing a user's rolling summary to build_chat_messages.
+    """
+    if not user or not user.conversation_summary:
+        return {}
+    return {"summary": user.conversation_summary}
 
 
-async def generate_response(message_history: List[Message]) -> str:
+async def generate_response(message_history: List[Message], user: Optional[User] = None, memories: Optional[List[dict]] = None) -> str:
     """
     Generate a response using OpenAI based on message history.
     Args:
-        message_history: List of messages ordered by timestamp (newest first)
+        message_history: List of messages ordered by timestamp (oldest first)
+        user: The user, whose rolling summary is included when present (optional)
+        memories: Relevant past messages from retrieval_service (optional)
     Returns:
         Generated response text
     """
-    # Format message history for the prompt
-    formatted_history = []
-    # Sort messages by timestamp in ascending order (oldest first)
-    sorted_messages = sorted(message_history, key=lambda x: x.timestamp)
-    for msg in sorted_messages:
-        formatted_history.append(f"{msg.sender}: {msg.text}")
-
-    # Create the prompt
-    prompt = "Here is the conversation history:\n\n"
-    prompt += "\n".join(formatted_history)
-    prompt += "\n\nassistant:"
-
-    # Generate response using OpenAI
-    response = await client.chat.completions.create(
-        model="gpt-4.1",
-        messages=[
-            {"role": "system", "content": PRIM_HEALTHCARE_ASSISTANT_WHATSAPP},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=150,
-        temperature=0.7
-    )
+    messages = build_chat_messages(
+        PRIM_HEALTHCARE_ASSISTANT_WHATSAPP, message_history, memories=memories, **summary_context(user))
 
-    return response.choices[0].message.content.strip()
+    return await complete_text(messages, max_tokens=150, temperature=0.7)
 
 
-async def generate_beta_response(message_history: List[Message]) -> str:
+async def generate_beta_response(message_history: List[Message], user_id: ObjectId, user: Optional[User] = None) -> str:
     """
     Generate a personalized response for users in beta using OpenAI.
     Args:
-        message_history: List of messages ordered by timestamp (newest first)
+        message_history: List of messages ordered by timestamp (oldest first)
+        user_id: The user's ID
+        user: The user, whose rolling summary is included when present (optional)
     Returns:
         Generated response text
     """
-    # Format message history for the prompt
-    formatted_history = []
-    # Sort messages by timestamp in ascending order (oldest first)
-    sorted_messages = sorted(message_history, key=lambda x: x.timestamp)
-    for msg in sorted_messages:
-        formatted_history.append(f"{msg.sender}: {msg.text}")
-
-    prompt = f"""Based on this conversation history:
-{chr(10).join(formatted_history)}
-
-Generate a brief, upbeat response (max 1-2 sentences) that:
-1. Acknowledges the user's interest and message
-2. Explains that the beta is still under construction
-3. Mentions that you'll reach out when ready to help with their healthcare
-4. Keeps the tone warm and personal
-
-Make it feel like a natural continuation of the conversation."""
-
-    response = await client.chat.completions.create(
-        model="gpt-4.1",
-        messages=[
-            {"role": "system", "content": "You are Prim, a friendly healthcare assistant. Keep responses warm and personal."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=150,
-        temperature=0.7
-    )
+    last_message = last_user_message(message_history)
 
-    return response.choices[0].message.content.strip()
+    async def generate(shared: bool) -> str:
+        if shared:
+            messages = build_chat_messages(PRIM_BETA_RESPONSE, shared_history(user_id, last_message))
+        else:
+            messages = build_chat_messages(PRIM_BETA_RESPONSE, message_history, **summary_context(user))
+        return await complete_text(messages, max_tokens=150, temperature=0.7)
+
+    return await response_cache.get_or_generate(
+        "beta",
+        "",
+        last_message,
+        user.name.split()[0] if user and user.name else None,
+        generate
+    )
@@ -0,0 +1,209 @@
+"""
+Caches generated replies for templated conversations (beta and onboarding).
+
+These replies depend mostly on which prompt produced them, what we still
+need from the user and what the user just said, so they are keyed on
+exactly that. The user's first name is swapped for a placeholder before a
+reply is stored and filled back in on a hit, so one cached reply serves
+every user. Because of that, a reply that gets cached is generated from
+the user's latest message alone, never from their history or summary,
+which could carry another user's health details. With a similarity
+threshold set, a message that doesn't match exactly can still hit an
+entry whose message embeds close enough.
+"""
+import re
+import time
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+import numpy as np
+from bson import ObjectId
+from config import get_settings
+from models.message import Message
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+NAME_PLACEHOLDER = "{{name}}"
+# Messages with contact details or long free text are personal or unlikely to repeat
+MAX_CACHEABLE_MESSAGE_LENGTH = 200
+UNCACHEABLE_PATTERN = re.compile(r"@|\d")
+
+
+def normalize_message(text: str) -> str:
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+def last_user_message(message_history: List[Message]) -> str:
+    for message in reversed(message_history):
+        if message.sender == "user" and message.text:
+            return message.text
+    return ""
+
+
+def shared_history(user_id: ObjectId, message: str) -> List[Message]:
+    """History for a reply that may be served to other users: only the latest message."""
+    return [Message(user_id=user_id, text=message, source="whatsapp", sender="user")]
+
+
+def is_cacheable_message(text: str) -> bool:
+    return bool(text) and len(text) <= MAX_CACHEABLE_MESSAGE_LENGTH and not UNCACHEABLE_PATTERN.search(text)
+
+
+def templatize(reply: str, name: Optional[str]) -> str:
+    if not name or len(name) < 2:
+        return reply
+    return re.sub(rf"\b{re.escape(name)}\b", NAME_PLACEHOLDER, reply)
+
+
+def personalize(reply: str, name: Optional[str]) -> str:
+    return reply.replace(NAME_PLACEHOLDER, name or "there")
+
+
+class ResponseCache:
+    """
+    Bounded TTL + LRU cache of templatized replies. Entries are grouped by
+    (template, state) so similarity matching only compares messages that
+    were answered with the same prompt and the same missing information.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, similarity_threshold: float = 0.0, embedder=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.embedder = embedder
+        # key -> (expires_at, reply, embedding or None)
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._groups: Dict[tuple, set] = {}
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def _evict(self, key: tuple) -> None:
+        self._entries.pop(key, None)
+        group = self._groups.get(key[:2])
+        if group is not None:
+            group.discard(key)
+            if not group:
+                del self._groups[key[:2]]
+
+    def _get_exact(self, key: tuple) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _get_similar(self, group_key: tuple, embedding: np.ndarray) -> Optional[str]:
+        now = time.monotonic()
+        candidates = [
+            key for key in self._groups.get(group_key, ())
+            if self._entries[key][2] is not None and self._entries[key][0] >= now
+        ]
+        if not candidates:
+            return None
+        matrix = np.stack([self._entries[key][2] for key in candidates])
+        scores = matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        self._entries.move_to_end(candidates[best])
+        return self._entries[candidates[best]][1]
+
+    async def _embed(self, text: str) -> Optional[np.ndarray]:
+        if self.similarity_threshold <= 0:
+            return None
+        if self.embedder is None:
+            # Imported here: embedding_service depends on message_service, which uses this cache
+            from services.embedding_service import get_embedder
+            self.embedder = get_embedder()
+        try:
+            vector = np.asarray((await self.embedder.embed([text]))[0], dtype=np.float32)
+        except Exception as e:
+            logger.warning("Response cache embedding failed, using exact matching only: %s", str(e))
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def put(self, key: tuple, reply: str, embedding: Optional[np.ndarray] = None) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, reply, embedding)
+        self._entries.move_to_end(key)
+        self._groups.setdefault(key[:2], set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._evict(next(iter(self._entries)))
+
+    async def get_or_generate(
+        self,
+        template: str,
+        state: str,
+        message: str,
+        name: Optional[str],
+        generate: Callable[[bool], Awaitable[str]],
+    ) -> str:
+        """
+        Return a cached reply for this template, state and message, or
+        generate one and cache it. `generate(shared)` is called with
+        shared=True when the reply will be cached and served to other users,
+        in which case it must only use `message` and `state` (see
+        shared_history); with shared=False it may use the user's own context.
+        Args:
+            template: Name of the prompt that produces the reply
+            state: What the reply depends on besides the message (e.g. missing info)
+            message: The user's latest message
+            name: The user's first name, substituted into cached replies
+            generate: Produces the reply on a miss or when the message isn't cacheable
+        Returns:
+            The reply text, personalized for `name`
+        """
+        if self.max_size <= 0 or not is_cacheable_message(message):
+            self.skipped += 1
+            return await generate(False)
+
+        normalized = normalize_message(message)
+        key = (template, state, normalized)
+        reply = self._get_exact(key)
+        if reply is not None:
+            self.hits += 1
+            return personalize(reply, name)
+
+        embedding = await self._embed(normalized)
+        if embedding is not None:
+            reply = self._get_similar(key[:2], embedding)
+            if reply is not None:
+                self.similar_hits += 1
+                return personalize(reply, name)
+
+        self.misses += 1
+        reply = await generate(True)
+        self.put(key, templatize(reply, name), embedding)
+        return reply
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.similar_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "hit_rate": round((self.hits + self.similar_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache(
+    settings.response_cache_max_size if settings.response_cache_enabled else 0,
+    settings.response_cache_ttl_seconds,
+    settings.response_cache_similarity_threshold,
+)
+
+
+def get_response_cache_stats() -> dict:
+    return response_cache.stats()
@@ -0,0 +1,322 @@
+"""
+Retrieves a user's most relevant past messages by embedding similarity.
+
+Each active user's message embeddings are held in a contiguous, row-normalized
+NumPy matrix so a top-k cosine query is a single matrix-vector product. Users
+are evicted least-recently-used, and their matrices can be snapshotted to disk
+and memory-mapped back on the next start. Users with more vectors than fit
+the in-process budget, and users whose vectors can't be loaded, are served
+from Qdrant instead. Only this process's embedding worker extends loaded
+matrices, so a user's vectors are re-checked against Mongo once they have
+been loaded for `ttl_seconds`.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+import numpy as np
+from bson import ObjectId
+from db import messages_collection
+from config import get_settings
+from services.embedding_service import get_embedder, embedding_worker, qdrant_models
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+MEMORY_PROJECTION = {"_id": 1, "text": 1, "sender": 1, "source": 1, "timestamp": 1, "embedding": 1}
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+class UserVectors:
+    """
+    Embeddings of one user's messages with the metadata needed to use them
+    as context. Rows are unit length, so dot products are cosine similarities.
+    """
+
+    def __init__(self, ids: List[ObjectId], matrix: np.ndarray, meta: List[dict]):
+        self.ids = ids
+        self.meta = meta
+        self._matrix = matrix
+        self._size = len(ids)
+        self._positions = {message_id: i for i, message_id in enumerate(ids)}
+        self.loaded_at = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:self._size]
+
+    def add(self, message_id: ObjectId, vector: np.ndarray, meta: dict) -> None:
+        if message_id in self._positions:
+            return
+        if self._size == len(self._matrix) or not self._matrix.flags.writeable:
+            # Grow geometrically; also copies memory-mapped snapshots into memory
+            capacity = max(16, self._size * 2)
+            grown = np.zeros((capacity, self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._size] = self._matrix[:self._size]
+            self._matrix = grown
+        norm = np.linalg.norm(vector)
+        self._matrix[self._size] = vector / norm if norm else vector
+        self._positions[message_id] = self._size
+        self.ids.append(message_id)
+        self.meta.append(meta)
+        self._size += 1
+
+    def search(self, query: np.ndarray, k: int) -> List[tuple]:
+        if self._size == 0 or k <= 0:
+            return []
+        norm = np.linalg.norm(query)
+        scores = self.matrix @ (query / norm if norm else query)
+        k = min(k, self._size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i]), self.meta[i]) for i in top]
+
+
+class VectorIndex:
+    def __init__(self, max_users: int, max_vectors_per_user: int, ttl_seconds: float, snapshot_dir: str = ""):
+        self.max_users = max_users
+        self.max_vectors_per_user = max_vectors_per_user
+        self.ttl_seconds = ttl_seconds
+        self.snapshot_dir = snapshot_dir
+        self._users: "OrderedDict[ObjectId, UserVectors]" = OrderedDict()
+        # Users with too many vectors to hold in process; always served by Qdrant
+        self._oversized: "OrderedDict[ObjectId, bool]" = OrderedDict()
+        self._locks: Dict[ObjectId, asyncio.Lock] = {}
+        self.hits = 0
+        self.loads = 0
+        self.refreshes = 0
+        self.snapshot_loads = 0
+        self.fallbacks = 0
+
+    async def get(self, user_id: ObjectId) -> Optional[UserVectors]:
+        """
+        Return the user's vectors, loading them on first use, or None if the
+        user has too many vectors to serve in process.
+        """
+        vectors = self._fresh(user_id)
+        if vectors is not None:
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return vectors
+        if user_id in self._oversized:
+            return None
+
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            vectors = self._fresh(user_id)
+            if vectors is not None:
+                return vectors
+            vectors = await self._load(user_id, self._users.get(user_id))
+        self._locks.pop(user_id, None)
+
+        if vectors is None:
+            self._users.pop(user_id, None)
+            self._oversized[user_id] = True
+            while len(self._oversized) > self.max_users:
+                self._oversized.popitem(last=False)
+            return None
+
+        self._users[user_id] = vectors
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            evicted_id, evicted = self._users.popitem(last=False)
+            self.save_snapshot(evicted_id, evicted)
+        return vectors
+
+    def _fresh(self, user_id: ObjectId) -> Optional[UserVectors]:
+        vectors = self._users.get(user_id)
+        if vectors is None or time.monotonic() - vectors.loaded_at > self.ttl_seconds:
+            return None
+        return vectors
+
+    async def _load(self, user_id: ObjectId, current: Optional[UserVectors] = None) -> Optional[UserVectors]:
+        query = {"user_id": user_id, "embedding": {"$ne": None}}
+        count = await messages_collection.count_documents(query, limit=self.max_vectors_per_user + 1)
+        if count > self.max_vectors_per_user:
+            return None
+
+        # Expired but nothing was embedded elsewhere since: keep the loaded matrix
+        if current is not None and current.size == count:
+            current.loaded_at = time.monotonic()
+            self.refreshes += 1
+            return current
+
+        snapshot = self.load_snapshot(user_id)
+        if snapshot is not None and snapshot.size == count:
+            self.snapshot_loads += 1
+            return snapshot
+
+        ids, rows, meta = [], [], []
+        async for doc in messages_collection.find(query, MEMORY_PROJECTION):
+            ids.append(doc["_id"])
+            rows.append(doc["embedding"])
+            meta.append(self._meta(doc))
+        matrix = np.asarray(rows, dtype=np.float32).reshape(len(rows), -1) if rows else \
+            np.zeros((0, settings.embedding_dimensions), dtype=np.float32)
+        self.loads += 1
+        return UserVectors(ids, _normalize_rows(matrix), meta)
+
+    @staticmethod
+    def _meta(doc: dict) -> dict:
+        timestamp = doc.get("timestamp")
+        return {
+            "text": doc.get("text"),
+            "sender": doc.get("sender"),
+            "source": doc.get("source"),
+            "timestamp": timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp,
+        }
+
+    def on_vectors(self, docs: List[dict], vectors: List[List[float]]) -> None:
+        """Embedding worker listener: extend the matrices of users already loaded."""
+        for doc, vector in zip(docs, vectors):
+            user_vectors = self._users.get(doc["user_id"])
+            if user_vectors is None:
+                continue
+            if user_vectors.size >= self.max_vectors_per_user:
+                del self._users[doc["user_id"]]
+                self._oversized[doc["user_id"]] = True
+                continue
+            user_vectors.add(doc["_id"], np.asarray(vector, dtype=np.float32), self._meta(doc))
+
+    def _snapshot_paths(self, user_id: ObjectId) -> tuple:
+        base = os.path.join(self.snapshot_dir, str(user_id))
+        return f"{base}.npy", f"{base}.json"
+
+    def save_snapshot(self, user_id: ObjectId, vectors: UserVectors) -> None:
+        if not self.snapshot_dir or vectors.size == 0:
+            return
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            matrix_path, meta_path = self._snapshot_paths(user_id)
+            # Write then rename so a crash never leaves a torn snapshot behind
+            np.save(f"{matrix_path}.tmp.npy", np.ascontiguousarray(vectors.matrix))
+            with open(f"{meta_path}.tmp", "w") as f:
+                json.dump({"ids": [str(i) for i in vectors.ids], "meta": vectors.meta}, f)
+            os.replace(f"{matrix_path}.tmp.npy", matrix_path)
+            os.replace(f"{meta_path}.tmp", meta_path)
+        except OSError as e:
+            logger.error("Failed to save vector snapshot for user %s: %s", user_id, str(e))
+
+    def load_snapshot(self, user_id: ObjectId) -> Optional[UserVectors]:
+        if not self.snapshot_dir:
+            return None
+        matrix_path, meta_path = self._snapshot_paths(user_id)
+        if not (os.path.exists(matrix_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            matrix = np.load(matrix_path, mmap_mode="r")
+            with open(meta_path) as f:
+                data = json.load(f)
+            ids = [ObjectId(i) for i in data["ids"]]
+            if len(ids) != len(matrix):
+                return None
+            return UserVectors(ids, matrix, data["meta"])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable vector snapshot for user %s: %s", user_id, str(e))
+            return None
+
+    def save_snapshots(self) -> None:
+        for user_id, vectors in self._users.items():
+            self.save_snapshot(user_id, vectors)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._users),
+            "vectors": sum(vectors.size for vectors in self._users.values()),
+            "oversized_users": len(self._oversized),
+            "hits": self.hits,
+            "loads": self.loads,
+            "refreshes": self.refreshes,
+            "snapshot_loads": self.snapshot_loads,
+            "qdrant_fallbacks": self.fallbacks,
+        }
+
+
+vector_index = VectorIndex(
+    settings.memory_index_max_users,
+    settings.memory_index_max_vectors_per_user,
+    settings.memory_index_ttl_seconds,
+    settings.memory_snapshot_dir,
+)
+
+
+async def _search_qdrant(user_id: ObjectId, query: List[float], k: int) -> List[dict]:
+    qdrant = embedding_worker.qdrant
+    if not qdrant:
+        return []
+    response = await qdrant.client.query_points(
+        collection_name=qdrant.collection,
+        query=query,
+        query_filter=qdrant_models.Filter(must=[
+            qdrant_models.FieldCondition(key="user_id", match=qdrant_models.MatchValue(value=str(user_id)))
+        ]),
+        limit=k
+    )
+    scores = {ObjectId(point.payload["message_id"]): point.score for point in response.points}
+    docs = messages_collection.find({"_id": {"$in": list(scores)}}, {"embedding": 0})
+    results = [{**VectorIndex._meta(doc), "score": scores[doc["_id"]]} async for doc in docs]
+    return sorted(results, key=lambda result: result["score"], reverse=True)
+
+
+async def retrieve_relevant_messages(user_id: ObjectId, query_text: str, k: Optional[int] = None) -> List[dict]:
+    """
+    Find the user's past messages most similar to `query_text`.
+    Args:
+        user_id: The user's ID
+        query_text: Text to compare against, usually the latest user message
+        k: Number of messages to return (default: settings.memory_retrieval_top_k)
+    Returns:
+        Dicts with text, sender, source, timestamp and score, most similar first
+    """
+    k = k or settings.memory_retrieval_top_k
+    if not query_text:
+        return []
+    query = (await get_embedder().embed([query_text]))[0]
+
+    user_vectors = await vector_index.get(user_id)
+    if user_vectors is None:
+        vector_index.fallbacks += 1
+        return await _search_qdrant(user_id, query, k)
+
+    return [{**meta, "score": score} for _, score, meta in user_vectors.search(np.asarray(query, dtype=np.float32), k)]
+
+
+async def recall_memories(user_id: ObjectId, query_text: str) -> List[dict]:
+    """
+    retrieve_relevant_messages for the reply path: nothing while the
+    embedding worker is disabled (no vectors are stored), and a failed or
+    slow retrieval (past memory_retrieval_timeout_seconds, e.g. a stalled
+    embeddings request) only costs the reply its memories.
+    """
+    if not settings.embedding_worker_enabled:
+        return []
+    try:
+        return await asyncio.wait_for(
+            retrieve_relevant_messages(user_id, query_text), settings.memory_retrieval_timeout_seconds)
+    except asyncio.TimeoutError:
+        logger.warning("Memory retrieval for user %s timed out after %ss",
+                       user_id, settings.memory_retrieval_timeout_seconds)
+        return []
+    except Exception as e:
+        logger.warning("Memory retrieval failed for user %s: %s", user_id, str(e))
+        return []
+
+
+def start() -> None:
+    embedding_worker.add_vector_listener(vector_index.on_vectors)
+
+
+def stop() -> None:
+    vector_index.save_snapshots()
@@ -0,0 +1,142 @@
+"""
+Maintains a rolling summary of each user's conversation on the user document.
+"""
+import asyncio
+from typing import Dict, List, Optional, Set
+import logging
+from bson import ObjectId
+from db import messages_collection
+from config import get_settings
+from models.message import Message
+from models.user import User
+from services.context_builder import count_tokens, SUMMARY_PREFIX
+from services.message_service import HISTORY_PROJECTION, add_message_listener, remove_message_listener, conversation_buffer
+from services.llm_gateway import complete_text, PRIORITY_BACKGROUND
+from services.prompts import PRIM_CONVERSATION_SUMMARY
+from services.user_service import get_user_by_id, update_user_and_get
+
+settings = get_settings()
+
+# Messages and tokens stored per user since the last summary was scheduled
+_pending_messages: Dict[ObjectId, int] = {}
+_pending_tokens: Dict[ObjectId, int] = {}
+_running: Dict[ObjectId, asyncio.Task] = {}
+_tasks: Set[asyncio.Task] = set()
+
+
+def on_messages_stored(user_id: ObjectId, messages: List[Message]) -> None:
+    """
+    Message listener: schedule a summary update once enough new messages
+    or tokens have accumulated for the user.
+    """
+    _pending_messages[user_id] = _pending_messages.get(user_id, 0) + len(messages)
+    _pending_tokens[user_id] = _pending_tokens.get(user_id, 0) + sum(count_tokens(m.text) for m in messages)
+
+    if (_pending_messages[user_id] >= settings.summary_message_threshold
+            or _pending_tokens[user_id] >= settings.summary_token_threshold):
+        schedule_summary(user_id)
+
+
+def schedule_summary(user_id: ObjectId) -> None:
+    if user_id in _running:
+        return
+    _pending_messages.pop(user_id, None)
+    _pending_tokens.pop(user_id, None)
+
+    task = asyncio.get_running_loop().create_task(_run_summary(user_id))
+    _running[user_id] = task
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _run_summary(user_id: ObjectId) -> None:
+    try:
+        await update_conversation_summary(user_id)
+    except Exception:
+        logging.exception("Failed to update conversation summary for user %s", user_id)
+    finally:
+        _running.pop(user_id, None)
+
+
+async def update_conversation_summary(user_id: ObjectId) -> Optional[User]:
+    """
+    Fold the user's messages not yet marked `summarized` into their
+    rolling summary, one batch of `summary_batch_size` messages at a time.
+    Args:
+        user_id: The user's ID
+    Returns:
+        The updated User, or None if there was nothing to fold in
+    """
+    user = await get_user_by_id(user_id)
+    if not user:
+        return None
+    updated = None
+    while True:
+        # Flags rather than a timestamp checkpoint: call transcripts are stored
+        # after the fact with their original, earlier timestamps
+        query = {"user_id": user_id, "summarized": {"$ne": True}}
+        cursor = messages_collection.find(query, HISTORY_PROJECTION).sort(
+            [("timestamp", 1), ("_id", 1)]).limit(settings.summary_batch_size)
+        messages = []
+        async for doc in cursor:
+            # Handle legacy messages without sender field
+            if "sender" not in doc:
+                doc["sender"] = "assistant" if doc.get("source") == "whatsapp" else "user"
+            messages.append(Message(**doc))
+        if not messages:
+            return updated
+
+        summary = await summarize_messages(user.conversation_summary, messages)
+        user = await update_user_and_get(user_id, {"conversation_summary": summary})
+        if not user:
+            return updated
+        updated = user
+        # Marked after the summary is saved: a crash in between folds the batch in twice rather than never
+        await messages_collection.update_many(
+            {"_id": {"$in": [message.id for message in messages]}}, {"$set": {"summarized": True}})
+        # Buffered copies still carry the old flags
+        conversation_buffer.invalidate(user_id)
+        logging.info("Folded %s messages into conversation summary for user %s", len(messages), user_id)
+
+        if len(messages) < settings.summary_batch_size:
+            return updated
+
+
+async def summarize_messages(summary: Optional[str], messages: List[Message]) -> str:
+    """
+    Produce a new summary from the previous one and the messages since.
+    """
+    transcript = "\n".join(f"{m.sender} ({m.source}): {m.text}" for m in messages)
+    content = f"Current summary:\n{summary or '(none yet)'}\n\nNew messages:\n{transcript}"
+
+    return await complete_text(
+        [
+            {"role": "system", "content": PRIM_CONVERSATION_SUMMARY},
+            {"role": "user", "content": content}
+        ],
+        model=settings.summary_model,
+        priority=PRIORITY_BACKGROUND,
+        max_tokens=settings.summary_max_tokens,
+        temperature=0.2
+    )
+
+
+def append_conversation_summary(system_prompt: str, user: Optional[User]) -> str:
+    """
+    Append the user's rolling summary to a system prompt, e.g. for a VAPI
+    assistant config that only takes a single system message.
+    """
+    if not user or not user.conversation_summary:
+        return system_prompt
+    return f"{system_prompt}\n\n{SUMMARY_PREFIX}{user.conversation_summary}"
+
+
+def start() -> None:
+    add_message_listener(on_messages_stored)
+
+
+async def stop() -> None:
+    remove_message_listener(on_messages_stored)
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
@@ -0,0 +1,290 @@
+"""
+Delayed actions ("call again in 20 minutes", "nudge tomorrow"), stored in
+the timers collection and turned into jobs when they come due.
+
+Timers can be scheduled days ahead, so they live in Mongo indexed on
+due_at. Each scheduler periodically claims the timers due within
+timer_lookahead_seconds, in batches, and keeps them in an in-memory
+hierarchical timing wheel that it advances once per tick; only the
+claimed, near-term timers are ever looked at again. A claim expires a
+little after the lookahead window, so timers held by a scheduler that
+died are picked up by another one. Due timers are dispatched
+concurrently by enqueueing their job (services/job_queue.py).
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from db import timers_collection
+from config import get_settings
+from services.job_queue import enqueue
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+def epoch_seconds(value: datetime) -> float:
+    """Epoch seconds of a naive UTC datetime, as stored in Mongo."""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel: level 0 has `slots` buckets of one tick,
+    each higher level has `slots` buckets spanning a full turn of the level
+    below. Adding and expiring a timer are O(1); timers on higher levels
+    cascade down as their bucket comes up.
+    """
+
+    def __init__(self, tick_seconds: float, slots: int, levels: int, now: float):
+        self.tick_seconds = tick_seconds
+        self.slots = slots
+        self.levels = levels
+        self._wheels: List[List[list]] = [[[] for _ in range(slots)] for _ in range(levels)]
+        # The next tick to expire
+        self._tick = int(now // tick_seconds)
+        self.size = 0
+
+    @property
+    def horizon_seconds(self) -> float:
+        """How far ahead of the current tick a timer can be added."""
+        return self.tick_seconds * self.slots ** self.levels - self.tick_seconds * self.slots ** (self.levels - 1)
+
+    def add(self, due: float, item: Any) -> bool:
+        """
+        Add `item` to expire at epoch seconds `due` (overdue items expire on
+        the next advance).
+        Returns:
+            False if `due` is beyond the wheel's horizon
+        """
+        tick = max(int(due // self.tick_seconds), self._tick)
+        for level in range(self.levels):
+            unit = self.slots ** level
+            if tick // unit - self._tick // unit < self.slots:
+                self._wheels[level][(tick // unit) % self.slots].append((tick, item))
+                self.size += 1
+                return True
+        return False
+
+    def advance(self, now: float) -> list:
+        """Advance to epoch seconds `now` and return the items that expired."""
+        expired = []
+        target = int(now // self.tick_seconds)
+        while self._tick <= target:
+            # Move the bucket of each higher level whose turn starts now down a level
+            for level in range(self.levels - 1, 0, -1):
+                unit = self.slots ** level
+                if self._tick % unit:
+                    continue
+                slot = (self._tick // unit) % self.slots
+                bucket, self._wheels[level][slot] = self._wheels[level][slot], []
+                for tick, item in bucket:
+                    self.size -= 1
+                    self.add(tick * self.tick_seconds, item)
+            slot = self._tick % self.slots
+            bucket, self._wheels[0][slot] = self._wheels[0][slot], []
+            expired.extend(item for _, item in bucket)
+            self.size -= len(bucket)
+            self._tick += 1
+        return expired
+
+
+class TimerScheduler:
+    def __init__(self, tick_seconds: float, slots: int, lookahead_seconds: float, load_interval: float,
+                 batch_size: int, dispatch_concurrency: int):
+        self.tick_seconds = tick_seconds
+        self.slots = slots
+        self.lookahead_seconds = lookahead_seconds
+        self.load_interval = load_interval
+        self.batch_size = batch_size
+        self.dispatch_concurrency = dispatch_concurrency
+        self.owner = uuid.uuid4().hex
+        self.wheel: Optional[TimingWheel] = None
+        # Timers due up to here have been claimed by this scheduler
+        self.loaded_until: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        self.loaded = 0
+        self.dispatched = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self) -> None:
+        if self._task is None:
+            self.wheel = TimingWheel(self.tick_seconds, self.slots, 2, time.time())
+            self.lookahead_seconds = min(self.lookahead_seconds, self.wheel.horizon_seconds)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def claim_until(self) -> datetime:
+        # Outlives the window so a claimed timer is dispatched before anyone else can claim it
+        return self.loaded_until + timedelta(seconds=self.load_interval + settings.timer_claim_grace_seconds)
+
+    def accepts(self, due_at: datetime) -> bool:
+        """Whether a new timer falls inside the window this scheduler has loaded."""
+        return self.running and self.loaded_until is not None and due_at <= self.loaded_until
+
+    def add(self, timer_id: ObjectId, due_at: datetime) -> None:
+        if not self.wheel.add(epoch_seconds(due_at), timer_id):
+            logger.warning("Timer %s is beyond the timing wheel's horizon", timer_id)
+
+    async def load(self) -> int:
+        """
+        Claim timers due within the lookahead window, a batch at a time, and
+        add them to the wheel. Timers whose claim lapsed are claimed again.
+        Returns:
+            Number of timers claimed
+        """
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=self.lookahead_seconds)
+        self.loaded_until = until
+        claim_until = self.claim_until()
+        unclaimed = {"due_at": {"$lte": until}, "claimed_until": {"$not": {"$gt": now}}}
+        claimed = 0
+        while True:
+            ids = [doc["_id"] async for doc in timers_collection.find(unclaimed, {"_id": 1})
+                   .sort("due_at", 1).limit(self.batch_size)]
+            if not ids:
+                break
+            await timers_collection.update_many(
+                {"_id": {"$in": ids}, **unclaimed},
+                {"$set": {"claimed_by": self.owner, "claimed_until": claim_until}}
+            )
+            async for doc in timers_collection.find(
+                    {"_id": {"$in": ids}, "claimed_by": self.owner}, {"due_at": 1}):
+                self.add(doc["_id"], doc["due_at"])
+                claimed += 1
+            if len(ids) < self.batch_size:
+                break
+        self.loaded += claimed
+        return claimed
+
+    async def dispatch(self, timer_id: ObjectId) -> None:
+        """Enqueue a due timer's job, then delete the timer."""
+        doc = await timers_collection.find_one({"_id": timer_id, "claimed_by": self.owner})
+        if not doc:
+            # Cancelled, or rescheduled and claimed again
+            return
+        if doc["due_at"] > datetime.utcnow() + timedelta(seconds=self.tick_seconds):
+            self.add(timer_id, doc["due_at"])
+            return
+        # The job's dedupe key makes a dispatch repeated after a crash a no-op
+        await enqueue(doc["type"], doc.get("payload") or {},
+                      dedupe_key=f"timer:{timer_id}:{epoch_seconds(doc['due_at'])}")
+        await timers_collection.delete_one({"_id": timer_id, "claimed_by": self.owner, "due_at": doc["due_at"]})
+        self.dispatched += 1
+
+    async def _dispatch_all(self, timer_ids: List[ObjectId]) -> None:
+        semaphore = asyncio.Semaphore(self.dispatch_concurrency)
+
+        async def dispatch_one(timer_id: ObjectId) -> None:
+            async with semaphore:
+                try:
+                    await self.dispatch(timer_id)
+                except Exception as e:
+                    # Left in place; it is claimed again once the claim lapses
+                    self.failed += 1
+                    logger.error("Failed to dispatch timer %s: %s", timer_id, str(e))
+
+        await asyncio.gather(*(dispatch_one(timer_id) for timer_id in timer_ids))
+
+    async def _run(self) -> None:
+        next_load = 0.0
+        while True:
+            if time.monotonic() >= next_load:
+                try:
+                    await self.load()
+                except Exception as e:
+                    logger.error("Failed to load timers: %s", str(e))
+                next_load = time.monotonic() + self.load_interval
+            due = self.wheel.advance(time.time())
+            if due:
+                await self._dispatch_all(due)
+            await asyncio.sleep(self.tick_seconds - time.time() % self.tick_seconds)
+
+    async def stop(self) -> None:
+        """Stop dispatching. Claimed timers are picked up elsewhere once their claim lapses."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self.loaded_until = None
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "pending": self.wheel.size if self.wheel else 0,
+            "loaded": self.loaded,
+            "dispatched": self.dispatched,
+            "failed": self.failed,
+        }
+
+
+timer_scheduler = TimerScheduler(
+    settings.timer_tick_seconds,
+    settings.timer_wheel_slots,
+    settings.timer_lookahead_seconds,
+    settings.timer_load_interval_seconds,
+    settings.timer_batch_size,
+    settings.timer_dispatch_concurrency,
+)
+
+
+async def schedule_timer(
+    job_type: str,
+    payload: Optional[Dict[str, Any]] = None,
+    delay: float = 0.0,
+    dedupe_key: Optional[str] = None,
+    replace: bool = False,
+) -> Optional[ObjectId]:
+    """
+    Enqueue a job of `job_type` after `delay` seconds.
+    Args:
+        job_type: Name the job handler was registered under
+        payload: Arguments for the job handler
+        delay: Seconds from now
+        dedupe_key: Identifies the timer; another timer with the same key isn't scheduled
+        replace: With a dedupe_key, move an existing timer to the new time and payload instead
+    Returns:
+        The timer's ID, or None if a timer with `dedupe_key` already exists
+    """
+    due_at = datetime.utcnow() + timedelta(seconds=delay)
+    doc: Dict[str, Any] = {"type": job_type, "payload": payload or {}, "due_at": due_at}
+    if timer_scheduler.accepts(due_at):
+        # Already inside our loaded window; nobody else would pick it up in time
+        doc.update(claimed_by=timer_scheduler.owner, claimed_until=timer_scheduler.claim_until())
+
+    if dedupe_key and replace:
+        update = {"$set": doc, "$setOnInsert": {"created_at": datetime.utcnow()}}
+        if "claimed_by" not in doc:
+            update["$unset"] = {"claimed_by": "", "claimed_until": ""}
+        result = await timers_collection.find_one_and_update(
+            {"dedupe_key": dedupe_key}, update, upsert=True, projection={"_id": 1},
+            return_document=ReturnDocument.AFTER)
+        timer_id = result["_id"]
+    else:
+        doc.update(created_at=datetime.utcnow(), **({"dedupe_key": dedupe_key} if dedupe_key else {}))
+        try:
+            timer_id = (await timers_collection.insert_one(doc)).inserted_id
+        except DuplicateKeyError:
+            return None
+
+    if "claimed_by" in doc:
+        timer_scheduler.add(timer_id, due_at)
+    return timer_id
+
+
+async def cancel_timer(dedupe_key: str) -> bool:
+    result = await timers_collection.delete_one({"dedupe_key": dedupe_key})
+    return bool(result.deleted_count)
+
+
+def get_timer_stats() -> dict:
+    return timer_scheduler.stats()
@@ -1,10 +1,24 @@
-from typing import Optional
+from typing import Optional, Dict, Tuple
+from collections import OrderedDict
 import logging
+import time
 from bson import ObjectId
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from models.user import User
 from db import users_collection
+from config import get_settings
 from datetime import datetime
 
+settings = get_settings()
+
+# Fields holding the normalized form of `phone` and `call_phone`. They are
+# backed by indexes (see db.ensure_indexes) so lookups never scan the collection.
+NORMALIZED_PHONE_FIELDS = {
+    "phone": "normalized_phone",
+    "call_phone": "normalized_call_phone",
+}
+
 
 def clean_phone_number(phone: str) -> str:
     """
@@ -34,6 +48,147 @@ def normalize_phone_number(phone: str) -> str:
     return digits
 
 
+class UserCache:
+    """
+    Bounded TTL + LRU cache of User objects for this process.
+    Entries are stored once by _id and reachable through secondary keys
+    (normalized phone, normalized call phone and email). Writes made
+    through this module refresh or invalidate entries; the TTL bounds how
+    stale an entry can get when another instance updates the user.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[ObjectId, tuple[float, User]]" = OrderedDict()
+        self._keys: Dict[str, ObjectId] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _secondary_keys(user: User) -> list[str]:
+        keys = []
+        for field in NORMALIZED_PHONE_FIELDS:
+            phone = getattr(user, field)
+            normalized_phone = normalize_phone_number(phone) if phone else ""
+            if normalized_phone:
+                keys.append(f"{field}:{normalized_phone}")
+        if user.email:
+            keys.append(f"email:{user.email}")
+        return keys
+
+    def _lookup(self, user_id: Optional[ObjectId]) -> Optional[User]:
+        entry = self._entries.get(user_id) if user_id is not None else None
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            self.invalidate(user_id)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return user
+
+    def get_by_id(self, user_id: ObjectId) -> Optional[User]:
+        return self._lookup(user_id)
+
+    def get_by_phone(self, phone: str) -> Optional[User]:
+        normalized_phone = normalize_phone_number(phone)
+        user_ids = {self._keys.get(f"{field}:{normalized_phone}") for field in NORMALIZED_PHONE_FIELDS} - {None}
+        if len(user_ids) > 1:
+            # One user's phone is another's call phone; let Mongo decide
+            self.misses += 1
+            return None
+        return self._lookup(next(iter(user_ids), None))
+
+    def get_by_email(self, email: str) -> Optional[User]:
+        return self._lookup(self._keys.get(f"email:{email}"))
+
+    def put(self, user: User) -> None:
+        if self.max_size <= 0:
+            return
+        # Drop keys from the previous version (e.g. an email that changed)
+        self.invalidate(user.id)
+        self._entries[user.id] = (time.monotonic() + self.ttl_seconds, user)
+        for key in self._secondary_keys(user):
+            self._keys[key] = user.id
+        while len(self._entries) > self.max_size:
+            oldest_id = next(iter(self._entries))
+            self.invalidate(oldest_id)
+
+    def invalidate(self, user_id: ObjectId) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return
+        for key in self._secondary_keys(entry[1]):
+            if self._keys.get(key) == user_id:
+                del self._keys[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._keys.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+user_cache = UserCache(settings.user_cache_max_size, settings.user_cache_ttl_seconds)
+
+
+def get_user_cache_stats() -> dict:
+    """
+    Hit/miss counters for the in-process user cache.
+    """
+    return user_cache.stats()
+
+
+def normalized_phone_fields(data: dict) -> dict:
+    """
+    Build the normalized phone fields for any phone fields present in `data`.
+    Args:
+        data: User fields, e.g. {"phone": "whatsapp:+16505551234"}
+    Returns:
+        Dictionary of normalized fields to store alongside the raw ones
+    """
+    normalized = {}
+    for field, normalized_field in NORMALIZED_PHONE_FIELDS.items():
+        if data.get(field):
+            normalized_value = normalize_phone_number(data[field])
+            if normalized_value:
+                normalized[normalized_field] = normalized_value
+    return normalized
+
+
+def phone_lookup_query(phone: str) -> Optional[dict]:
+    """
+    Build the indexed query matching a user on either normalized phone field.
+    Args:
+        phone: Phone number string in any format
+    Returns:
+        MongoDB filter, or None if the phone number has no digits
+    """
+    normalized_phone = normalize_phone_number(phone)
+    if not normalized_phone:
+        return None
+    return {
+        "$or": [
+            {"normalized_phone": normalized_phone},
+            {"normalized_call_phone": normalized_phone},
+        ],
+        # Unmerged duplicates found by backfill_normalized_phones
+        "duplicate_of": {"$exists": False},
+    }
+
+
 async def get_user_by_phone(phone: str) -> Optional[User]:
     """
     Get user by phone number, handling various phone number formats.
@@ -42,23 +197,94 @@ async def get_user_by_phone(phone: str) -> Optional[User]:
     Returns:
         User object if found, None otherwise
     """
-    normalized_phone = normalize_phone_number(phone)
+    user = user_cache.get_by_phone(phone)
+    if user:
+        return user
 
-    # Get all users and compare normalized phone numbers
-    async for user_data in users_collection.find({}):
-        # Normalize stored phone numbers
-        stored_phone = normalize_phone_number(user_data.get('phone', ''))
-        stored_call_phone = normalize_phone_number(
-            user_data.get('call_phone', ''))
-
-        # Check if either normalized phone matches
-        if stored_phone == normalized_phone or stored_call_phone == normalized_phone:
-            return User(**user_data)
+    query = phone_lookup_query(phone)
+    if query:
+        user_data = await users_collection.find_one(query)
+        if user_data:
+            user = User(**user_data)
+            user_cache.put(user)
+            return user
 
     logging.warning(f"User not found for phone: {phone}")
     return None
 
 
+async def backfill_normalized_phones(batch_size: int = 500) -> int:
+    """
+    Populate normalized phone fields on users created before they existed.
+    Safe to run repeatedly: only documents missing the fields are touched.
+
+    Users whose phone numbers only differed in formatting (e.g.
+    "whatsapp:+1555..." and "+1555...") normalize to the same value, which
+    the unique normalized_phone index can't hold. The user already holding
+    the value, or else the oldest one, keeps it; the others are marked
+    `duplicate_of` that user, left without normalized_phone and logged for
+    a manual merge.
+    Args:
+        batch_size: Number of updates sent per bulk write
+    Returns:
+        Number of user documents updated
+    """
+    query = {
+        "$or": [
+            {"phone": {"$nin": [None, ""]}, "normalized_phone": {"$exists": False}, "duplicate_of": {"$exists": False}},
+            {"call_phone": {"$nin": [None, ""]}, "normalized_call_phone": {"$exists": False}},
+        ]
+    }
+    projection = {"created_at": 1, **{field: 1 for field in NORMALIZED_PHONE_FIELDS}}
+
+    pending = []
+    claimants: Dict[str, list] = {}
+    async for user_data in users_collection.find(query, projection):
+        normalized = normalized_phone_fields(user_data)
+        if not normalized:
+            continue
+        pending.append((user_data, normalized))
+        if "normalized_phone" in normalized:
+            claimants.setdefault(normalized["normalized_phone"], []).append(user_data)
+
+    # Who keeps each normalized phone: an existing holder, or the oldest claimant
+    owners = {}
+    async for user_data in users_collection.find(
+            {"normalized_phone": {"$in": list(claimants)}}, {"normalized_phone": 1}):
+        owners[user_data["normalized_phone"]] = user_data["_id"]
+    for normalized_phone, users in claimants.items():
+        if normalized_phone not in owners:
+            oldest = min(users, key=lambda user_data: (user_data.get("created_at") or datetime.min, user_data["_id"]))
+            owners[normalized_phone] = oldest["_id"]
+
+    updated = 0
+    duplicates = []
+    operations = []
+    for user_data, normalized in pending:
+        owner = owners.get(normalized.get("normalized_phone"))
+        if owner is not None and owner != user_data["_id"]:
+            del normalized["normalized_phone"]
+            normalized["duplicate_of"] = owner
+            duplicates.append((user_data["_id"], owner))
+        operations.append(UpdateOne({"_id": user_data["_id"]}, {"$set": normalized}))
+        if len(operations) >= batch_size:
+            result = await users_collection.bulk_write(operations, ordered=False)
+            updated += result.modified_count
+            operations = []
+
+    if operations:
+        result = await users_collection.bulk_write(operations, ordered=False)
+        updated += result.modified_count
+
+    if updated:
+        logging.info("Backfilled normalized phone fields for %s users", updated)
+    if duplicates:
+        logging.error(
+            "%s users share a normalized phone number with another user and need merging: %s",
+            len(duplicates), ", ".join(f"{user_id} (duplicate of {owner})" for user_id, owner in duplicates))
+    return updated
+
+
 async def get_user_by_email(email: str) -> Optional[User]:
     """
     Get user by email.
@@ -67,13 +293,42 @@ async def get_user_by_email(email: str) -> Optional[User]:
     Returns:
         User object if found, None otherwise
     """
+    user = user_cache.get_by_email(email)
+    if user:
+        return user
+
     user_data = await users_collection.find_one({"email": email})
     if user_data:
-        return User(**user_data)
+        user = User(**user_data)
+        user_cache.put(user)
+        return user
     return None
 
 
-async def create_user(phone: str, name: Optional[str] = None, email: Optional[str] = None, is_yc: bool = False) -> User:
+async def get_user_by_id(user_id: ObjectId) -> Optional[User]:
+    """
+    Get user by ID.
+    Args:
+        user_id: The user's ID
+    Returns:
+        User object if found, None otherwise
+    """
+    user = user_cache.get_by_id(user_id)
+    if user:
+        return user
+
+    user_data = await users_collection.find_one({"_id": user_id})
+    if user_data:
+        user = User(**user_data)
+        user_cache.put(user)
+        return user
+    return None
+
+
+def new_user_document(phone: str, name: Optional[str] = None, email: Optional[str] = None, is_yc: bool = False) -> dict:
+    """
+    Build the document stored for a new user.
+    """
     clean_phone = clean_phone_number(phone)
 
     # Create user data dictionary explicitly
@@ -87,6 +342,12 @@ async def create_user(phone: str, name: Optional[str] = None, email: Optional[st
         "onboarded": False,
         "created_at": datetime.utcnow()
     }
+    user_data.update(normalized_phone_fields(user_data))
+    return user_data
+
+
+async def create_user(phone: str, name: Optional[str] = None, email: Optional[str] = None, is_yc: bool = False) -> User:
+    user_data = new_user_document(phone, name=name, email=email, is_yc=is_yc)
 
     logging.info("Creating user with data: %s", user_data)
 
@@ -95,14 +356,57 @@ async def create_user(phone: str, name: Optional[str] = None, email: Optional[st
 
     # Create User instance from the inserted data
     user = User(**user_data, id=result.inserted_id)
-
-    # Verify the inserted document
-    inserted_user = await users_collection.find_one({"_id": result.inserted_id})
-    logging.info("Inserted user document: %s", inserted_user)
+    user_cache.put(user)
 
     return user
 
 
+async def get_or_create_user(phone: str, name: Optional[str] = None, email: Optional[str] = None, is_yc: bool = False) -> Tuple[User, bool]:
+    """
+    Get the user matching a phone number, creating it if it doesn't exist.
+    Uses a single upsert so concurrent webhooks for the same number resolve
+    to the same document instead of racing to insert duplicates.
+    Args:
+        phone: Phone number string in any format
+        name: Name for a newly created user (optional)
+        email: Email for a newly created user (optional)
+        is_yc: YC flag for a newly created user
+    Returns:
+        Tuple of the User and whether it was created by this call
+    """
+    user = user_cache.get_by_phone(phone)
+    if user:
+        return user, False
+
+    query = phone_lookup_query(phone)
+    if not query:
+        raise ValueError("Phone number is required")
+
+    user_data = new_user_document(phone, name=name, email=email, is_yc=is_yc)
+    user_data["_id"] = ObjectId()
+
+    try:
+        user_doc = await users_collection.find_one_and_update(
+            query,
+            {"$setOnInsert": user_data},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # A concurrent upsert inserted the user first; it now matches the query
+        user_doc = await users_collection.find_one(query)
+        if not user_doc:
+            raise
+
+    created = user_doc["_id"] == user_data["_id"]
+    if created:
+        logging.info("Created user with data: %s", user_doc)
+
+    user = User(**user_doc)
+    user_cache.put(user)
+    return user, created
+
+
 async def update_user_vapi_assistant(user_id: ObjectId, vapi_assistant_id: str) -> bool:
     result = await users_collection.update_one(
         {"_id": user_id},
@@ -113,6 +417,7 @@ async def update_user_vapi_assistant(user_id: ObjectId, vapi_assistant_id: str)
             }
         }
     )
+    user_cache.invalidate(user_id)
     return result.modified_count > 0
 
 
@@ -125,8 +430,34 @@ async def update_user(user_id: ObjectId, update_data: dict) -> bool:
     Returns:
         True if update was successful
     """
+    update_data = {**update_data, **normalized_phone_fields(update_data)}
     result = await users_collection.update_one(
         {"_id": user_id},
         {"$set": update_data}
     )
+    user_cache.invalidate(user_id)
     return result.modified_count > 0
+
+
+async def update_user_and_get(user_id: ObjectId, update_data: dict) -> Optional[User]:
+    """
+    Update user fields and return the updated user in the same round trip.
+    Args:
+        user_id: The user's ID
+        update_data: Dictionary of fields to update
+    Returns:
+        The updated User, or None if no user has this ID
+    """
+    update_data = {**update_data, **normalized_phone_fields(update_data)}
+    user_doc = await users_collection.find_one_and_update(
+        {"_id": user_id},
+        {"$set": update_data},
+        return_document=ReturnDocument.AFTER
+    )
+    if not user_doc:
+        user_cache.invalidate(user_id)
+        return None
+
+    user = User(**user_doc)
+    user_cache.put(user)
+    return user
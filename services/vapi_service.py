@@ -2,23 +2,53 @@ import httpx
 import logging
 from config import get_settings
 from typing import Optional, Dict, Any
+from services.http_clients import get_vapi_client
 
 # Create a logger for this module
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 settings = get_settings()
-VAPI_BASE_URL = "https://api.vapi.ai"
+
+
+def assistant_model(system_prompt: str, model: str = "gpt-4.1", user_id: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    The `model` section of a VAPI assistant config. With custom_llm_enabled,
+    VAPI sends each turn to our /custom-llm endpoint, which adds the user's
+    context and streams the reply; otherwise VAPI calls OpenAI directly.
+    Args:
+        system_prompt: The assistant's system prompt
+        model: The model to use
+        user_id: The user the call is with, if known (optional)
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    if not settings.custom_llm_enabled:
+        return {"provider": "openai", "model": model, "messages": messages}
+
+    url = settings.custom_llm_url or f"{settings.base_url}/api/v1/custom-llm"
+    if user_id:
+        url = f"{url.rstrip('/')}/{user_id}"
+    return {
+        "provider": "custom-llm",
+        "url": url,
+        "model": model,
+        "messages": messages,
+        # Authenticates VAPI to the endpoint, which serves users' health context
+        "headers": {"Authorization": f"Bearer {settings.custom_llm_secret}"},
+    }
+
 
 async def make_call(
     to_phone: str,
     system_prompt: str,
     first_message: str,
     model: str = "gpt-4.1",
+    user_id: Optional[Any] = None,
 ) -> str:
     """
     Initiate a call using VAPI with a temporary assistant.
     The assistant will be created for this specific call.
+    Pass `user_id` so a custom LLM assistant knows who it is talking to.
     Returns the call ID.
     """
     if not to_phone:
@@ -34,39 +64,32 @@ async def make_call(
     logging.info("Making VAPI call to %s (formatted from %s)", formatted_phone, to_phone)
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{VAPI_BASE_URL}/call",
-                headers={"Authorization": f"Bearer {settings.vapi_api_key}"},
-                json={
-                    "type": "outboundPhoneCall",
-                    "customer": {
-                        "number": formatted_phone,
+        client = get_vapi_client()
+        response = await client.post(
+            "/call",
+            json={
+                "type": "outboundPhoneCall",
+                "customer": {
+                    "number": formatted_phone,
+                },
+                "phoneNumberId": settings.vapi_phone_id,
+                "assistant": {
+                    "model": assistant_model(system_prompt, model, user_id),
+                    "firstMessage": first_message,
+                    "backgroundSound": "off",
+                    "voice": {
+                        "provider": "vapi",
+                        "voiceId": "Lily"
                     },
-                    "phoneNumberId": settings.vapi_phone_id,
-                    "assistant": {
-                        "model": {
-                            "provider": "openai",
-                            "model": model,
-                            "messages": [
-                                {"role": "system", "content": system_prompt}
-                            ]
-                        },
-                        "firstMessage": first_message,
-                        "backgroundSound": "off",
-                        "voice": {
-                            "provider": "vapi",
-                            "voiceId": "Lily"
-                        },
-                        "voicemailDetection": {
-                            "provider": "vapi",
-                        },
-                        **({"server": {"url": settings.vapi_webhook_url}} if settings.vapi_webhook_url else {}),
+                    "voicemailDetection": {
+                        "provider": "vapi",
                     },
-                }
-            )
-            response.raise_for_status()
-            return response.json()["id"]
+                    **({"server": {"url": settings.vapi_webhook_url}} if settings.vapi_webhook_url else {}),
+                },
+            }
+        )
+        response.raise_for_status()
+        return response.json()["id"]
     except httpx.HTTPError as e:
         error_detail = str(e)
         if isinstance(e, httpx.HTTPStatusError):
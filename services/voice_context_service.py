@@ -0,0 +1,214 @@
+"""
+Keeps a per-user voice context snapshot (greeting, summary and open tasks)
+ready for inbound calls.
+
+VAPI's assistant-request has to be answered within a tight deadline, so
+the snapshot is rebuilt in the background whenever messages are stored
+for a user, written to the voice_contexts collection and cached in memory.
+Answering assistant-request is then a single lookup.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+from bson import ObjectId
+from db import voice_contexts_collection
+from config import get_settings
+from models.message import Message
+from models.user import User
+from models.voice_context import VoiceContext
+from services.llm_gateway import complete_text, PRIORITY_BACKGROUND
+from services.message_service import add_message_listener, remove_message_listener, get_user_message_history
+from services.prompts import PRIM_VOICE_CONTEXT
+from services.user_service import get_user_by_id
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+DEFAULT_GREETING = "Hey there! It's Prim! How's everything going? Anything I can help you with?"
+NAMED_GREETING = "Hey there {name}! It's Prim! How's everything going? Anything I can help you with?"
+
+
+def default_greeting(user: Optional[User]) -> str:
+    if user and user.name:
+        return NAMED_GREETING.format(name=user.name.split()[0])
+    return DEFAULT_GREETING
+
+
+class VoiceContextCache:
+    """Bounded TTL + LRU cache of VoiceContext snapshots by user ID."""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[ObjectId, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: ObjectId) -> Optional[VoiceContext]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(user_id, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, context: VoiceContext) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[context.user_id] = (time.monotonic() + self.ttl_seconds, context)
+        self._entries.move_to_end(context.user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+voice_context_cache = VoiceContextCache(settings.voice_context_cache_size, settings.voice_context_cache_ttl_seconds)
+
+# Users with a rebuild waiting out the debounce delay or running
+_scheduled: Dict[ObjectId, asyncio.Task] = {}
+_tasks: Set[asyncio.Task] = set()
+rebuilds = 0
+failed_rebuilds = 0
+
+
+async def get_voice_context(user_id: ObjectId) -> Optional[VoiceContext]:
+    """
+    Return the user's voice context snapshot from memory, or from Mongo by
+    _id on a cache miss. None if it hasn't been built yet.
+    """
+    context = voice_context_cache.get(user_id)
+    if context is not None:
+        return context
+    doc = await voice_contexts_collection.find_one({"_id": user_id})
+    if not doc:
+        return None
+    context = VoiceContext(**doc)
+    voice_context_cache.put(context)
+    return context
+
+
+def on_messages_stored(user_id: ObjectId, messages: List[Message]) -> None:
+    """
+    Message listener: rebuild the user's snapshot
+    `voice_context_debounce_seconds` after the first new message, so a
+    burst of messages (or a call transcript) triggers one rebuild.
+    """
+    schedule_rebuild(user_id, settings.voice_context_debounce_seconds)
+
+
+def schedule_rebuild(user_id: ObjectId, delay: float = 0.0) -> None:
+    if user_id in _scheduled:
+        return
+    task = asyncio.get_running_loop().create_task(_rebuild_later(user_id, delay))
+    _scheduled[user_id] = task
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _rebuild_later(user_id: ObjectId, delay: float) -> None:
+    global rebuilds, failed_rebuilds
+    try:
+        await asyncio.sleep(delay)
+        # Messages stored from here on schedule another rebuild
+        _scheduled.pop(user_id, None)
+        await rebuild_voice_context(user_id)
+        rebuilds += 1
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        failed_rebuilds += 1
+        logger.exception("Failed to rebuild voice context for user %s", user_id)
+    finally:
+        if _scheduled.get(user_id) is asyncio.current_task():
+            _scheduled.pop(user_id, None)
+
+
+async def rebuild_voice_context(user_id: ObjectId) -> Optional[VoiceContext]:
+    """
+    Build the user's voice context snapshot from their rolling summary and
+    recent messages, and store it in Mongo and the cache.
+    Args:
+        user_id: The user's ID
+    Returns:
+        The new VoiceContext, or None if the user doesn't exist
+    """
+    user = await get_user_by_id(user_id)
+    if not user:
+        return None
+    history = await get_user_message_history(user_id, limit=settings.voice_context_history_messages)
+    history = history[-settings.voice_context_history_messages:]
+
+    transcript = "\n".join(f"{m.sender} ({m.source}): {m.text}" for m in history if m.text)
+    content = (
+        f"User's name: {user.name or 'unknown'}\n\n"
+        f"What Prim remembers:\n{user.conversation_summary or '(nothing yet)'}\n\n"
+        f"Recent messages:\n{transcript or '(none)'}"
+    )
+    raw = await complete_text(
+        [
+            {"role": "system", "content": PRIM_VOICE_CONTEXT},
+            {"role": "user", "content": content}
+        ],
+        model=settings.voice_context_model,
+        priority=PRIORITY_BACKGROUND,
+        response_format={"type": "json_object"},
+        max_tokens=400,
+        temperature=0.3
+    )
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        logger.warning("Voice context for user %s was not valid JSON, using defaults", user_id)
+        data = {}
+
+    open_tasks = data.get("open_tasks")
+    context = VoiceContext(
+        _id=user_id,
+        greeting=str(data.get("greeting") or default_greeting(user)),
+        summary=str(data.get("summary") or user.conversation_summary or "") or None,
+        open_tasks=[str(task) for task in open_tasks] if isinstance(open_tasks, list) else [],
+        through=history[-1].timestamp if history else None,
+    )
+    await voice_contexts_collection.replace_one(
+        {"_id": user_id}, context.model_dump(by_alias=True), upsert=True)
+    voice_context_cache.put(context)
+    return context
+
+
+def voice_system_prompt(system_prompt: str, context: Optional[VoiceContext]) -> str:
+    """Append a snapshot's summary and open tasks to a voice system prompt."""
+    if not context:
+        return system_prompt
+    sections = [system_prompt]
+    if context.summary:
+        sections.append(f"What you know about this caller:\n{context.summary}")
+    if context.open_tasks:
+        sections.append("Open tasks to follow up on:\n" + "\n".join(f"- {task}" for task in context.open_tasks))
+    return "\n\n".join(sections)
+
+
+def get_voice_context_stats() -> dict:
+    return {
+        **voice_context_cache.stats(),
+        "pending_rebuilds": len(_scheduled),
+        "rebuilds": rebuilds,
+        "failed_rebuilds": failed_rebuilds,
+    }
+
+
+def start() -> None:
+    add_message_listener(on_messages_stored)
+
+
+async def stop() -> None:
+    remove_message_listener(on_messages_stored)
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
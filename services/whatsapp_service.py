@@ -1,35 +1,376 @@
+"""
+Sends WhatsApp messages through Twilio.
+
+Every send goes through an outbound scheduler that keeps us under Twilio's
+throughput limits: a global token bucket caps messages per second across
+all recipients and a per-recipient bucket stops one conversation from
+hogging it. Buckets live in the process, so the account-wide rate is split
+evenly across the `whatsapp_send_processes` processes that send (the web
+app and `python -m worker`). Conversational replies are sent ahead of notifications, each
+recipient's messages go out one at a time in the order they were queued,
+and 429/503 responses are retried after the delay Twilio asks for.
+"""
+import asyncio
+import heapq
+import itertools
 import logging
+import math
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set
 import httpx
 from config import get_settings
+from services.http_clients import get_twilio_client
+
+TWILIO_API_PATH = "/2010-04-01/Accounts"
+
+# Lanes, lowest first: replies in an active conversation go before notifications
+PRIORITY_REPLY = 0
+PRIORITY_NOTIFICATION = 1
+PRIORITY_NAMES = {PRIORITY_REPLY: "reply", PRIORITY_NOTIFICATION: "notification"}
+RETRYABLE_STATUS_CODES = {429, 503}
+LATENCY_SAMPLES = 1000
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+async def post_whatsapp_message(to: str, message: str) -> str:
+    """
+    Send a WhatsApp message with a single Twilio API request, bypassing the
+    outbound scheduler.
+    Returns the message ID.
+    """
+    client = get_twilio_client()
+
+    logging.info("Sending WhatsApp message to %s: %s", to, message)
+    try:
+        url = f"{TWILIO_API_PATH}/{settings.twilio_account_sid}/Messages.json"
+        data = {
+            "From": f"whatsapp:{settings.twilio_whatsapp_number}",
+            "To": to,
+            "Body": message
+        }
+
+        response = await client.post(url, data=data)
+        response.raise_for_status()
+        return response.json()["sid"]
+    except httpx.HTTPStatusError as e:
+        logging.error("Failed to send WhatsApp message: %s", str(e))
+        logging.error("Response content: %s", e.response.text)
+        raise
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
 
-TWILIO_API_URL = "https://api.twilio.com/2010-04-01/Accounts"
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        if self.tokens >= 1 or self.rate <= 0:
+            return 0.0
+        return (1 - self.tokens) / self.rate
 
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
 
-async def send_whatsapp_message(to: str, message: str) -> str:
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundMessage:
+    __slots__ = ("to", "body", "priority", "future", "queued_at", "attempts")
+
+    def __init__(self, to: str, body: str, priority: int, future: asyncio.Future):
+        self.to = to
+        self.body = body
+        self.priority = priority
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class OutboundScheduler:
+    """
+    Rate-limited, prioritized send queue.
+
+    Messages wait in a FIFO per recipient; only the head of each recipient's
+    queue is eligible, and only one message per recipient is in flight, so a
+    recipient always receives messages in the order they were queued. Eligible
+    recipients are ordered by the lane of their head message, then by arrival.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, str], Awaitable[str]],
+        rate_per_second: float,
+        burst: int,
+        recipient_rate_per_second: float,
+        recipient_burst: int,
+        concurrency: int,
+        max_retries: int,
+    ):
+        self._send = send
+        self._global = TokenBucket(rate_per_second, burst)
+        self.recipient_rate_per_second = recipient_rate_per_second
+        self.recipient_burst = recipient_burst
+        self.max_retries = max_retries
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._queues: Dict[str, Deque[OutboundMessage]] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._busy: Set[str] = set()
+        self._ready: List[tuple] = []    # (priority, seq, recipient)
+        self._delayed: List[tuple] = []  # (not_before, seq, recipient)
+        self._scheduled: Set[str] = set()
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sends: Set[asyncio.Task] = set()
+        self._closed = False
+        self._queue_latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self._send_latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def start(self) -> None:
+        if self._task is None:
+            self._closed = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def send(self, to: str, body: str, priority: int = PRIORITY_REPLY) -> str:
+        """
+        Queue a message and wait until Twilio has accepted it.
+        Returns:
+            The Twilio message SID
+        Raises:
+            RuntimeError: If the scheduler is shutting down
+            httpx.HTTPError: If Twilio rejected the message or retries ran out
+        """
+        if self._closed:
+            raise RuntimeError("WhatsApp outbound scheduler is shutting down")
+        self.start()
+
+        message = OutboundMessage(to, body, priority, asyncio.get_running_loop().create_future())
+        queue = self._queues.setdefault(to, deque())
+        queue.append(message)
+        if len(queue) == 1:
+            self._schedule(to)
+        return await message.future
+
+    def _schedule(self, to: str, not_before: float = 0.0) -> None:
+        if to in self._scheduled or to in self._busy or not self._queues.get(to):
+            return
+        self._scheduled.add(to)
+        if not_before > time.monotonic():
+            heapq.heappush(self._delayed, (not_before, next(self._seq), to))
+        else:
+            heapq.heappush(self._ready, (self._queues[to][0].priority, next(self._seq), to))
+        self._wakeup.set()
+
+    def _recipient_bucket(self, to: str) -> TokenBucket:
+        bucket = self._buckets.get(to)
+        if bucket is None:
+            bucket = self._buckets[to] = TokenBucket(self.recipient_rate_per_second, self.recipient_burst)
+        return bucket
+
+    async def _wait(self, timeout: Optional[float]) -> None:
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, to = heapq.heappop(self._delayed)
+                self._scheduled.discard(to)
+                self._schedule(to)
+
+            if now < self._paused_until:
+                await self._wait(self._paused_until - now)
+                continue
+            if not self._ready:
+                await self._wait(self._delayed[0][0] - now if self._delayed else None)
+                continue
+
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            priority, seq, to = self._ready[0]
+            recipient_wait = self._recipient_bucket(to).wait_time(now)
+            heapq.heappop(self._ready)
+            self._scheduled.discard(to)
+            if recipient_wait > 0:
+                self._schedule(to, now + recipient_wait)
+                continue
+
+            self._busy.add(to)
+            await self._slots.acquire()
+            self._global.take(time.monotonic())
+            self._recipient_bucket(to).take(time.monotonic())
+            task = asyncio.get_running_loop().create_task(self._deliver(self._queues[to][0]))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _deliver(self, message: OutboundMessage) -> None:
+        retry_at = 0.0
+        started = time.monotonic()
+        if message.attempts == 0:
+            self._queue_latencies.append(started - message.queued_at)
+        try:
+            sid = await self._send(message.to, message.body)
+            self._send_latencies.append(time.monotonic() - started)
+            self.sent += 1
+            self._finish(message, result=sid)
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if status in RETRYABLE_STATUS_CODES and message.attempts < self.max_retries:
+                message.attempts += 1
+                self.retried += 1
+                delay = retry_after_seconds(e.response) or min(60.0, 2 ** message.attempts) * random.uniform(0.5, 1.5)
+                retry_at = time.monotonic() + delay
+                if status == 429:
+                    # Twilio throttles per account, so hold every recipient back
+                    self.throttled += 1
+                    self._paused_until = max(self._paused_until, retry_at)
+                logger.warning("Twilio returned %s for %s, retrying in %.1fs", status, message.to, delay)
+            else:
+                self.failed += 1
+                self._finish(message, error=e)
+        except asyncio.CancelledError:
+            self._finish(message, error=RuntimeError("WhatsApp send cancelled"))
+            raise
+        except Exception as e:
+            self.failed += 1
+            self._finish(message, error=e)
+        finally:
+            self._busy.discard(message.to)
+            self._slots.release()
+            self._schedule(message.to, retry_at)
+
+    def _finish(self, message: OutboundMessage, result: Optional[str] = None, error: Optional[Exception] = None) -> None:
+        queue = self._queues.get(message.to)
+        if queue and queue[0] is message:
+            queue.popleft()
+        if not queue:
+            self._queues.pop(message.to, None)
+            bucket = self._buckets.get(message.to)
+            if bucket and bucket.is_full(time.monotonic()):
+                del self._buckets[message.to]
+        if message.future.done():
+            return
+        if error is not None:
+            message.future.set_exception(error)
+        else:
+            message.future.set_result(result)
+
+    async def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop accepting messages, give queued ones up to `timeout` seconds to
+        go out, then cancel the rest.
+        """
+        if self._task is None:
+            return
+        self._closed = True
+        deadline = time.monotonic() + (timeout or 0)
+        while (self._queues or self._sends) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._queues:
+            logger.warning("WhatsApp outbound scheduler stopped with %s messages unsent", self.depth)
+
+        self._task.cancel()
+        for task in list(self._sends):
+            task.cancel()
+        await asyncio.gather(self._task, *self._sends, return_exceptions=True)
+        for queue in self._queues.values():
+            for message in queue:
+                if not message.future.done():
+                    message.future.set_exception(RuntimeError("WhatsApp outbound scheduler stopped"))
+        self._queues.clear()
+        self._task = None
+
+    @staticmethod
+    def _percentiles(samples: Deque[float]) -> dict:
+        if not samples:
+            return {"p50_ms": None, "p95_ms": None}
+        ordered = sorted(samples)
+        return {
+            "p50_ms": round(ordered[math.ceil(len(ordered) * 0.5) - 1] * 1000, 1),
+            "p95_ms": round(ordered[math.ceil(len(ordered) * 0.95) - 1] * 1000, 1),
+        }
+
+    def stats(self) -> dict:
+        lanes = {name: 0 for name in PRIORITY_NAMES.values()}
+        for queue in self._queues.values():
+            for message in queue:
+                lane = PRIORITY_NAMES.get(message.priority, str(message.priority))
+                lanes[lane] = lanes.get(lane, 0) + 1
+        return {
+            "queue_depth": self.depth,
+            "queue_depth_by_lane": lanes,
+            "recipients_waiting": len(self._queues),
+            "in_flight": len(self._busy),
+            "paused_for_seconds": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "throttled": self.throttled,
+            "queue_latency": self._percentiles(self._queue_latencies),
+            "send_latency": self._percentiles(self._send_latencies),
+        }
+
+
+outbound = OutboundScheduler(
+    post_whatsapp_message,
+    rate_per_second=settings.whatsapp_send_rate_per_second / max(1, settings.whatsapp_send_processes),
+    burst=max(1, settings.whatsapp_send_burst // max(1, settings.whatsapp_send_processes)),
+    recipient_rate_per_second=settings.whatsapp_recipient_rate_per_second,
+    recipient_burst=settings.whatsapp_recipient_burst,
+    concurrency=settings.whatsapp_send_concurrency,
+    max_retries=settings.whatsapp_send_max_retries,
+)
+
+
+async def send_whatsapp_message(to: str, message: str, priority: int = PRIORITY_REPLY) -> str:
     """
     Send a WhatsApp message using Twilio's API.
     Args:
         to: The recipient's phone number (should include 'whatsapp:' prefix)
         message: The message text to send
+        priority: PRIORITY_REPLY (default) or PRIORITY_NOTIFICATION
     Returns the message ID.
     """
-    settings = get_settings()
+    return await outbound.send(to, message, priority)
 
-    async with httpx.AsyncClient() as client:
-        logging.info("Sending WhatsApp message to %s: %s", to, message)
-        try:
-            url = f"{TWILIO_API_URL}/{settings.twilio_account_sid}/Messages.json"
-            auth = (settings.twilio_account_sid, settings.twilio_auth_token)
-            data = {
-                "From": f"whatsapp:{settings.twilio_whatsapp_number}",
-                "To": to,
-                "Body": message
-            }
-
-            response = await client.post(url, auth=auth, data=data)
-            response.raise_for_status()
-            return response.json()["sid"]
-        except httpx.HTTPStatusError as e:
-            logging.error("Failed to send WhatsApp message: %s", str(e))
-            logging.error("Response content: %s", e.response.text)
-            raise
+
+def get_outbound_stats() -> dict:
+    return outbound.stats()
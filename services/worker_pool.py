@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a job can't be queued because the pool is saturated."""
+
+
+class WorkerPool:
+    """
+    In-process pool of asyncio workers fed by a bounded queue.
+    Webhook handlers submit the slow part of their work here so the HTTP
+    response can go out immediately. When the queue is full, submit() waits
+    up to `enqueue_timeout` seconds and then raises QueueFullError so the
+    caller can push back on the sender (e.g. return 503 and let it retry).
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queue_size: int, enqueue_timeout: float = 0.5):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.enqueue_timeout = enqueue_timeout
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._workers: List[asyncio.Task] = []
+        self._closed = False
+        self._in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def is_saturated(self) -> bool:
+        return self._queue.full()
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        self._closed = False
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"{self.name}-worker-{i}")
+            for i in range(self.concurrency)
+        ]
+        logger.info("Started %s worker pool with %s workers", self.name, self.concurrency)
+
+    async def submit(self, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> None:
+        """
+        Queue `func(*args, **kwargs)` to run on a worker.
+        Raises:
+            QueueFullError: If the pool is shutting down or stays full for `enqueue_timeout`
+        """
+        if self._closed:
+            self.rejected += 1
+            raise QueueFullError(f"{self.name} worker pool is shutting down")
+        if not self._workers:
+            await self.start()
+        try:
+            await asyncio.wait_for(self._queue.put((func, args, kwargs, time.monotonic())), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise QueueFullError(f"{self.name} worker pool queue is full")
+
+    async def _worker(self) -> None:
+        while True:
+            func, args, kwargs, queued_at = await self._queue.get()
+            self._in_flight += 1
+            try:
+                await func(*args, **kwargs)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Job %s failed in %s worker pool", getattr(func, "__name__", func), self.name)
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+                logger.debug("%s job finished %.3fs after being queued", self.name, time.monotonic() - queued_at)
+
+    async def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop accepting jobs, wait up to `timeout` seconds for queued and
+        running jobs to finish, then cancel the workers.
+        """
+        if not self._workers:
+            return
+        self._closed = True
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%s worker pool drain timed out with %s queued and %s running jobs",
+                           self.name, self.depth, self._in_flight)
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("Stopped %s worker pool", self.name)
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._workers),
+            "queue_depth": self.depth,
+            "queue_max_size": self._queue.maxsize,
+            "in_flight": self._in_flight,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,9 @@
+"""
+Unit tests for the in-process primitives; they don't touch Mongo or any
+external API. Settings are read when the services are imported, so the
+required ones get placeholder values here.
+"""
+import os
+
+for name in ("TWILIO_ACCOUNT_SID", "TWILIO_AUTH_TOKEN", "TWILIO_WHATSAPP_NUMBER", "VAPI_API_KEY", "OPENAI_API_KEY"):
+    os.environ.setdefault(name, "test")
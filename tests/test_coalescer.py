@@ -0,0 +1,94 @@
+import asyncio
+from typing import Any, List
+from services.coalescer import MessageCoalescer
+from services.worker_pool import QueueFullError
+
+
+class InlinePool:
+    """Stands in for a WorkerPool: runs each submitted batch as a task."""
+
+    def __init__(self, rejections: int = 0, on_reject=None):
+        self.rejections = rejections
+        self.on_reject = on_reject
+        self.tasks: List[asyncio.Task] = []
+
+    async def submit(self, func, *args: Any) -> None:
+        if self.rejections:
+            self.rejections -= 1
+            if self.on_reject:
+                self.on_reject()
+            raise QueueFullError("full")
+        self.tasks.append(asyncio.create_task(func(*args)))
+
+
+def test_burst_is_handled_as_one_batch_per_key():
+    batches = []
+
+    async def handler(key, items):
+        batches.append((key, items))
+
+    async def main():
+        pool = InlinePool()
+        # A long window: nothing goes out until drain() flushes it
+        coalescer = MessageCoalescer(pool, handler, window_seconds=60, max_wait_seconds=60)
+        for item in ("a", "b", "c"):
+            coalescer.add("user 1", item)
+        coalescer.add("user 2", "x")
+        await asyncio.sleep(0)
+        assert batches == []
+        await coalescer.drain(timeout=1)
+        await asyncio.gather(*pool.tasks)
+        assert coalescer.stats()["pending_keys"] == 0
+
+    asyncio.run(main())
+    assert sorted(batches) == [("user 1", ["a", "b", "c"]), ("user 2", ["x"])]
+
+
+def test_items_arriving_during_a_batch_form_the_next_one():
+    batches = []
+
+    async def main():
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def handler(key, items):
+            batches.append(items)
+            started.set()
+            await release.wait()
+
+        pool = InlinePool()
+        coalescer = MessageCoalescer(pool, handler, window_seconds=0, max_wait_seconds=0)
+        coalescer.add("user", "a")
+        await asyncio.wait_for(started.wait(), 1)
+        started.clear()
+        coalescer.add("user", "b")
+        coalescer.add("user", "c")
+        for _ in range(5):
+            await asyncio.sleep(0)
+        # Still busy with the first batch
+        assert batches == [["a"]]
+        release.set()
+        await asyncio.wait_for(started.wait(), 1)
+        await asyncio.gather(*pool.tasks)
+
+    asyncio.run(main())
+    assert batches == [["a"], ["b", "c"]]
+
+
+def test_batch_rejected_by_a_full_pool_is_retried_ahead_of_newer_items():
+    batches = []
+
+    async def handler(key, items):
+        batches.append(items)
+
+    async def main():
+        coalescer = None
+        pool = InlinePool(rejections=1, on_reject=lambda: coalescer.add("user", "b"))
+        coalescer = MessageCoalescer(pool, handler, window_seconds=0, max_wait_seconds=0)
+        coalescer.add("user", "a")
+        for _ in range(5):
+            await asyncio.sleep(0)
+        await coalescer.drain(timeout=1)
+        await asyncio.gather(*pool.tasks)
+
+    asyncio.run(main())
+    assert batches == [["a", "b"]]
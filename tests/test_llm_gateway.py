@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from services import llm_gateway
+from services.llm_gateway import CircuitBreaker, PrioritySemaphore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_gateway, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_breaker_lets_one_trial_through_per_reset_period(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    clock.now += 29.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()
+    # Half-open: only the one trial until another period has passed
+    assert not breaker.allow()
+    clock.now += 29.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()
+
+
+def test_failed_trial_keeps_breaker_open(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+    clock.now += 10
+    assert not breaker.allow()
+
+
+def test_successful_trial_closes_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_semaphore_wakes_lowest_priority_value_first():
+    order = []
+
+    async def waiter(semaphore: PrioritySemaphore, name: str, priority: int):
+        await semaphore.acquire(priority)
+        order.append(name)
+
+    async def main():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        tasks = [asyncio.create_task(waiter(semaphore, name, priority))
+                 for name, priority in (("background", 1), ("interactive", 0), ("background 2", 1))]
+        await asyncio.sleep(0)
+        assert semaphore.waiting == 3
+        for _ in tasks:
+            semaphore.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert order == ["interactive", "background", "background 2"]
+
+
+def test_semaphore_slot_granted_to_cancelled_waiter_is_handed_on():
+    async def main():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        cancelled = asyncio.create_task(semaphore.acquire())
+        await asyncio.sleep(0)
+        semaphore.release()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await asyncio.wait_for(semaphore.acquire(), 1)
+
+    asyncio.run(main())
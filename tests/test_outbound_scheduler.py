@@ -0,0 +1,55 @@
+import asyncio
+from services.whatsapp_service import OutboundScheduler, TokenBucket
+
+
+def test_bucket_starts_full_then_waits_for_a_refill():
+    bucket = TokenBucket(rate=2.0, capacity=3)
+    now = bucket.updated_at
+    for _ in range(3):
+        assert bucket.wait_time(now) == 0.0
+        bucket.take(now)
+    assert bucket.wait_time(now) == 0.5
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=2.0, capacity=3)
+    now = bucket.updated_at
+    for _ in range(3):
+        bucket.take(now)
+    assert bucket.wait_time(now + 0.25) == 0.25
+    assert bucket.wait_time(now + 0.5) == 0.0
+    bucket.take(now + 0.5)
+    assert bucket.wait_time(now + 0.5) == 0.5
+
+
+def test_bucket_refill_is_capped_at_capacity():
+    bucket = TokenBucket(rate=2.0, capacity=3)
+    now = bucket.updated_at
+    bucket.take(now)
+    assert not bucket.is_full(now)
+    assert bucket.is_full(now + 100)
+    assert bucket.tokens == 3
+
+
+def test_recipient_messages_go_out_one_at_a_time_in_order():
+    sent = []
+    in_flight = set()
+
+    async def send(to: str, body: str) -> str:
+        assert to not in in_flight
+        in_flight.add(to)
+        await asyncio.sleep(0)
+        in_flight.discard(to)
+        sent.append((to, body))
+        return f"SM{len(sent)}"
+
+    async def main():
+        scheduler = OutboundScheduler(
+            send, rate_per_second=1000, burst=1000, recipient_rate_per_second=1000, recipient_burst=1000,
+            concurrency=4, max_retries=0)
+        await asyncio.gather(*(scheduler.send(to, str(i)) for i in range(5) for to in ("a", "b")))
+        await scheduler.stop(timeout=1)
+
+    asyncio.run(main())
+    for to in ("a", "b"):
+        assert [body for recipient, body in sent if recipient == to] == ["0", "1", "2", "3", "4"]
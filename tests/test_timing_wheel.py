@@ -0,0 +1,59 @@
+from services.timer_service import TimingWheel
+
+# Two levels of four one-second slots: level 1 buckets span four ticks
+START = 100.0
+
+
+def make_wheel() -> TimingWheel:
+    return TimingWheel(tick_seconds=1.0, slots=4, levels=2, now=START)
+
+
+def test_timer_expires_on_its_tick():
+    wheel = make_wheel()
+    assert wheel.add(START + 2.5, "a")
+    assert wheel.advance(START + 1.9) == []
+    assert wheel.advance(START + 2.0) == ["a"]
+    assert wheel.size == 0
+
+
+def test_timers_cascade_down_and_expire_on_their_own_tick():
+    wheel = make_wheel()
+    # Everything past the first four ticks starts on level 1
+    for tick in range(100, 116):
+        assert wheel.add(tick + 0.5, tick)
+    assert wheel.size == 16
+
+    for tick in range(100, 116):
+        assert wheel.advance(float(tick)) == [tick]
+    assert wheel.advance(200.0) == []
+    assert wheel.size == 0
+
+
+def test_advancing_several_ticks_at_once_expires_in_due_order():
+    wheel = make_wheel()
+    wheel.add(START + 11, "later")
+    wheel.add(START + 5, "sooner")
+    assert wheel.advance(START + 20) == ["sooner", "later"]
+
+
+def test_overdue_timer_expires_on_next_advance():
+    wheel = make_wheel()
+    assert wheel.add(START - 30, "late")
+    assert wheel.advance(START) == ["late"]
+
+
+def test_timer_beyond_horizon_is_rejected():
+    wheel = make_wheel()
+    assert wheel.horizon_seconds == 12.0
+    assert wheel.add(START + wheel.horizon_seconds, "edge")
+    assert not wheel.add(START + 16, "too far")
+    assert wheel.size == 1
+
+
+def test_wheel_keeps_time_after_wrapping_around():
+    wheel = make_wheel()
+    wheel.advance(START + 37)
+    wheel.add(START + 47, "b")
+    wheel.add(START + 39, "a")
+    assert wheel.advance(START + 46) == ["a"]
+    assert wheel.advance(START + 47) == ["b"]
@@ -0,0 +1,59 @@
+"""
+Runs background jobs from the jobs collection, and the timer scheduler
+that turns due timers into jobs:
+
+    python -m worker
+
+Run as many workers as the job volume needs; they share the queue and the
+timers through Mongo leases, so webhook processes and job capacity scale
+independently.
+"""
+import asyncio
+import logging
+import signal
+import db
+from config import get_settings
+from services import http_clients
+from services.email_service import outbox
+from services.whatsapp_service import outbound
+from services.job_queue import job_worker
+from services.timer_service import timer_scheduler
+# Registers the job handlers
+import services.jobs  # noqa: F401
+import services.follow_up_service  # noqa: F401
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+
+async def main() -> None:
+    await db.connect()
+    await db.ensure_indexes()
+    await http_clients.start()
+    job_worker.start()
+    timer_scheduler.start()
+    logger.info("Job worker started with concurrency %s", job_worker.concurrency)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+
+    logger.info("Stopping job worker")
+    await timer_scheduler.stop()
+    await job_worker.stop(timeout=settings.shutdown_drain_timeout_seconds)
+    await outbound.stop(timeout=settings.shutdown_drain_timeout_seconds)
+    await outbox.close()
+    await http_clients.close()
+    db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())